@@ -4,10 +4,12 @@ import sys
 import csv
 import six
 import zlib
+import types
 import json
 import pytz
 import logging
 import lochness
+import threading
 import itertools
 import lochness.email
 import lochness.redcap as REDCap
@@ -45,6 +47,20 @@ Subject = col.namedtuple('Subject', [
 
 
 class Subject(object):
+    '''
+    Subject of a PHOENIX study, as read from the study metadata file.
+
+    The per-source fields, e.g., subject.box, may be given as frozen values
+    shared by every subject read from the same metadata file. A frozen value
+    is copied to a dict on first access, so subjects that are only
+    scheduled or compared never hold their own copies.
+    '''
+    __slots__ = ('active', 'study', 'id', 'consent', 'general_folder',
+                 'protected_folder', 'metadata_csv', '_bids',
+                 '_beiwe', '_icognition', '_saliva', '_xnat', '_redcap',
+                 '_dropbox', '_box', '_mediaflux', '_mindlamp', '_daris',
+                 '_rpms')
+
     def __init__(self, active, phoenix_study, phoenix_id, consent, beiwe,
                  icognition, saliva, xnat, redcap, dropbox,
                  box, mediaflux, mindlamp, daris, rpms,
@@ -81,7 +97,58 @@ class Subject(object):
                 'rpms': self.rpms, 'general_folder': self.general_folder,
                 'protected_folder': self.protected_folder,
                 'metadata_csv': self.metadata_csv}
-        
+
+
+class Frozen(tuple):
+    '''metadata value shared by the subjects of a metadata file'''
+    __slots__ = ()
+
+    def thaw(self):
+        return dict()
+
+
+class FrozenSources(Frozen):
+    '''source mapping, as ((deployment, (id, ...)), ...)'''
+    __slots__ = ()
+
+    def thaw(self):
+        return col.defaultdict(list, ((x, list(y)) for x, y in self))
+
+
+class FrozenList(Frozen):
+    '''list of values, e.g., saliva sample ids'''
+    __slots__ = ()
+
+    def thaw(self):
+        return list(self)
+
+
+# value of the fields of a source missing from the metadata file
+NO_COLUMN = Frozen()
+
+
+def _source_field(name):
+    '''subject field which thaws a frozen value on first access'''
+    slot = '_' + name
+
+    def getter(self):
+        value = getattr(self, slot)
+        if isinstance(value, Frozen):
+            value = value.thaw()
+            setattr(self, slot, value)
+        return value
+
+    def setter(self, value):
+        setattr(self, slot, value)
+
+    return property(getter, setter)
+
+
+for _name in ['beiwe', 'icognition', 'saliva', 'xnat', 'redcap', 'dropbox',
+              'box', 'mediaflux', 'mindlamp', 'daris', 'rpms']:
+    setattr(Subject, _name, _source_field(_name))
+del _name
+
 
 def initialize_metadata(Lochness, args, multiple_site_in_a_repo) -> None:
     '''Create (overwrite) metadata.csv using either REDCap or RPMS database'''
@@ -137,95 +204,222 @@ def read_phoenix_metadata(Lochness, studies=None):
             continue
 
 
-def _subjects(Lochness, study, general_folder, protected_folder, metadata_file):
-    meta_basename = os.path.basename(metadata_file)
-
-    # read the study metadata fiile (local or remote)
-    metadata_df = pd.read_csv(metadata_file)
-    metadata_df = metadata_df.astype(str)
-    headers = metadata_df.columns
-
-    for index, row in metadata_df.iterrows():
-        values = row.tolist()
-
-        # quick sanity check of the current row
-        if not values:
-            continue
-
-        # these columns are required
-        if len(values) != len(headers):
-            raise StudyMetadataError(
-                    f'bad row in metadata file for {meta_basename}')
+# optional metadata columns, parsed in this order, with the Subject field,
+# the default used for '*' and the number of fields of each value
+METADATA_SOURCES = [
+    ('Beiwe', 'beiwe', None, 3),
+    ('REDCap', 'redcap', 'redcap.*:{ID}', 2),
+    ('Mindlamp', 'mindlamp', 'mindlamp.*:{ID}', 2),
+    ('XNAT', 'xnat', 'cbscentral:Buckner_P:{ID}', 3),
+    ('iCognition', 'icognition', 'mytimedtest:{ID}', 2),
+    ('OnlineScoring', None, 'onlinescoring:{ID}', 2),
+    ('Dropbox', 'dropbox', 'dropbox.cbsn:{ID}', 2),
+    ('Box', 'box', 'box.*:{ID}', 2),
+    ('Mediaflux', 'mediaflux', 'mediaflux.*:{ID}', 2),
+    ('Daris', 'daris', 'daris.*:{ID}', 2),
+    ('RPMS', 'rpms', 'rpms.*:{ID}', 2),
+]
+
+MetadataCache = dict()
+'''
+Subjects parsed from each metadata file, reused until the file changes.
+'''
 
-        # these columns are required
-        row = dict(zip(headers, values))
-        active = int(row['Active'].strip())
-        consent = row['Consent'].strip()
-        phoenix_id = row['Subject ID'].strip()
 
-        # these columns are optional
-        phoenix_study = row.get('Study', study).strip()
+def _subjects(Lochness, study, general_folder, protected_folder, metadata_file):
+    '''
+    Yield the subjects of a metadata file. The file is parsed again only if
+    its content has changed since the last call, and the parsed values are
+    shared by the subjects of every call.
+    '''
+    key = (metadata_file, study, general_folder, protected_folder)
+    stat = os.stat(metadata_file)
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    with _subjects.lock:
+        cached = MetadataCache.get(key)
+    if cached is None or cached['signature'] != signature:
+        # the checksum and the rows are taken from the same read, so a file
+        # rewritten in between is not cached under the wrong checksum
+        with open(metadata_file, 'rb') as fo:
+            content = fo.read()
+        checksum = _crc32bin(io.BytesIO(content))
+        if cached is not None and checksum == cached['crc32']:
+            # metadata files are often rewritten with the same content
+            cached['signature'] = signature
+            logger.debug(f'metadata file {metadata_file} is unchanged')
+        else:
+            rows = _parse_metadata(study, general_folder, protected_folder,
+                                   metadata_file, content)
+            cached = {'signature': signature,
+                      'crc32': checksum,
+                      'rows': rows}
+            with _subjects.lock:
+                MetadataCache[key] = cached
+    else:
+        logger.debug(f'metadata file {metadata_file} is unchanged')
+
+    debug = logger.isEnabledFor(logging.DEBUG)
+    for row in cached['rows']:
+        if isinstance(row, Exception):
+            raise type(row)(*row.args)
+        subject = Subject(**row)
+        if debug:
+            logger.debug('subject metadata blob:\n{0}'.format(json.dumps(subject.asdict(), indent=2)))
+        yield subject
 
-        saliva = dict()
-        if 'Saliva' in row:
-            saliva = _parse_saliva(row['Saliva'], phoenix_id)
 
-        beiwe = dict()
-        if 'Beiwe' in row:
-            beiwe = _parse_beiwe(row['Beiwe'], phoenix_id)
+_subjects.lock = threading.Lock()
 
-        redcap = dict()
-        if 'REDCap' in row:
-            redcap = _parse_redcap(row['REDCap'], phoenix_id)
 
-        mindlamp = dict()
-        if 'Mindlamp' in row:
-            mindlamp = _parse_mindlamp(row['Mindlamp'], phoenix_id)
+def _parse_metadata(study, general_folder, protected_folder, metadata_file,
+                    content=None):
+    '''
+    Parse every row of a metadata file, column by column.
 
-        xnat = dict()
-        if 'XNAT' in row:
-            xnat = _parse_xnat(row['XNAT'], phoenix_id)
+    :param content: Content of the metadata file, read from disk if None
+    :type content: bytes
 
-        icognition = dict()
-        if 'iCognition' in row:
-            icognition = _parse_icognition(row['iCognition'], phoenix_id)
+    :returns: list of Subject keyword arguments, or of the exception raised
+              by a bad row, in the order of the rows
+    '''
+    meta_basename = os.path.basename(metadata_file)
 
-        onlinescoring = dict()
-        if 'OnlineScoring' in row:
-            onlinescoring = _parse_onlinescoring(row['OnlineScoring'], phoenix_id)
+    # read the study metadata fiile (local or remote)
+    metadata_df = pd.read_csv(metadata_file if content is None
+                              else io.BytesIO(content))
+    metadata_df = metadata_df.astype(str).reset_index(drop=True)
+    nrows = len(metadata_df)
+
+    # these columns are required
+    actives = metadata_df['Active'].str.strip().tolist()
+    consents = metadata_df['Consent'].str.strip().tolist()
+    phoenix_ids = metadata_df['Subject ID'].str.strip()
+
+    # these columns are optional
+    if 'Study' in metadata_df:
+        phoenix_studies = metadata_df['Study'].str.strip().tolist()
+    else:
+        phoenix_studies = [study.strip()] * nrows
+
+    if 'Saliva' in metadata_df:
+        saliva = [list() for _ in range(nrows)]
+        items = _metadata_items(metadata_df['Saliva'])
+        for index, item in items.items():
+            saliva[index].append(item)
+        saliva = [FrozenList(x) for x in saliva]
+    else:
+        saliva = [NO_COLUMN] * nrows
+
+    parsed = []
+    for column, field, default, nfields in METADATA_SOURCES:
+        if column in metadata_df:
+            parsed.append((field, _parse_metadata_column(
+                    metadata_df[column], phoenix_ids, default, nfields)))
+        else:
+            parsed.append((field, None))
 
-        dropbox = dict()
-        if 'Dropbox' in row:
-            dropbox = _parse_dropbox(row['Dropbox'], phoenix_id)
+    rows = []
+    phoenix_ids = phoenix_ids.tolist()
+    for index in range(nrows):
+        try:
+            active = int(actives[index])
+        except ValueError as e:
+            rows.append(e)
+            break
+
+        row = dict(active=active, phoenix_study=phoenix_studies[index],
+                   phoenix_id=phoenix_ids[index], consent=consents[index],
+                   saliva=saliva[index])
+        error = None
+        for field, values in parsed:
+            value = NO_COLUMN if values is None else values[index]
+            if isinstance(value, Exception):
+                error = value
+                break
+            if field is not None:
+                row[field] = value
+        if error is not None:
+            rows.append(error)
+            break
 
-        box = dict()
-        if 'Box' in row:
-            box = _parse_box(row['Box'], phoenix_id)
+        # sanity check on very critical bits of information
+        if not row['phoenix_id'] or not row['phoenix_study']:
+            rows.append(StudyMetadataError(
+                'bad row in metadata file {0}'.format(meta_basename)))
+            break
+
+        row['general'] = os.path.join(general_folder, row['phoenix_study'],
+                                      row['phoenix_id'])
+        row['protected'] = os.path.join(protected_folder,
+                                        row['phoenix_study'],
+                                        row['phoenix_id'])
+        row['metadata_file'] = metadata_file
+        rows.append(row)
+    return rows
+
+
+def _metadata_items(values):
+    '''
+    Split metadata values on semicolons, as [x.strip() for x in
+    value.split(';') if x], into a Series of items indexed by row.
+    '''
+    items = values.str.split(';').explode()
+    return items[items != ''].str.strip()
 
-        mediaflux = dict()
-        if 'Mediaflux' in row:
-            mediaflux = _parse_mediaflux(row['Mediaflux'], phoenix_id)
 
-        daris = dict()
-        if 'Daris' in row:
-            daris = _parse_daris(row['Daris'], phoenix_id)
+def _parse_metadata_column(values, phoenix_ids, default, nfields):
+    '''
+    Parse a metadata column. Each value is parsed as by _simple_parser, or
+    by _parse_xnat and _parse_beiwe when values have three fields.
+
+    :param values: metadata column
+    :type values: pandas.Series
+    :param phoenix_ids: subject id of each row
+    :type phoenix_ids: pandas.Series
+    :param default: value used for a single asterisk, formatted with the
+                    subject id, or None
+    :type default: str
+    :param nfields: number of colon separated fields of each value
+    :type nfields: int
+    :returns: list with a FrozenSources, or a StudyMetadataError, for each
+              row
+    '''
+    items = _metadata_items(values)
 
-        rpms = dict()
-        if 'RPMS' in row:
-            rpms = _parse_rpms(row['RPMS'], phoenix_id)
+    # use default if value was a single asterisk
+    if default is not None:
+        counts = items.groupby(level=0).size()
+        star = ((items == '*').values &
+                (counts.reindex(items.index).values == 1))
+        if star.any():
+            logger.debug('falling back to default {0} for {1} rows'.format(
+                default, star.sum()))
+            replaced = items.values.copy()
+            replaced[star] = [default.format(ID=phoenix_ids[x])
+                              for x in items.index[star]]
+            items = pd.Series(replaced, index=items.index)
 
-        # sanity check on very critical bits of information
-        if not phoenix_id or not phoenix_study:
-            raise StudyMetadataError('bad row in metadata file {0}'.format(meta_basename))
-        general = os.path.join(general_folder, phoenix_study, phoenix_id)
-        protected = os.path.join(protected_folder, phoenix_study, phoenix_id)
-        subject = Subject(active, phoenix_study, phoenix_id, consent, beiwe,
-                          icognition, saliva, xnat, redcap, dropbox,
-                          box, mediaflux, mindlamp, daris, rpms,
-                          general, protected, metadata_file)
-
-        logger.debug('subject metadata blob:\n{0}'.format(json.dumps(subject.asdict(), indent=2)))
-        yield subject
+    # split values on colon and return a dict structure
+    fields = items.str.split(':')
+    valid = (fields.str.len() == nfields).tolist()
+
+    results = [col.defaultdict(list) for _ in range(len(values))]
+    for index, item, item_fields, ok in zip(items.index, items.tolist(),
+                                            fields.tolist(), valid):
+        result = results[index]
+        if isinstance(result, Exception):
+            continue
+        if not ok:
+            results[index] = StudyMetadataError(
+                    'bad metadata value {0}'.format(item))
+        elif nfields == 2:
+            result[item_fields[0]].append(item_fields[1])
+        else:
+            result[item_fields[0]].append(tuple(item_fields[1:]))
+    return [x if isinstance(x, Exception)
+            else FrozenSources((y, tuple(z)) for y, z in x.items())
+            for x in results]
 
 
 def _parse_saliva(value, default_id=None):
@@ -375,19 +569,38 @@ def listdir(Lochness, d):
 
 def attempt(f, Lochness, *args, **kwargs):
     '''attempt a function call'''
-    if len(attempt.warnings) >= 5:
-        lochness.email.attempts_error(Lochness, attempt)
-        attempt.warnings = []
-        #raise AttemptsError('too many attempt warnings')
+    _check_attempt_warnings(Lochness)
     try:
         f(Lochness, *args, **kwargs)
     except Exception as e:
         logger.warn(e)
         logger.debug(tb.format_exc().strip())
-        attempt.warnings.append(str(e))
+        with attempt.lock:
+            attempt.warnings.append(str(e))
+
+
+def merge_attempt_warnings(Lochness, warnings):
+    '''merge warnings collected by attempt() in another process'''
+    for warning in warnings:
+        _check_attempt_warnings(Lochness)
+        with attempt.lock:
+            attempt.warnings.append(warning)
+
+
+def _check_attempt_warnings(Lochness):
+    '''send an error report once too many attempt warnings pile up'''
+    with attempt.lock:
+        if len(attempt.warnings) < 5:
+            return
+        report = types.SimpleNamespace(warnings=attempt.warnings)
+        attempt.warnings = []
+    # sent without the lock, so other workers are not blocked on the email
+    lochness.email.attempts_error(Lochness, report)
+    #raise AttemptsError('too many attempt warnings')
 
 
 attempt.warnings = []
+attempt.lock = threading.Lock()
 
 class AttemptsError(Exception):
     pass
@@ -10,14 +10,22 @@ import lochness.net as net
 from typing import Generator, Tuple
 from pathlib import Path
 import hashlib
-from io import BytesIO
 import lochness.keyring as keyring
 import lochness.net as net
 import lochness.tree as tree
+import lochness.ratelimit as ratelimit
+import lochness.box.cache as cache
+import lochness.resume as resume
+import lochness.executor as executor
+import lochness.patterns as patterns
+import lochness.index as fileindex
+from lochness.dropbox.hash import StreamHasher
 from os.path import join, basename
 from boxsdk import Client, OAuth2
-import cryptease as enc
-import re
+import requests
+from boxsdk.network.default_network import DefaultNetwork
+from boxsdk.session.session import AuthorizedSession
+import lochness.functools as functools
 
 
 logger = logging.getLogger(__name__)
@@ -25,6 +33,7 @@ Module = lochness.lchop(__name__, 'lochness.')
 Basename = lochness.lchop(__name__, 'lochness.box.')
 
 CHUNK_SIZE = 65536
+MAX_CONNECTIONS = 16
 
 def delete_on_success(Lochness, module_name):
     ''' get module-specific delete_on_success flag with a safe default '''
@@ -37,6 +46,17 @@ def delete_on_success(Lochness, module_name):
     return value
 
 
+def paranoid_verify(Lochness, module_name):
+    ''' get module-specific paranoid_verify flag with a safe default '''
+    value = Lochness.get('box', dict()) \
+                    .get(module_name, dict()) \
+                    .get('paranoid_verify', False)
+    # if this is anything but a boolean, just return False
+    if not isinstance(value, bool):
+        return False
+    return value
+
+
 def base(Lochness, module_name):
     ''' get module-specific base box directory '''
     return Lochness.get('box', {}) \
@@ -44,9 +64,31 @@ def base(Lochness, module_name):
                    .get('base', '')
 
 
+class PooledNetwork(DefaultNetwork):
+    '''Box network layer keeping up to MAX_CONNECTIONS open connections'''
+    def __init__(self):
+        super().__init__()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=MAX_CONNECTIONS)
+        self._session.mount('https://', adapter)
+
+
+@functools.run_cache
+def get_client(client_id: str, client_secret: str, api_token: str) -> Client:
+    '''Return a Box client shared by every subject within a run'''
+    auth = OAuth2(
+        client_id=client_id,
+        client_secret=client_secret,
+        access_token=api_token,
+    )
+    session = AuthorizedSession(auth, network_layer=PooledNetwork())
+    return Client(auth, session=session)
+
+
 def get_box_object_based_on_name(client: boxsdk.client,
                                  box_folder_name: str,
-                                 box_path_id: str = '0') \
+                                 box_path_id: str = '0',
+                                 listing_cache=None,
+                                 path_cache=None) \
                                          -> boxsdk.object.folder:
     '''Return Box folder object for the given folder name
 
@@ -54,53 +96,107 @@ def get_box_object_based_on_name(client: boxsdk.client,
     path strings in Box.
         - https://stackoverflow.com/questions/16153409/is-there-any-easy-way-to-get-folderid-based-on-a-given-path
 
-    This function will recursively search for a folder which
-    has the same name as the `bx_head` and return its id.
+    This function will search each level of the path for a folder which
+    has the same name and return the folder object of the last level.
 
     Key Arguments:
         client: Box client object
-        box_folder_name: Name of the folder in interest, str
+        box_folder_name: Name or path of the folder in interest, str
         box_path: Known parent id, str of int.
                   Default=0. This execute search from the root.
+        listing_cache: cache of folder listings, ListingCache, optional.
+        path_cache: cache of folder ids, PathCache, optional. Folders in
+                    the cache are fetched without listing their parent.
 
     Returns:
         box_folder_object
 
     '''
-    box_folder_name = str(box_folder_name)
-
     # if box root is given as path - eg) box_folder_name == 'example/PronetLA'
-    if '/' in box_folder_name:
-        # remove leading '/' from the path string
-        box_folder_name = box_folder_name[1:] if box_folder_name[0] == '/' \
-                else box_folder_name
-
-        # get root object
-        root = Path(box_folder_name).parts[0]
-        box_obj = get_box_object_based_on_name(client,
-                                               root,
-                                               box_path_id)
-
-        if box_path_id == '0':
-            box_obj = get_box_object_based_on_name(
-                    client,
-                    Path(box_folder_name).relative_to(root),
-                    box_obj.id)
+    # remove leading '/' from the path string
+    box_folder_name = str(box_folder_name).lstrip('/')
 
+    box_obj = None
+    for name in Path(box_folder_name).parts:
+        box_obj = _get_child_folder(client, name, box_path_id,
+                                    listing_cache, path_cache)
         if box_obj is None:
             return None
+        box_path_id = box_obj.object_id
+
+    return box_obj
+
+
+def _get_child_folder(client, name, box_path_id,
+                      listing_cache=None, path_cache=None):
+    '''Return the folder object named `name` under the folder box_path_id'''
+    if path_cache is not None:
+        folder_id = path_cache.get(box_path_id, name)
+        if folder_id is not None:
+            # the folder is fetched once per run for the signature of its
+            # listing
+            box_obj = path_cache.folder(folder_id)
+            if box_obj is not None:
+                return box_obj
+            try:
+                ratelimit.acquire('box')
+                box_obj = client.folder(folder_id=folder_id).get(
+                        fields=cache.LISTING_FIELDS)
+                path_cache.keep(box_obj)
+                return box_obj
+            except boxsdk.BoxAPIException as e:
+                if e.status != 404:
+                    raise
+                logger.debug(f'cached folder {box_path_id}/{name} is gone')
+                path_cache.drop(box_path_id, name)
 
     # get list of files and directories under the top directory
+    ratelimit.acquire('box')
     root_dir = client.folder(folder_id=box_path_id).get()
 
     # Return matched box object
-    for file_or_folder in root_dir.get_items():
-        if file_or_folder.type == 'folder' and \
-           file_or_folder.name == Path(box_folder_name).name:
+    for file_or_folder in list_folder(root_dir, listing_cache):
+        if file_or_folder.type == 'folder' and file_or_folder.name == name:
+            if path_cache is not None:
+                path_cache.put(box_path_id, name, file_or_folder.object_id)
+                path_cache.keep(file_or_folder)
             return file_or_folder
 
+    return None
+
+
+def list_folder(box_folder_object, listing_cache=None) -> list:
+    '''List the items of a Box folder
 
-def walk_from_folder_object(root: str, box_folder_object) -> \
+    The folder is only listed through the API when it has changed since its
+    listing was cached.
+
+    Key Arguments:
+        box_folder_object: folder object, Box Folder
+        listing_cache: cache of folder listings, ListingCache, optional.
+
+    Returns:
+        list of Box file and folder objects
+    '''
+    if listing_cache is not None:
+        folder_signature = cache.signature(box_folder_object)
+        items = listing_cache.get(box_folder_object.object_id,
+                                  folder_signature)
+        if items is not None:
+            return [cache.from_dict(box_folder_object, x) for x in items]
+
+    ratelimit.acquire('box')
+    items = list(box_folder_object.get_items(fields=cache.LISTING_FIELDS))
+
+    if listing_cache is not None:
+        listing_cache.put(box_folder_object.object_id,
+                          folder_signature,
+                          [cache.to_dict(x) for x in items])
+    return items
+
+
+def walk_from_folder_object(root: str, box_folder_object,
+                            listing_cache=None) -> \
         Generator[str, list, list]:
     '''top-down os.path.walk that operates on a Box folder object
 
@@ -111,6 +207,8 @@ def walk_from_folder_object(root: str, box_folder_object) -> \
     Key Arguments:
         root: path of the folder, str
         box_folder_object: folder object, Box Folder
+        listing_cache: cache of folder listings, ListingCache, optional.
+                       Unchanged folders are not listed again.
 
     Yields:
         (root, box_folder_objects, box_file_object)
@@ -119,7 +217,7 @@ def walk_from_folder_object(root: str, box_folder_object) -> \
         box_file_object: box file objects, list
     '''
     box_folder_objects, box_file_objects = [], []
-    for file_or_folder in box_folder_object.get_items():
+    for file_or_folder in list_folder(box_folder_object, listing_cache):
         if file_or_folder.type == 'folder':
             box_folder_objects.append(file_or_folder)
         else:
@@ -129,7 +227,8 @@ def walk_from_folder_object(root: str, box_folder_object) -> \
 
     for box_dir_object in box_folder_objects:
         new_root = os.path.join(root, box_dir_object.name)
-        for x in walk_from_folder_object(new_root, box_dir_object):
+        for x in walk_from_folder_object(new_root, box_dir_object,
+                                         listing_cache):
             yield x
 
 
@@ -137,8 +236,14 @@ def save(box_file_object: boxsdk.object.file,
          box_path_tuple: Tuple[str, str],
          out_base: str,
          key=None,
-         compress=False, delete=False, dry=False):
-    '''save a box file to an output directory'''
+         compress=False, delete=False, dry=False, paranoid=False,
+         index=None):
+    '''save a box file to an output directory
+
+    The sha1 is computed while the file is downloaded. With paranoid, the
+    saved file is also read back and verified. With a FileIndex, files that
+    are already saved are looked up in the index instead of on disk.
+    '''
     # file path
     box_path_root, box_path_name = box_path_tuple
     box_fullpath = os.path.join(box_path_root, box_path_name)
@@ -150,15 +255,20 @@ def save(box_file_object: boxsdk.object.file,
     # local path
     local_fullfile = os.path.join(out_base, box_path_name + ext)
 
-    if os.path.exists(local_fullfile):
+    remote = dict(remote_id=getattr(box_file_object, 'object_id', None),
+                  size=getattr(box_file_object, 'size', None),
+                  content_hash=getattr(box_file_object, 'sha1', None))
+    if fileindex.exists(index, local_fullfile, **remote):
         return
     local_dirname = os.path.dirname(local_fullfile)
-    if not os.path.exists(local_dirname):
-        os.makedirs(local_dirname)
+    os.makedirs(local_dirname, exist_ok=True)
 
     if not dry:
         try:
-            _save(box_file_object, box_fullpath, local_fullfile, key, compress)
+            _save(box_file_object, box_fullpath, local_fullfile, key,
+                  compress, paranoid)
+            if index is not None:
+                index.add(local_fullfile, **remote)
             if delete:
                 logger.debug(f'deleting file on box {box_fullpath}')
                 _delete(box_file_object, box_fullpath)
@@ -191,6 +301,7 @@ class HashRetryError(Exception):
 
 def _delete(box_file_object: boxsdk.object.file, box_fullpath: str):
     try:
+        ratelimit.acquire('box')
         md = box_file_object.delete()
 
     except boxsdk.BoxAPIException as e:
@@ -201,34 +312,98 @@ class DeletionError(Exception):
     pass
 
 
-@hash_retry(3)
-def _save(box_file_object, box_fullpath, local_fullfile, key, compress):
-    # request the file from box.com
+def open_content(box_file_object: boxsdk.object.file,
+                 byte_range: Tuple[int, int] = None):
+    '''Open a streaming download of a Box file
+
+    Unlike box_file_object.content(), the file content is not read into
+    memory, but read from the connection as the returned stream is read.
+
+    Key Arguments:
+        box_file_object: file object, Box File
+        byte_range: inclusive (first, last) byte offsets to download, the
+                    last offset may be None to download to the end.
+
+    Returns:
+        readable file-like object, which should be closed after use
+    '''
+    headers = None
+    if byte_range is not None:
+        first, last = byte_range
+        last = '' if last is None else last
+        headers = {'Range': f'bytes={first}-{last}'}
+    box_response = box_file_object.session.get(
+            box_file_object.get_url('content'),
+            expect_json_response=False,
+            stream=True,
+            headers=headers)
+    stream = box_response.network_response.response_as_stream
+    stream.decode_content = True
+    return stream
+
+
+def _open(box_file_object, box_fullpath, byte_range=None):
+    '''request the file content from box.com'''
     try:
-        content = BytesIO(box_file_object.content())
+        ratelimit.acquire('box')
+        return open_content(box_file_object, byte_range)
     except boxsdk.BoxAPIException as e:
-        if e.error.is_path() and e.error.get_path().is_not_found():
+        if e.status == 404:
             msg = f'error downloading file {box_fullpath}'
             raise DownloadError(msg)
         else:
             raise e
+
+
+@hash_retry(3)
+def _save(box_file_object, box_fullpath, local_fullfile, key, compress,
+          paranoid=False):
     local_dirname = os.path.dirname(local_fullfile)
     logger.info(f'saving {box_fullpath} to {local_fullfile} ')
-
-    # write the file content to a temporary location
-    if key:
-        _stream = crypt.encrypt(content, key, chunk_size=CHUNK_SIZE)
-        tmp_name = _savetemp(crypt.buffer(_stream),
-                             local_dirname,
-                             compress=compress)
+    hasher = hashlib.sha1()
+    size = getattr(box_file_object, 'size', None)
+
+    if resume.resumable(size, key):
+        # large files are saved to a part file first, which is resumed with
+        # range requests after a failure
+        part = resume.Part(local_fullfile, box_file_object.object_id,
+                           box_file_object.sha1, size)
+        part_name, hasher = part.download(
+                lambda offset: _open(box_file_object, box_fullpath,
+                                     (offset, None)),
+                hashlib.sha1)
+        verify_hasher(part_name, box_file_object.sha1, hasher)
+        if compress:
+            with open(part_name, 'rb') as content:
+                tmp_name = _savetemp(content, local_dirname, compress=True)
+            os.remove(part_name)
+        else:
+            tmp_name = part_name
     else:
-        tmp_name = _savetemp(content, local_dirname, compress=compress)
+        # stream the file content to a temporary location, hashing the plain
+        # content on the way
+        content = StreamHasher(_open(box_file_object, box_fullpath), hasher)
+        try:
+            if key:
+                _stream = crypt.encrypt(content, key, chunk_size=CHUNK_SIZE)
+                tmp_name = _savetemp(crypt.buffer(_stream),
+                                     local_dirname,
+                                     compress=compress)
+            else:
+                tmp_name = _savetemp(content, local_dirname,
+                                     compress=compress)
+        finally:
+            content.close()
+        verify_hasher(tmp_name, box_file_object.sha1, hasher)
 
     # verify the file and rename to final local destination
-    logger.debug(f'verifying temporary file {tmp_name}')
-    verify(tmp_name, box_file_object.sha1, key=key, compress=compress)
+    if paranoid:
+        logger.debug(f'verifying temporary file {tmp_name}')
+        verify(tmp_name, box_file_object.sha1, key=key, compress=compress)
     os.chmod(tmp_name, 0o0644)
     os.rename(tmp_name, local_fullfile)
+    if resume.resumable(size, key):
+        part.remove()
 
 
 class DownloadError(Exception):
@@ -275,6 +450,13 @@ def verify(f, content_hash, key=None, compress=False):
         raise BoxHashError(message, f)
 
 
+def verify_hasher(f, content_hash, hasher):
+    '''compare the box hash computed while saving f to content_hash'''
+    if hasher.hexdigest() != content_hash:
+        message = f'hash mismatch detected for {f}'
+        raise BoxHashError(message, f)
+
+
 class BoxHashError(Exception):
     def __init__(self, message, filename):
         super(BoxHashError, self).__init__(message)
@@ -296,114 +478,126 @@ def sync_module(Lochness: 'lochness.config',
     delete = delete_on_success(Lochness, module_basename)
     logger.debug(f'delete_on_success for {module_basename} is {delete}')
 
-    for bx_sid in subject.box[module_name]:
-        logger.debug(f'exploring {subject.study}/{subject.id}')
-        _passphrase = keyring.passphrase(Lochness, subject.study)
-        enc_key = enc.kdf(_passphrase)
+    # read back and verify every saved file
+    paranoid = paranoid_verify(Lochness, module_basename)
 
-        client_id, client_secret, api_token = keyring.box_api_token(
-                Lochness, module_name)
+    # folder listings cached between polls
+    listing_cache = cache.listing_cache(Lochness, module_basename)
 
-        # box authentication
-        auth = OAuth2(
-            client_id=client_id,
-            client_secret=client_secret,
-            access_token=api_token,
-        )
-        client = Client(auth)
+    # folder ids shared by every subject
+    path_cache = cache.path_cache(Lochness, module_basename)
 
-        bx_base = base(Lochness, module_basename)
+    # files already saved, indexed between polls
+    index = fileindex.get(Lochness, 'box', module_basename)
 
-        # get the id of the bx_base path in box
-        bx_base_obj = get_box_object_based_on_name(
-                client, bx_base, '0')
+    # files found by the walk are downloaded by a pool of workers
+    workers = executor.download_workers(Lochness, 'box')
+    with executor.DownloadQueue(workers) as downloads:
+        for bx_sid in subject.box[module_name]:
+            logger.debug(f'exploring {subject.study}/{subject.id}')
+            enc_key = keyring.encryption_key(Lochness, subject.study)
 
-        if bx_base_obj is None:
-            logger.debug('Root of the box is not found')
-            continue
+            client_id, client_secret, api_token = keyring.box_api_token(
+                    Lochness, module_name)
 
-        # loop through the items defined for the BOX data
-        for datatype, products in iter(
-                Lochness['box'][module_basename]['file_patterns'].items()):
+            # box authentication
+            client = get_client(client_id, client_secret, api_token)
 
-            if Lochness['BIDS']:
-                datatype_root_obj = get_box_object_based_on_name(
-                        client, datatype, bx_base_obj.id)
+            bx_base = base(Lochness, module_basename)
 
-                if datatype_root_obj == None:
-                    logger.debug(f'{datatype} is not found under {bx_base_obj}')
-                    continue
+            # get the id of the bx_base path in box
+            bx_base_obj = get_box_object_based_on_name(
+                    client, bx_base, '0', listing_cache, path_cache)
 
-                # for BIDS root datatype_obj has bx_sid
-                datatype_obj = get_box_object_based_on_name(
-                        client, bx_sid, datatype_root_obj.id)
-            else:
-                subject_obj = get_box_object_based_on_name(
-                        client, bx_sid, bx_base_obj.id)
+            if bx_base_obj is None:
+                logger.debug('Root of the box is not found')
+                continue
 
-                if subject_obj == None:
-                    logger.debug(f'{bx_sid} is not found under {bx_base_obj}')
-                    continue
+            # loop through the items defined for the BOX data
+            for datatype, products in iter(
+                    Lochness['box'][module_basename]['file_patterns'].items()):
 
-                datatype_obj = get_box_object_based_on_name(
-                        client, datatype, subject_obj.id)
+                if Lochness['BIDS']:
+                    datatype_root_obj = get_box_object_based_on_name(
+                            client, datatype, bx_base_obj.object_id,
+                            listing_cache, path_cache)
 
-            # full path
-            bx_head = join(bx_base,
-                           datatype,
-                           bx_sid)
+                    if datatype_root_obj == None:
+                        logger.debug(f'{datatype} is not found under {bx_base_obj}')
+                        continue
 
-            logger.debug('walking %s', bx_head)
+                    # for BIDS root datatype_obj has bx_sid
+                    datatype_obj = get_box_object_based_on_name(
+                            client, bx_sid, datatype_root_obj.object_id,
+                            listing_cache, path_cache)
+                else:
+                    subject_obj = get_box_object_based_on_name(
+                            client, bx_sid, bx_base_obj.object_id,
+                            listing_cache, path_cache)
+
+                    if subject_obj == None:
+                        logger.debug(f'{bx_sid} is not found under {bx_base_obj}')
+                        continue
 
-            # if the directory is empty
-            if datatype_obj == None:
-                continue
+                    datatype_obj = get_box_object_based_on_name(
+                            client, datatype, subject_obj.object_id,
+                            listing_cache, path_cache)
 
-            # walk through the root directory
-            for root, dirs, files in walk_from_folder_object(
-                    bx_head, datatype_obj):
-                for box_file_object in files:
-                    bx_tail = join(basename(root), box_file_object.name)
-                    product = _find_product(bx_tail, products, subject=bx_sid)
+                # full path
+                bx_head = join(bx_base,
+                               datatype,
+                               bx_sid)
 
-                    if not product:
-                        continue
+                logger.debug('walking %s', bx_head)
 
-                    protect = product.get('protect', True)
+                # if the directory is empty
+                if datatype_obj == None:
+                    continue
 
-                    # GENERAL / STUDY or PROTECTED / STUDY
-                    output_base = subject.protected_folder \
-                        if protect else subject.general_folder
+                # compile the file patterns once for the whole walk
+                find_product = patterns.compile(products, glob=True,
+                                                subject=bx_sid)
 
-                    encrypt = product.get('encrypt', False)
-                    key = enc_key if encrypt else None
+                # walk through the root directory
+                for root, dirs, files in walk_from_folder_object(
+                        bx_head, datatype_obj, listing_cache):
+                    for box_file_object in files:
+                        bx_tail = join(basename(root), box_file_object.name)
+                        product = find_product(bx_tail)
 
-                    processed = product.get('processed', False)
+                        if not product:
+                            continue
 
-                    # For DPACC, get processed from the config.yml
-                    output_base = tree.get(
-                            datatype,
-                            output_base,
-                            processed=processed,
-                            BIDS=Lochness['BIDS'])
+                        protect = product.get('protect', True)
 
-                    compress = product.get('compress', False)
+                        # GENERAL / STUDY or PROTECTED / STUDY
+                        output_base = subject.protected_folder \
+                            if protect else subject.general_folder
 
-                    save(box_file_object,
-                         (root, box_file_object.name),
-                         output_base, key=key,
-                         compress=compress, delete=False,
-                         dry=False)
+                        encrypt = product.get('encrypt', False)
+                        key = enc_key if encrypt else None
 
+                        processed = product.get('processed', False)
 
-def _find_product(s, products, **kwargs):
-    for product in products:
-        pattern = product['pattern'].safe_substitute(**kwargs)
-        pattern = re.sub(r'\*', '.*', pattern)
-        if re.match(pattern, s):
-            return product
+                        # For DPACC, get processed from the config.yml
+                        output_base = tree.get(
+                                datatype,
+                                output_base,
+                                processed=processed,
+                                BIDS=Lochness['BIDS'])
 
-    return None
+                        compress = product.get('compress', False)
+
+                        downloads.submit(save, box_file_object,
+                                         (root, box_file_object.name),
+                                         output_base, key=key,
+                                         compress=compress, delete=False,
+                                         dry=False, paranoid=paranoid,
+                                         index=index)
+
+
+def _find_product(s, products, **kwargs):
+    return patterns.compile(products, glob=True, **kwargs).match(s)
 
 
 @net.retry(max_attempts=5)
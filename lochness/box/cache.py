@@ -0,0 +1,315 @@
+import os
+import json
+import time
+import logging
+import threading
+import lochness
+import lochness.functools as functools
+
+logger = logging.getLogger(__name__)
+
+LISTING_FIELDS = ['type', 'id', 'name', 'sha1', 'size', 'etag',
+                  'modified_at', 'content_modified_at']
+
+DEFAULT_TTL = 86400
+
+ListingCaches = dict()
+'''
+Listing caches shared by every sync job in a process, keyed by cache file.
+'''
+
+
+def cache_dir(Lochness):
+    ''' get the cache directory, or None if caching is not configured '''
+    value = Lochness.get('cache_dir', None)
+    if not value:
+        return None
+    return os.path.expanduser(value)
+
+
+def ttl(Lochness, module_name, field):
+    ''' get module-specific cache ttl in seconds with a safe default '''
+    value = Lochness.get('box', dict()) \
+                    .get(module_name, dict()) \
+                    .get(field, DEFAULT_TTL)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return DEFAULT_TTL
+    return value
+
+
+def signature(box_folder_object):
+    '''
+    Change signature of a Box folder. Box updates the etag and the
+    content_modified_at of a folder when its content changes.
+
+    :param box_folder_object: Box folder, listed with LISTING_FIELDS
+    :type box_folder_object: boxsdk.object.folder.Folder
+    :returns: signature, or None if the folder was not listed with its
+              modification time
+    :rtype: list
+    '''
+    etag = getattr(box_folder_object, 'etag', None)
+    modified = getattr(box_folder_object, 'content_modified_at', None) or \
+               getattr(box_folder_object, 'modified_at', None)
+    if modified is None:
+        return None
+    return [etag, modified]
+
+
+class JsonCache(object):
+    '''
+    Dict of cache entries, optionally persisted to a json file. The file is
+    only rewritten when an entry changed since it was last saved.
+
+    :param path: json file to persist the entries to, optional
+    :type path: str
+    :param ttl: Maximum age of an entry in seconds
+    :type ttl: float
+    '''
+    def __init__(self, path=None, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        '''read entries from the cache file'''
+        try:
+            with open(self.path, 'r') as fp:
+                self.entries = json.load(fp)
+        except (ValueError, OSError) as e:
+            logger.warning(f'ignoring unreadable cache {self.path}: {e}')
+            self.entries = dict()
+
+    def save(self):
+        '''write entries to the cache file'''
+        if not self.path or not self.dirty:
+            return
+        with self.lock:
+            content = json.dumps(self.entries).encode('utf-8')
+            self.dirty = False
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lochness.atomic_write(self.path, content)
+        logger.debug(f'saved cache {self.path} '
+                     f'({self.hits} hits, {self.misses} misses)')
+
+    def expired(self, entry):
+        '''True if the entry is older than the ttl'''
+        return time.time() - entry['cached_at'] > self.ttl
+
+
+class ListingCache(JsonCache):
+    '''
+    Box folder listings keyed by folder id. A cached listing is only used
+    while the folder signature is unchanged and the listing is younger than
+    `ttl` seconds.
+    '''
+    def get(self, folder_id, signature):
+        '''
+        Return the cached items of a folder, or None if the folder has
+        changed since it was listed.
+
+        :param folder_id: Box folder id
+        :type folder_id: str
+        :param signature: Current folder signature
+        :type signature: list
+        :returns: list of item dicts, or None
+        '''
+        with self.lock:
+            listing = self.entries.get(folder_id)
+            if signature is None or listing is None or \
+                    listing['signature'] != signature or \
+                    self.expired(listing):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return listing['items']
+
+    def put(self, folder_id, signature, items):
+        '''
+        Store the items of a folder.
+
+        :param folder_id: Box folder id
+        :type folder_id: str
+        :param signature: Folder signature when the items were listed
+        :type signature: list
+        :param items: list of item dicts
+        :type items: list
+        '''
+        if signature is None:
+            return
+        with self.lock:
+            self.entries[folder_id] = {'signature': signature,
+                                       'cached_at': time.time(),
+                                       'items': items}
+            self.dirty = True
+
+
+class PathCache(JsonCache):
+    '''
+    Box folder ids keyed by parent folder id and folder name, so a path is
+    resolved without listing every folder on the way. Entries are evicted
+    after `ttl` seconds. The folder objects fetched for the ids are kept in
+    memory, so folders shared by every subject are fetched once per run.
+    '''
+    def __init__(self, path=None, ttl=DEFAULT_TTL):
+        super().__init__(path, ttl)
+        self.folders = dict()
+
+    def get(self, parent_id, name):
+        '''
+        Return the cached id of a folder, or None.
+
+        :param parent_id: Box id of the parent folder
+        :type parent_id: str
+        :param name: Folder name
+        :type name: str
+        :returns: Box folder id, or None
+        '''
+        key = f'{parent_id}/{name}'
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.expired(entry):
+                del self.entries[key]
+                self.dirty = True
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry['id']
+
+    def put(self, parent_id, name, folder_id):
+        '''
+        Store the id of a folder.
+
+        :param parent_id: Box id of the parent folder
+        :type parent_id: str
+        :param name: Folder name
+        :type name: str
+        :param folder_id: Box folder id
+        :type folder_id: str
+        '''
+        with self.lock:
+            self.entries[f'{parent_id}/{name}'] = {'id': folder_id,
+                                                   'cached_at': time.time()}
+            self.dirty = True
+
+    def drop(self, parent_id, name):
+        '''
+        Forget the id of a folder, e.g., once it was deleted or moved.
+
+        :param parent_id: Box id of the parent folder
+        :type parent_id: str
+        :param name: Folder name
+        :type name: str
+        '''
+        with self.lock:
+            folder = self.entries.pop(f'{parent_id}/{name}', None)
+            if folder is not None:
+                self.folders.pop(folder['id'], None)
+                self.dirty = True
+
+    def folder(self, folder_id):
+        '''
+        Return the folder object of an id fetched in this run, or None.
+
+        :param folder_id: Box folder id
+        :type folder_id: str
+        '''
+        with self.lock:
+            return self.folders.get(folder_id)
+
+    def keep(self, box_folder_object):
+        '''
+        Keep a folder object for the rest of the run.
+
+        :param box_folder_object: Box folder, with the listing fields
+        :type box_folder_object: boxsdk.object.folder.Folder
+        '''
+        with self.lock:
+            self.folders[box_folder_object.object_id] = box_folder_object
+
+
+def listing_cache(Lochness, module_name):
+    '''
+    Return the listing cache of a Box module, or None if ``cache_dir`` is
+    not set in the configuration file. The cache is created once and kept
+    for the life of the process, so continuous polls reuse it, and saved at
+    the end of every run.
+
+    :param Lochness: Lochness context
+    :type Lochness: dict
+    :param module_name: Box module name, without 'box.'
+    :type module_name: str
+    '''
+    directory = cache_dir(Lochness)
+    if directory is None:
+        return None
+    path = os.path.join(directory, 'box', f'{module_name}_listing.json')
+    with listing_cache.lock:
+        if path not in ListingCaches:
+            ListingCaches[path] = ListingCache(
+                    path, ttl=ttl(Lochness, module_name, 'listing_cache_ttl'))
+        return ListingCaches[path]
+
+
+listing_cache.lock = threading.Lock()
+
+
+@functools.run_end
+def save_listing_caches():
+    '''save the listing caches changed by a run'''
+    with listing_cache.lock:
+        caches = list(ListingCaches.values())
+    for cache in caches:
+        cache.save()
+
+
+def path_cache(Lochness, module_name):
+    '''
+    Return the path cache of a Box module. The cache is shared by every
+    subject within a run, and saved at the end of the run when ``cache_dir``
+    is set in the configuration file.
+
+    :param Lochness: Lochness context
+    :type Lochness: dict
+    :param module_name: Box module name, without 'box.'
+    :type module_name: str
+    '''
+    directory = cache_dir(Lochness)
+    path = os.path.join(directory, 'box', f'{module_name}_paths.json') \
+            if directory else None
+    return _path_cache(module_name, path,
+                       ttl(Lochness, module_name, 'path_cache_ttl'))
+
+
+@functools.run_cache
+def _path_cache(module_name, path, ttl):
+    return PathCache(path, ttl)
+
+
+@functools.run_end
+def save_path_caches():
+    '''save the path caches changed by a run'''
+    with _path_cache.lock:
+        caches = list(_path_cache.cache.values())
+    for cache in caches:
+        cache.save()
+
+
+def to_dict(box_object):
+    '''item dict with only the listing fields of a Box object'''
+    response = box_object.response_object
+    return dict((x, response[x]) for x in LISTING_FIELDS if x in response)
+
+
+def from_dict(box_folder_object, item):
+    '''Box object from an item dict, using the session of its parent folder'''
+    return box_folder_object.translator.translate(
+            box_folder_object.session, dict(item))
@@ -5,6 +5,7 @@ import yaml.reader
 import getpass as gp
 import cryptease as crypt
 import string
+import lochness.ratelimit as ratelimit
 
 logger = logging.getLogger(__name__)
 
@@ -33,6 +34,9 @@ def load(f: 'location', archive_base=None):
                     modality_dict['pattern'] = \
                         string.Template(modality_dict['pattern'])
 
+    # shared per-source api rate limits
+    ratelimit.configure(Lochness)
+
     with open(Lochness['keyring_file'], 'rb') as fp:
         logger.info('reading keyring file {0}'.format(Lochness['keyring_file']))
         if 'NRG_KEYRING_PASS' in os.environ:
@@ -1,16 +1,29 @@
 import os
+import time
 import gzip
+import threading
 import dropbox
 import logging
 import importlib
 import tempfile as tf
 import cryptease as crypt
 import lochness.net as net
+import lochness.ratelimit as ratelimit
+import lochness.functools as functools
+import lochness.resume as resume
+import hashlib
 from . import hash as hash
+from . import cursor as cursor
+import lochness.keyring as keyring
+import lochness.index as fileindex
 
 logger = logging.getLogger(__name__)
 
 CHUNK_SIZE = 1024
+MAX_CONNECTIONS = 16
+LONGPOLL_MIN_TIMEOUT = 30
+LONGPOLL_MAX_TIMEOUT = 60
+PARTS = 4
 
 def delete_on_success(Lochness, module_name):
     ''' get module-specific delete_on_success flag with a safe default '''
@@ -22,6 +35,16 @@ def delete_on_success(Lochness, module_name):
         return False
     return value
 
+def paranoid_verify(Lochness, module_name):
+    ''' get module-specific paranoid_verify flag with a safe default '''
+    value = Lochness.get('dropbox', dict()) \
+                   .get(module_name, dict()) \
+                   .get('paranoid_verify', False)
+    # if this is anything but a boolean, just return False
+    if not isinstance(value, bool):
+        return False
+    return value
+
 def base(Lochness, module_name):
     ''' get module-specific base dropbox diretory '''
     return Lochness.get('dropbox', {}) \
@@ -34,6 +57,64 @@ def sync(Lochness, subject, dry):
     for module in subject.dropbox:
         get(module).sync(Lochness, subject, dry)
 
+@functools.run_cache
+def get_client(api_token):
+    '''return a dropbox client shared by every subject within a run'''
+    session = dropbox.create_session(max_connections=MAX_CONNECTIONS)
+    return dropbox.Dropbox(api_token, session=session)
+
+def wait_for_changes(Lochness, timeout):
+    '''
+    Sleep for up to timeout seconds, waking up as soon as a file changes in
+    one of the Dropbox accounts of the keyring. Each account is watched with
+    files_list_folder_longpoll in its own thread. The threads are joined
+    before returning, so a longpoll lasts at most LONGPOLL_MAX_TIMEOUT
+    seconds, after which the threads see that a change was detected.
+
+    :returns: True if a change was detected
+    '''
+    deadline = time.monotonic() + timeout
+    changed = threading.Event()
+
+    def poll(api_token):
+        try:
+            client = get_client(api_token)
+            ratelimit.acquire('dropbox')
+            latest = client.files_list_folder_get_latest_cursor('', recursive=True)
+            while not changed.is_set():
+                remaining = int(deadline - time.monotonic())
+                if remaining < LONGPOLL_MIN_TIMEOUT:
+                    return
+                result = client.files_list_folder_longpoll(
+                        latest.cursor, timeout=min(remaining, LONGPOLL_MAX_TIMEOUT))
+                if result.changes:
+                    changed.set()
+                elif result.backoff:
+                    time.sleep(result.backoff)
+        except Exception as e:
+            logger.warn('stopped watching dropbox for changes: {0}'.format(e))
+
+    tokens = [keyring.dropbox_api_token(Lochness, x)
+              for x in Lochness['keyring'] if x.startswith('dropbox.')]
+    threads = []
+    if timeout >= LONGPOLL_MIN_TIMEOUT:
+        for api_token in tokens:
+            thread = threading.Thread(target=poll, args=(api_token,), daemon=True)
+            thread.start()
+            threads.append(thread)
+    changed.wait(timeout)
+    for thread in threads:
+        thread.join()
+    return changed.is_set()
+
+def cursor_store(Lochness, module_name):
+    '''return the cursor store of a dropbox module'''
+    return cursor.get(Lochness, module_name)
+
+def file_index(Lochness, module_name):
+    '''return the index of files saved by a dropbox module, or None'''
+    return fileindex.get(Lochness, 'dropbox', module_name)
+
 def get(module):
     '''return a specific dropbox module'''
     try:
@@ -42,18 +123,29 @@ def get(module):
     except ImportError:
         raise ImportError('no module {0} in package lochness.dropbox'.format(module))
 
-def walk(client, top=''):
-    '''top-down os.path.walk that operates on a Dropbox folder'''
+def walk(client, top='', cursors=None):
+    '''top-down os.path.walk that operates on a Dropbox folder
+
+    With a CursorStore, the folder is listed recursively on the first walk,
+    and later walks only fetch the changes since the stored cursor.
+    '''
+    if cursors is not None:
+        entries = _list_changes(client, top, cursors)
+        if entries is None:
+            return
+        for x in _walk_entries(top, entries):
+            yield x
+        return
     dirs,files = [],[]
     try:
-        listing = client.files_list_folder(top)
+        entries = _list_folder(client, top)
     except dropbox.exceptions.ApiError as e:
         if e.error.is_path() and e.error.get_path().is_not_found():    
             logger.info('path does not exist {}'.format(top))
         else:
             raise e
         return
-    for entry in listing.entries:
+    for entry in entries:
         if isinstance(entry, dropbox.files.FolderMetadata):
             dirs.append(os.path.basename(entry.path_display))
         else:
@@ -64,21 +156,115 @@ def walk(client, top=''):
         for x in walk(client, new_path):
             yield x
 
-def save(client, dbx_file, out_base, key=None, compress=False, delete=False, dry=False):
-    '''save a dropbox file to an output directory'''
+def _list_folder(client, top):
+    '''list every entry of a folder, following has_more'''
+    ratelimit.acquire('dropbox')
+    listing = client.files_list_folder(top)
+    entries = list(listing.entries)
+    while listing.has_more:
+        ratelimit.acquire('dropbox')
+        listing = client.files_list_folder_continue(listing.cursor)
+        entries.extend(listing.entries)
+    return entries
+
+def _list_changes(client, top, cursors):
+    '''
+    return {path_lower: [path_display, is_folder]} of every entry under a
+    folder, updated with the changes since the stored cursor
+    '''
+    stored = cursors.get(top)
+    listing = None
+    try:
+        if stored is not None:
+            cursor,entries = stored
+            try:
+                ratelimit.acquire('dropbox')
+                listing = client.files_list_folder_continue(cursor)
+            except dropbox.exceptions.ApiError as e:
+                if not e.error.is_reset():
+                    raise e
+                logger.info('cursor of {0} was reset'.format(top))
+        if listing is None:
+            entries = dict()
+            ratelimit.acquire('dropbox')
+            listing = client.files_list_folder(top, recursive=True)
+        _apply_changes(entries, listing.entries, top)
+        while listing.has_more:
+            ratelimit.acquire('dropbox')
+            listing = client.files_list_folder_continue(listing.cursor)
+            _apply_changes(entries, listing.entries, top)
+    except dropbox.exceptions.ApiError as e:
+        if e.error.is_path() and e.error.get_path().is_not_found():
+            logger.info('path does not exist {}'.format(top))
+            cursors.drop(top)
+            return None
+        raise e
+    cursors.put(top, listing.cursor, entries)
+    return entries
+
+def _apply_changes(entries, changes, top):
+    '''apply a page of files_list_folder entries'''
+    for entry in changes:
+        key = entry.path_lower
+        if key == top.lower().rstrip('/'):
+            continue
+        if isinstance(entry, dropbox.files.DeletedMetadata):
+            entries.pop(key, None)
+            for x in [x for x in entries if x.startswith(key + '/')]:
+                del entries[x]
+        else:
+            is_folder = isinstance(entry, dropbox.files.FolderMetadata)
+            entries[key] = [entry.path_display, is_folder]
+
+def _walk_entries(top, entries):
+    '''top-down os.path.walk over listed entries
+
+    Entries are grouped by the lowercased path of their parent, as Dropbox
+    paths are case insensitive and the path_display of a parent may differ
+    from the one in the path_display of its entries.
+    '''
+    tree = dict()
+    offset = len(top.rstrip('/'))
+    for path_lower,(path_display,is_folder) in entries.items():
+        parent = os.path.dirname(path_lower[offset:].strip('/'))
+        name = os.path.basename(path_display)
+        dirs,files = tree.setdefault(parent, (dict(), []))
+        if is_folder:
+            dirs[name.lower()] = name
+        else:
+            files.append(name)
+    def _walk(rel_lower, rel):
+        dirs,files = tree.get(rel_lower, (dict(), []))
+        yield os.path.join(top, rel) if rel else top, sorted(dirs.values()), sorted(files)
+        for d in sorted(dirs.values()):
+            for x in _walk(os.path.join(rel_lower, d.lower()), os.path.join(rel, d)):
+                yield x
+    return _walk('', '')
+
+def save(client, dbx_file, out_base, key=None, compress=False, delete=False, dry=False,
+         paranoid=False, index=None):
+    '''save a dropbox file to an output directory
+
+    The content hash is computed while the file is downloaded. With paranoid,
+    the saved file is also read back and verified. With a FileIndex, files
+    that are already saved are looked up in the index instead of on disk.
+    '''
     dbx_head,dbx_tail = dbx_file
     dbx_fullfile = os.path.join(dbx_head, dbx_tail)
     ext = '.lock' if key else ''
     ext = ext + '.gz' if compress else ext
     local_fullfile = os.path.join(out_base, dbx_tail + ext)
-    if os.path.exists(local_fullfile):
+    # the walk does not list ids, so files found on disk are indexed without
+    # one, and downloaded files with their Dropbox id
+    if fileindex.exists(index, local_fullfile):
         return
     local_dirname = os.path.dirname(local_fullfile)
-    if not os.path.exists(local_dirname):
-        os.makedirs(local_dirname)
+    os.makedirs(local_dirname, exist_ok=True)
     if not dry:
         try:
-            _save(client, dbx_fullfile, local_fullfile, key, compress)
+            md = _save(client, dbx_fullfile, local_fullfile, key, compress, paranoid)
+            if index is not None:
+                index.add(local_fullfile, md.id, md.size, md.content_hash)
             if delete:
                 logger.debug('deleting file on dropbox {0}'.format(dbx_fullfile))
                 _delete(client, dbx_fullfile)
@@ -106,6 +292,7 @@ class HashRetryError(Exception):
 
 def _delete(client, dbx_fullfile):
     try:
+        ratelimit.acquire('dropbox')
         md = client.files_delete(dbx_fullfile)
     except dropbox.exceptions.ApiError as e:
         raise DeletionError('error deleting file {0}'.format(dbx_fullfile))
@@ -113,29 +300,75 @@ def _delete(client, dbx_fullfile):
 class DeletionError(Exception):
     pass
 
-@hash_retry(3)
-def _save(client, dbx_fullfile, local_fullfile, key, compress):
-    # request the file from dropbox.com
+def _open(client, dbx_fullfile, offset=0, last=None):
+    '''request the file content from dropbox.com, optionally from an offset
+    up to an inclusive last byte'''
+    if offset or last is not None:
+        last = '' if last is None else last
+        client = client.clone(headers={'Range': 'bytes={0}-{1}'.format(offset, last)})
+    try:
+        ratelimit.acquire('dropbox')
+        return client.files_download(dbx_fullfile)
+    except dropbox.exceptions.ApiError as e:
+        if e.error.is_path() and e.error.get_path().is_not_found():
+            raise DownloadError('error downloading file {0}'.format(dbx_fullfile))
+        else:
+            raise e
+
+def _metadata(client, dbx_fullfile):
+    '''get the metadata of a file from dropbox.com'''
     try:
-        md,resp = client.files_download(dbx_fullfile)
+        ratelimit.acquire('dropbox')
+        return client.files_get_metadata(dbx_fullfile)
     except dropbox.exceptions.ApiError as e:
         if e.error.is_path() and e.error.get_path().is_not_found():
             raise DownloadError('error downloading file {0}'.format(dbx_fullfile))
         else:
             raise e
+
+@hash_retry(3)
+def _save(client, dbx_fullfile, local_fullfile, key, compress, paranoid=False):
+    md = _metadata(client, dbx_fullfile)
     local_dirname = os.path.dirname(local_fullfile)
     logger.info('saving {0} to {1} '.format(dbx_fullfile, local_fullfile))
-    # write the file content to a temporary location
-    if key:
-        _stream = crypt.encrypt(resp.raw, key, chunk_size=CHUNK_SIZE)
-        tmp_name = _savetemp(crypt.buffer(_stream), local_dirname, compress=compress)
+    if resume.resumable(md.size, key):
+        # large files are saved to a part file first, fetching PARTS blocks
+        # of the content hash at the same time. Each block is hashed as it
+        # arrives, and only missing blocks are fetched after a failure
+        part = resume.Part(local_fullfile, md.id, md.content_hash, md.size)
+        blocks = part.download_blocks(
+                lambda first, last: _open(client, dbx_fullfile, first, last)[1].raw,
+                lambda data: hashlib.sha256(data).digest(),
+                hash.DropboxContentHasher.BLOCK_SIZE,
+                PARTS)
+        part_name = part.path
+        verify_hasher(part_name, md.content_hash, combine_blocks(blocks))
+        if compress:
+            with open(part_name, 'rb') as content:
+                tmp_name = _savetemp(content, local_dirname, compress=True)
+            os.remove(part_name)
+        else:
+            tmp_name = part_name
     else:
-        tmp_name = _savetemp(resp.raw, local_dirname, compress=compress)
+        # hash the plain content while writing it to a temporary location
+        md,resp = _open(client, dbx_fullfile)
+        hasher = hash.DropboxContentHasher()
+        content = hash.StreamHasher(resp.raw, hasher)
+        if key:
+            _stream = crypt.encrypt(content, key, chunk_size=CHUNK_SIZE)
+            tmp_name = _savetemp(crypt.buffer(_stream), local_dirname, compress=compress)
+        else:
+            tmp_name = _savetemp(content, local_dirname, compress=compress)
+        verify_hasher(tmp_name, md.content_hash, hasher)
     # verify the file and rename to final local destination
-    logger.debug('verifying temporary file {0}'.format(tmp_name))
-    verify(tmp_name, md.content_hash, key=key, compress=compress)
+    if paranoid:
+        logger.debug('verifying temporary file {0}'.format(tmp_name))
+        verify(tmp_name, md.content_hash, key=key, compress=compress)
     os.chmod(tmp_name, 0o0644)
     os.rename(tmp_name, local_fullfile)
+    if resume.resumable(md.size, key):
+        part.remove()
+    return md
 
 class DownloadError(Exception):
     pass
@@ -175,6 +408,19 @@ def verify(f, content_hash, key=None, compress=False):
         message = 'hash mismatch detected for {0}'.format(f)
         raise DropboxHashError(message, f)
 
+def combine_blocks(block_digests):
+    '''dropbox content hasher from the sha256 digests of the file blocks'''
+    hasher = hashlib.sha256()
+    for block_digest in block_digests:
+        hasher.update(block_digest)
+    return hasher
+
+def verify_hasher(f, content_hash, hasher):
+    '''compare the dropbox hash computed while saving f to content_hash'''
+    if hasher.hexdigest() != content_hash:
+        message = 'hash mismatch detected for {0}'.format(f)
+        raise DropboxHashError(message, f)
+
 class DropboxHashError(Exception):
     def __init__(self, message, filename):
         super(DropboxHashError, self).__init__(message)
@@ -1,10 +1,9 @@
 import os
 import re
-import dropbox
 import logging
 import lochness
-import cryptease
 import lochness.dropbox
+import lochness.executor
 import lochness.net as net
 import lochness.tree as tree
 import lochness.keyring as keyring
@@ -31,31 +30,38 @@ logger = logging.getLogger(__name__)
 def sync(Lochness, subject, dry):
     delete = lochness.dropbox.delete_on_success(Lochness, Basename)
     logger.debug('delete_on_success for {0} is {1}'.format(Basename, delete))
-    for dbx_sid in subject.dropbox[Module]:
-        logger.debug('exploring {0}/{1}'.format(subject.study, subject.id))
-        _passphrase = keyring.passphrase(Lochness, subject.study)
-        enc_key = cryptease.kdf(_passphrase)
-        api_token = keyring.dropbox_api_token(Lochness, Module)
-        client = dropbox.Dropbox(api_token)
-        patterns = _batch_compile(CONFIG, dbx_sid)
-        for category,datatype in _iterate(CONFIG):
-            output_base = subject.protected_folder if category == 'PROTECTED' else subject.general_folder
-            output_base = tree.get(datatype, output_base)
-            dbx_head = os.path.join(os.sep, datatype, subject.study)
-            # shim the dropbox head for certain data types
-            if datatype == 'onsite_interview':
-                dbx_head = os.path.join(dbx_head, 'output')
-            elif datatype == 'behav_qc':
-                dbx_head = os.path.join(dbx_head, dbx_sid)
-            dbx_head_len = len(dbx_head)
-            for root,dirs,files in lochness.dropbox.walk(client, dbx_head):
-                for f in files:
-                    dbx_tail = os.path.join(root, f)[dbx_head_len:].lstrip(os.sep)
-                    dbx_file = dbx_head,dbx_tail
-                    if patterns[datatype].match(dbx_tail):
-                        key = enc_key if category == 'PROTECTED' else None
-                        lochness.dropbox.save(client, dbx_file, output_base,
-                                             key=key, delete=delete, dry=dry)
+    paranoid = lochness.dropbox.paranoid_verify(Lochness, Basename)
+    cursors = lochness.dropbox.cursor_store(Lochness, Basename)
+    index = lochness.dropbox.file_index(Lochness, Basename)
+    # files found by the walk are downloaded by a pool of workers
+    workers = lochness.executor.download_workers(Lochness, 'dropbox')
+    with lochness.executor.DownloadQueue(workers) as downloads:
+        for dbx_sid in subject.dropbox[Module]:
+            logger.debug('exploring {0}/{1}'.format(subject.study, subject.id))
+            enc_key = keyring.encryption_key(Lochness, subject.study)
+            api_token = keyring.dropbox_api_token(Lochness, Module)
+            client = lochness.dropbox.get_client(api_token)
+            patterns = _batch_compile(CONFIG, dbx_sid)
+            for category,datatype in _iterate(CONFIG):
+                output_base = subject.protected_folder if category == 'PROTECTED' else subject.general_folder
+                output_base = tree.get(datatype, output_base)
+                dbx_head = os.path.join(os.sep, datatype, subject.study)
+                # shim the dropbox head for certain data types
+                if datatype == 'onsite_interview':
+                    dbx_head = os.path.join(dbx_head, 'output')
+                elif datatype == 'behav_qc':
+                    dbx_head = os.path.join(dbx_head, dbx_sid)
+                dbx_head_len = len(dbx_head)
+                for root,dirs,files in lochness.dropbox.walk(client, dbx_head, cursors):
+                    for f in files:
+                        dbx_tail = os.path.join(root, f)[dbx_head_len:].lstrip(os.sep)
+                        dbx_file = dbx_head,dbx_tail
+                        if patterns[datatype].match(dbx_tail):
+                            key = enc_key if category == 'PROTECTED' else None
+                            downloads.submit(lochness.dropbox.save,
+                                             client, dbx_file, output_base,
+                                             key=key, delete=delete, dry=dry,
+                                             paranoid=paranoid, index=index)
 
 def _iterate(config):
     for category,blob in iter(config.items()):
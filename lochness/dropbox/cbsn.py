@@ -1,9 +1,9 @@
 import os
 import re
 import lochness
-import dropbox
 import logging
 import lochness.dropbox
+import lochness.executor
 import lochness.net as net
 import lochness.tree as tree
 import lochness.keyring as keyring
@@ -23,36 +23,48 @@ logger = logging.getLogger(__name__)
 def sync(Lochness, subject, dry=False):
     delete = lochness.dropbox.delete_on_success(Lochness, Basename)
     logger.debug('delete_on_success for {0} is {1}'.format(Basename, delete))
-    for dbx_sid in subject.dropbox[Module]:
-        logger.debug('exploring {0}/{1}'.format(subject.study, subject.id))
-        api_token = keyring.dropbox_api_token(Lochness, Module)
-        client = dropbox.Dropbox(api_token)
-        dbx_base = lochness.dropbox.base(Lochness, Basename)
-        patterns = _batch_compile(PATTERNS)
-        # walk dropbox 'Data_output' folder
-        mri_eye_base = tree.get('mri_eye', subject.general_folder)
-        mri_behav_base = tree.get('mri_behav', subject.general_folder)
-        dbx_head = os.path.join(dbx_base, 'Data_output', dbx_sid)
-        dbx_head_len = len(dbx_head)
-        for root,dirs,files in lochness.dropbox.walk(client, dbx_head):
-            for f in files:
-                dbx_tail = os.path.join(root, f)[dbx_head_len:].lstrip(os.sep)
-                dbx_file = dbx_head,dbx_tail
-                if patterns['mri_eye'].match(f): # mri_eye
-                    lochness.dropbox.save(client, dbx_file, mri_eye_base, dry=dry)
-                elif patterns['mri_behav'].match(f): # mri_behav
-                    lochness.dropbox.save(client, dbx_file, mri_behav_base, dry=dry)
-        # walk dropbox 'Behav_QC' folder
-        behav_qc_base = tree.get('behav_qc', subject.general_folder)
-        dbx_head = os.path.join(dbx_base, 'Behav_QC', dbx_sid)
-        dbx_head_len = len(dbx_head)
-        for root,dirs,files in lochness.dropbox.walk(client, dbx_head):
-            for f in files:
-                dbx_tail = os.path.join(root, f)[dbx_head_len:].lstrip(os.sep)
-                dbx_file = dbx_head,dbx_tail
-                if patterns['behav_qc'].match(f): # behav_qc
-                    lochness.dropbox.save(client, dbx_file, behav_qc_base, 
-                                         delete=delete, dry=dry)
+    paranoid = lochness.dropbox.paranoid_verify(Lochness, Basename)
+    cursors = lochness.dropbox.cursor_store(Lochness, Basename)
+    index = lochness.dropbox.file_index(Lochness, Basename)
+    # files found by the walk are downloaded by a pool of workers
+    workers = lochness.executor.download_workers(Lochness, 'dropbox')
+    with lochness.executor.DownloadQueue(workers) as downloads:
+        for dbx_sid in subject.dropbox[Module]:
+            logger.debug('exploring {0}/{1}'.format(subject.study, subject.id))
+            api_token = keyring.dropbox_api_token(Lochness, Module)
+            client = lochness.dropbox.get_client(api_token)
+            dbx_base = lochness.dropbox.base(Lochness, Basename)
+            patterns = _batch_compile(PATTERNS)
+            # walk dropbox 'Data_output' folder
+            mri_eye_base = tree.get('mri_eye', subject.general_folder)
+            mri_behav_base = tree.get('mri_behav', subject.general_folder)
+            dbx_head = os.path.join(dbx_base, 'Data_output', dbx_sid)
+            dbx_head_len = len(dbx_head)
+            for root,dirs,files in lochness.dropbox.walk(client, dbx_head, cursors):
+                for f in files:
+                    dbx_tail = os.path.join(root, f)[dbx_head_len:].lstrip(os.sep)
+                    dbx_file = dbx_head,dbx_tail
+                    if patterns['mri_eye'].match(f): # mri_eye
+                        downloads.submit(lochness.dropbox.save,
+                                         client, dbx_file, mri_eye_base, dry=dry,
+                                         paranoid=paranoid, index=index)
+                    elif patterns['mri_behav'].match(f): # mri_behav
+                        downloads.submit(lochness.dropbox.save,
+                                         client, dbx_file, mri_behav_base, dry=dry,
+                                         paranoid=paranoid, index=index)
+            # walk dropbox 'Behav_QC' folder
+            behav_qc_base = tree.get('behav_qc', subject.general_folder)
+            dbx_head = os.path.join(dbx_base, 'Behav_QC', dbx_sid)
+            dbx_head_len = len(dbx_head)
+            for root,dirs,files in lochness.dropbox.walk(client, dbx_head, cursors):
+                for f in files:
+                    dbx_tail = os.path.join(root, f)[dbx_head_len:].lstrip(os.sep)
+                    dbx_file = dbx_head,dbx_tail
+                    if patterns['behav_qc'].match(f): # behav_qc
+                        downloads.submit(lochness.dropbox.save,
+                                         client, dbx_file, behav_qc_base,
+                                         delete=delete, dry=dry,
+                                         paranoid=paranoid, index=index)
 
 def _batch_compile(patterns):
     '''batch compile regular expressions'''
@@ -0,0 +1,121 @@
+import os
+import json
+import logging
+import threading
+import lochness
+import lochness.functools as functools
+
+logger = logging.getLogger(__name__)
+
+CursorStores = dict()
+'''
+Cursor stores shared by every sync job in a process, keyed by module name.
+'''
+
+
+class CursorStore(object):
+    '''
+    files_list_folder cursors of watched Dropbox folders, with the entries
+    listed under each folder so far. A folder walked with a cursor only
+    fetches the changes made since the last walk. The cursor file is only
+    rewritten when a cursor changed since it was last saved.
+
+    :param path: json file to persist the cursors to, optional
+    :type path: str
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.folders = dict()
+        self.dirty = False
+        if path and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        '''read cursors from the cursor file'''
+        try:
+            with open(self.path, 'r') as fp:
+                self.folders = json.load(fp)
+        except (ValueError, OSError) as e:
+            logger.warning(f'ignoring unreadable cursors {self.path}: {e}')
+            self.folders = dict()
+
+    def save(self):
+        '''write cursors to the cursor file'''
+        if not self.path or not self.dirty:
+            return
+        with self.lock:
+            content = json.dumps(self.folders).encode('utf-8')
+            self.dirty = False
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lochness.atomic_write(self.path, content)
+
+    def get(self, top):
+        '''
+        Return the cursor and entries of a folder, or None.
+
+        :param top: Dropbox folder path
+        :type top: str
+        :returns: (cursor, {path_lower: [path_display, is_folder]})
+        '''
+        with self.lock:
+            folder = self.folders.get(top.lower())
+            if folder is None:
+                return None
+            return folder['cursor'], dict(folder['entries'])
+
+    def put(self, top, cursor, entries):
+        '''
+        Store the cursor and entries of a folder.
+
+        :param top: Dropbox folder path
+        :type top: str
+        :param cursor: files_list_folder cursor
+        :type cursor: str
+        :param entries: {path_lower: [path_display, is_folder]}
+        :type entries: dict
+        '''
+        folder = {'cursor': cursor, 'entries': entries}
+        with self.lock:
+            if self.folders.get(top.lower()) != folder:
+                self.folders[top.lower()] = folder
+                self.dirty = True
+
+    def drop(self, top):
+        '''forget a folder, e.g., when it does not exist anymore'''
+        with self.lock:
+            if self.folders.pop(top.lower(), None) is not None:
+                self.dirty = True
+
+
+def get(Lochness, module_name):
+    '''
+    Return the cursor store of a Dropbox module. The store is kept for the
+    life of the process, and saved at the end of every run when
+    ``cache_dir`` is set in the configuration file.
+
+    :param Lochness: Lochness context
+    :type Lochness: dict
+    :param module_name: Dropbox module name, without 'dropbox.'
+    :type module_name: str
+    '''
+    path = None
+    if Lochness.get('cache_dir', None):
+        path = os.path.join(os.path.expanduser(Lochness['cache_dir']),
+                            'dropbox', f'{module_name}_cursors.json')
+    with get.lock:
+        if module_name not in CursorStores:
+            CursorStores[module_name] = CursorStore(path)
+        return CursorStores[module_name]
+
+
+get.lock = threading.Lock()
+
+
+@functools.run_end
+def save_cursor_stores():
+    '''save the cursor stores changed by a run'''
+    with get.lock:
+        stores = list(CursorStores.values())
+    for store in stores:
+        store.save()
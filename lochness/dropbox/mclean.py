@@ -1,14 +1,13 @@
 import os
-import re
 import string
-import dropbox
 import lochness
 import logging
-import cryptease as enc
 import lochness.dropbox
+import lochness.executor
 import lochness.net as net
 import lochness.tree as tree
 import lochness.keyring as keyring
+import lochness.patterns as patterns
 
 CONFIG = {
     'actigraphy': [
@@ -78,36 +77,39 @@ logger = logging.getLogger(__name__)
 def sync(Lochness, subject, dry):
     delete = lochness.dropbox.delete_on_success(Lochness, Basename)
     logger.debug('delete_on_success for {0} is {1}'.format(Basename, delete))
-    for dbx_sid in subject.dropbox[Module]:
-        logger.debug('exploring {0}/{1}'.format(subject.study, subject.id))
-        _passphrase = keyring.passphrase(Lochness, subject.study)
-        enc_key = enc.kdf(_passphrase)
-        api_token = keyring.dropbox_api_token(Lochness, Module)
-        client = dropbox.Dropbox(api_token)
-        dbx_base = lochness.dropbox.base(Lochness, Basename)
-        for datatype,products in iter(CONFIG.items()):
-            dbx_head = os.path.join(dbx_base, datatype, 'PHOENIX_PULL_{0}_{1}'.format(datatype, subject.study), dbx_sid)
-            dbx_head_len = len(dbx_head)
-            logger.debug('walking %s', dbx_head)
-            for root,dirs,files in lochness.dropbox.walk(client, dbx_head):
-                for f in files:
-                    dbx_tail = os.path.join(root, f)[dbx_head_len:].lstrip(os.sep)
-                    dbx_file = (dbx_head, dbx_tail)
-                    product = _find_product(dbx_tail, products, subject=dbx_sid)
-                    if not product:
-                        continue
-                    protect = product.get('protect', False)
-                    compress = product.get('compress', False)
-                    key = enc_key if protect else None
-                    output_base = subject.protected_folder if protect else subject.general_folder
-                    output_base = tree.get(datatype, output_base)
-                    lochness.dropbox.save(client, dbx_file, output_base, key=key,
-                                          compress=compress, delete=delete, dry=dry)
+    paranoid = lochness.dropbox.paranoid_verify(Lochness, Basename)
+    cursors = lochness.dropbox.cursor_store(Lochness, Basename)
+    index = lochness.dropbox.file_index(Lochness, Basename)
+    # files found by the walk are downloaded by a pool of workers
+    workers = lochness.executor.download_workers(Lochness, 'dropbox')
+    with lochness.executor.DownloadQueue(workers) as downloads:
+        for dbx_sid in subject.dropbox[Module]:
+            logger.debug('exploring {0}/{1}'.format(subject.study, subject.id))
+            enc_key = keyring.encryption_key(Lochness, subject.study)
+            api_token = keyring.dropbox_api_token(Lochness, Module)
+            client = lochness.dropbox.get_client(api_token)
+            dbx_base = lochness.dropbox.base(Lochness, Basename)
+            for datatype,products in iter(CONFIG.items()):
+                dbx_head = os.path.join(dbx_base, datatype, 'PHOENIX_PULL_{0}_{1}'.format(datatype, subject.study), dbx_sid)
+                dbx_head_len = len(dbx_head)
+                logger.debug('walking %s', dbx_head)
+                find_product = patterns.compile(products, subject=dbx_sid)
+                for root,dirs,files in lochness.dropbox.walk(client, dbx_head, cursors):
+                    for f in files:
+                        dbx_tail = os.path.join(root, f)[dbx_head_len:].lstrip(os.sep)
+                        dbx_file = (dbx_head, dbx_tail)
+                        product = find_product(dbx_tail)
+                        if not product:
+                            continue
+                        protect = product.get('protect', False)
+                        compress = product.get('compress', False)
+                        key = enc_key if protect else None
+                        output_base = subject.protected_folder if protect else subject.general_folder
+                        output_base = tree.get(datatype, output_base)
+                        downloads.submit(lochness.dropbox.save,
+                                         client, dbx_file, output_base, key=key,
+                                         compress=compress, delete=delete, dry=dry,
+                                         paranoid=paranoid, index=index)
 
 def _find_product(s, products, **kwargs):
-    for product in products:
-        pattern = product['pattern'].safe_substitute(**kwargs)
-        if re.match(pattern, s):
-            #logger.debug('{0} is from product={1}, vendor={2}'.format(s, product['product'], product['vendor']))
-            return product
-    return None
+    return patterns.compile(products, **kwargs).match(s)
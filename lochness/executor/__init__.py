@@ -0,0 +1,207 @@
+import logging
+import lochness
+import threading
+import importlib
+import collections as col
+import lochness.functools as functools
+import concurrent.futures as cf
+
+logger = logging.getLogger(__name__)
+
+EXECUTORS = {
+    'thread': cf.ThreadPoolExecutor,
+    'process': cf.ProcessPoolExecutor
+}
+
+MAX_DEFERRED = 1000
+'''
+Jobs of sources at their concurrency cap kept aside while looking for a job
+to run. Once reached, no more jobs are pulled until a running job finishes.
+'''
+
+
+def source_name(Module):
+    '''get the source name of a sync module e.g., lochness.box -> box'''
+    return lochness.lchop(Module.__name__, 'lochness.').split('.')[0]
+
+
+def concurrency_caps(Lochness):
+    ''' get per-source concurrency caps from the configuration file '''
+    caps = dict()
+    for source, value in iter(Lochness.get('concurrency', dict()).items()):
+        # if this is anything but a positive integer, ignore the cap
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            logger.warn(f'ignoring bad concurrency cap for {source}: {value}')
+            continue
+        caps[source] = value
+    return caps
+
+
+def download_workers(Lochness, source):
+    ''' get the number of concurrent downloads of a source with a safe default '''
+    value = Lochness.get('download_workers', dict()).get(source, 1)
+    # if this is anything but a positive integer, download one file at a time
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        return 1
+    return value
+
+
+def run(Lochness, jobs, workers=1, kind='thread', dry=False):
+    '''Run (Module, subject) sync jobs on a bounded pool of workers
+
+    Each job is passed through lochness.attempt, so a failing job is logged
+    and recorded in attempt.warnings without stopping the other jobs. With a
+    single worker, jobs run serially in the calling thread.
+
+    Key arguments:
+        Lochness: Lochness config.load object
+        jobs: iterable of (Module, subject) tuples, where Module is a lochness
+              source module with a sync function.
+        workers: maximum number of jobs running at the same time, int.
+        kind: 'thread' or 'process', str.
+        dry: dry run, bool.
+    '''
+    if workers <= 1:
+        for Module, subject in jobs:
+            lochness.attempt(Module.sync, Lochness, subject, dry=dry)
+        return
+
+    if kind not in EXECUTORS:
+        raise ExecutorError(f'unknown executor kind {kind}')
+
+    caps = concurrency_caps(Lochness)
+    running = col.Counter()
+    deferred = col.deque()
+    futures = dict()
+    jobs = iter(jobs)
+
+    with EXECUTORS[kind](max_workers=workers) as pool:
+        while True:
+            # keep the pool full with jobs whose source is under its cap
+            while len(futures) < workers:
+                job = _next_job(jobs, deferred, running, caps)
+                if job is None:
+                    break
+                Module, subject = job
+                source = source_name(Module)
+                running[source] += 1
+                logger.debug(f'submitting {source} job for '
+                             f'{subject.study}/{subject.id}')
+                if kind == 'process':
+                    future = pool.submit(_attempt_in_process, Module.__name__,
+                                         Lochness, subject, dry)
+                else:
+                    future = pool.submit(lochness.attempt, Module.sync,
+                                         Lochness, subject, dry=dry)
+                futures[future] = source
+
+            if not futures:
+                break
+
+            done, _ = cf.wait(futures, return_when=cf.FIRST_COMPLETED)
+            for future in done:
+                running[futures.pop(future)] -= 1
+                warnings = future.result()
+                if kind == 'process':
+                    lochness.merge_attempt_warnings(Lochness, warnings)
+
+
+def _next_job(jobs, deferred, running, caps):
+    '''return the next job whose source is under its concurrency cap'''
+    for index, (Module, subject) in enumerate(deferred):
+        if _under_cap(Module, running, caps):
+            del deferred[index]
+            return Module, subject
+
+    # jobs pulled past capped sources are kept, up to MAX_DEFERRED of them
+    while len(deferred) < MAX_DEFERRED:
+        try:
+            Module, subject = next(jobs)
+        except StopIteration:
+            break
+        if _under_cap(Module, running, caps):
+            return Module, subject
+        deferred.append((Module, subject))
+
+    return None
+
+
+def _under_cap(Module, running, caps):
+    source = source_name(Module)
+    return source not in caps or running[source] < caps[source]
+
+
+def _attempt_in_process(module_name, Lochness, subject, dry):
+    '''attempt a sync in a worker process and return the warnings'''
+    Module = importlib.import_module(module_name)
+    lochness.attempt.warnings = []
+    lochness.attempt(Module.sync, Lochness, subject, dry=dry)
+    # the caches of a worker process are not seen by the main process
+    functools.end_run()
+    warnings = lochness.attempt.warnings
+    lochness.attempt.warnings = []
+    return warnings
+
+
+class DownloadQueue(object):
+    '''Bounded queue of downloads serviced by a pool of threads
+
+    submit() blocks while `workers` downloads are running and `backlog` more
+    are waiting, so the walk feeding the queue never runs far ahead of the
+    downloads. The first failed download stops the queue, and its exception
+    is raised by the next submit() or when the queue is closed. With a single
+    worker, downloads run inline in the calling thread.
+
+    Key arguments:
+        workers: number of concurrent downloads, int.
+        backlog: number of queued downloads, int. Defaults to workers.
+    '''
+    def __init__(self, workers=1, backlog=None):
+        self.workers = workers
+        self.pool = None
+        if workers > 1:
+            backlog = workers if backlog is None else backlog
+            self.slots = threading.BoundedSemaphore(workers + backlog)
+            self.pool = cf.ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.error = None
+
+    def submit(self, fn, *args, **kwargs):
+        '''queue fn(*args, **kwargs), blocking while the queue is full'''
+        if self.pool is None:
+            return fn(*args, **kwargs)
+        self._raise_error()
+        self.slots.acquire()
+        future = self.pool.submit(fn, *args, **kwargs)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        self.slots.release()
+        if future.cancelled() or future.exception() is None:
+            return
+        with self.lock:
+            if self.error is None:
+                self.error = future.exception()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self, cancel=False):
+        '''wait for the queued downloads, or cancel the ones not started'''
+        if self.pool is None:
+            return
+        self.pool.shutdown(wait=True, cancel_futures=cancel)
+        if not cancel:
+            self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(cancel=exc_type is not None)
+        return False
+
+
+class ExecutorError(Exception):
+    pass
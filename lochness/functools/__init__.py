@@ -1,4 +1,8 @@
 import pickle
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
 
 def lru_cache(fn):
     '''
@@ -20,3 +24,77 @@ def lru_cache(fn):
         setattr(memoized_fn, attr, value)
     memoized_fn.cache = {}
     return memoized_fn
+
+
+def run_cache(fn):
+    '''
+    Thread-safe memoization wrapper for values that should only be computed
+    once per sync run. Concurrent calls with the same arguments wait for the
+    first call instead of repeating it. Use clear_run_caches() to start a new
+    run.
+    :param fn: Function
+    :type fn: function
+    :returns: Memoized function
+    :rtype: function
+    '''
+    def memoized_fn(*args):
+        pargs = pickle.dumps(args)
+        if pargs in memoized_fn.cache:
+            return memoized_fn.cache[pargs]
+        with memoized_fn.lock:
+            key_lock = memoized_fn.locks.setdefault(pargs, threading.Lock())
+        with key_lock:
+            if pargs not in memoized_fn.cache:
+                memoized_fn.cache[pargs] = fn(*args)
+        return memoized_fn.cache[pargs]
+    for attr, value in iter(fn.__dict__.items()):
+        setattr(memoized_fn, attr, value)
+    memoized_fn.cache = {}
+    memoized_fn.locks = {}
+    memoized_fn.lock = threading.Lock()
+    run_cache.registry.append(memoized_fn)
+    return memoized_fn
+
+
+run_cache.registry = []
+
+
+def clear_run_caches():
+    '''
+    Clear every function memoized with run_cache, e.g., at the beginning of
+    a poll cycle.
+    '''
+    for memoized_fn in run_cache.registry:
+        with memoized_fn.lock:
+            memoized_fn.cache.clear()
+            memoized_fn.locks.clear()
+
+
+def run_end(fn):
+    '''
+    Register a function to call at the end of every sync run, e.g., to save
+    a cache once per run instead of once per subject. Use end_run() to call
+    them.
+    :param fn: Function without arguments
+    :type fn: function
+    :returns: fn
+    :rtype: function
+    '''
+    run_end.registry.append(fn)
+    return fn
+
+
+run_end.registry = []
+
+
+def end_run():
+    '''
+    Call every function registered with run_end, e.g., once every sync job
+    of a run is done.
+    '''
+    for fn in run_end.registry:
+        try:
+            fn()
+        except Exception as e:
+            logger.warning(f'{fn.__module__}.{fn.__name__} failed at the end '
+                           f'of the run: {e}')
@@ -0,0 +1,223 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RECONCILE_INTERVAL = 86400
+
+Indexes = dict()
+'''
+File indexes shared by every sync job in a process, keyed by database file.
+'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    local_path TEXT PRIMARY KEY,
+    remote_id TEXT,
+    size INTEGER,
+    content_hash TEXT,
+    mtime REAL,
+    synced_at REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+class FileIndex(object):
+    '''
+    SQLite index of the files a source has saved under PHOENIX. Files found
+    in the index are known to be saved without touching the file system,
+    which saves a stat call per remote file on every poll. Files missing from
+    the index are still looked up on disk, so files saved before the index
+    existed, or by a run that crashed before its index was written, are
+    picked up and indexed.
+
+    reconcile_if_due() reconciles the index with the disk every
+    `reconcile_interval` seconds, forgetting files that were removed from
+    PHOENIX so they are downloaded again.
+
+    :param path: SQLite database file
+    :type path: str
+    :param reconcile_interval: Seconds between reconciliations
+    :type reconcile_interval: float
+    '''
+    def __init__(self, path, reconcile_interval=DEFAULT_RECONCILE_INTERVAL):
+        self.path = path
+        self.reconcile_interval = reconcile_interval
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.paths = set(x for x, in self.db.execute(
+                'SELECT local_path FROM files'))
+        self.last_reconciled = self.reconciled_at()
+
+    def __contains__(self, local_path):
+        return local_path in self.paths
+
+    def exists(self, local_path, remote_id=None, size=None,
+               content_hash=None):
+        '''
+        True if a file is already saved. A file that is not indexed yet is
+        looked up on disk, and indexed if found.
+
+        :param local_path: Local path of the file
+        :type local_path: str
+        '''
+        if local_path in self.paths:
+            return True
+        if not os.path.exists(local_path):
+            return False
+        self.add(local_path, remote_id, size, content_hash)
+        return True
+
+    def add(self, local_path, remote_id=None, size=None, content_hash=None):
+        '''
+        Record a saved file.
+
+        :param local_path: Local path of the file
+        :type local_path: str
+        :param remote_id: Remote file id
+        :type remote_id: str
+        :param size: Remote file size in bytes
+        :type size: int
+        :param content_hash: Remote content hash of the file
+        :type content_hash: str
+        '''
+        mtime = os.path.getmtime(local_path)
+        with self.lock:
+            self.db.execute(
+                    'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                    (local_path, remote_id, size, content_hash, mtime,
+                     time.time()))
+            self.db.commit()
+            self.paths.add(local_path)
+
+    def get(self, local_path):
+        '''
+        Return the record of a file, or None.
+
+        :param local_path: Local path of the file
+        :type local_path: str
+        :returns: dict with the columns of the files table
+        '''
+        with self.lock:
+            cursor = self.db.execute(
+                    'SELECT * FROM files WHERE local_path = ?', (local_path,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([x[0] for x in cursor.description], row))
+
+    def reconciled_at(self):
+        '''time of the last reconciliation'''
+        with self.lock:
+            row = self.db.execute(
+                    "SELECT value FROM meta WHERE key = 'reconciled_at'"
+                    ).fetchone()
+        return float(row[0]) if row else 0.0
+
+    def reconcile_if_due(self):
+        '''reconcile the index if the last reconciliation is too old'''
+        if time.time() - self.last_reconciled > self.reconcile_interval:
+            self.reconcile()
+
+    def reconcile(self):
+        '''
+        Forget indexed files that are not on disk anymore. Each directory is
+        listed once, instead of looking up every file.
+
+        :returns: number of files forgotten
+        '''
+        with self.lock:
+            paths = list(self.paths)
+            self.last_reconciled = time.time()
+        directories = defaultdict(list)
+        for local_path in paths:
+            dirname, basename = os.path.split(local_path)
+            directories[dirname].append(basename)
+
+        missing = []
+        for dirname, basenames in directories.items():
+            try:
+                found = set(os.listdir(dirname))
+            except FileNotFoundError:
+                found = set()
+            missing.extend(os.path.join(dirname, x)
+                           for x in basenames if x not in found)
+
+        with self.lock:
+            self.db.executemany('DELETE FROM files WHERE local_path = ?',
+                                [(x,) for x in missing])
+            self.db.execute(
+                    'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                    ('reconciled_at', str(self.last_reconciled)))
+            self.db.commit()
+            self.paths.difference_update(missing)
+        logger.info(f'reconciled {self.path}: {len(paths)} files indexed, '
+                    f'{len(missing)} missing from disk')
+        return len(missing)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def reconcile_interval(Lochness):
+    ''' get the reconciliation interval in seconds with a safe default '''
+    value = Lochness.get('index_reconcile_interval',
+                         DEFAULT_RECONCILE_INTERVAL)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return DEFAULT_RECONCILE_INTERVAL
+    return value
+
+
+def get(Lochness, source, module_name):
+    '''
+    Return the file index of a module, or None if ``cache_dir`` is not set
+    in the configuration file. The index is opened once and kept for the
+    life of the process, and reconciled when it is due.
+
+    :param Lochness: Lochness context
+    :type Lochness: dict
+    :param source: Data source, e.g., 'box'
+    :type source: str
+    :param module_name: Module name, without the source
+    :type module_name: str
+    '''
+    directory = Lochness.get('cache_dir', None)
+    if not directory:
+        return None
+    path = os.path.join(os.path.expanduser(directory), source,
+                        f'{module_name}_files.sqlite')
+    with get.lock:
+        if path not in Indexes:
+            Indexes[path] = FileIndex(path, reconcile_interval(Lochness))
+        index = Indexes[path]
+    index.reconcile_if_due()
+    return index
+
+
+get.lock = threading.Lock()
+
+
+def exists(index, local_path, **kwargs):
+    '''
+    True if a file is already saved, using the file index if there is one.
+
+    :param index: FileIndex, or None
+    :param local_path: Local path of the file
+    :type local_path: str
+    '''
+    if index is None:
+        return os.path.exists(local_path)
+    return index.exists(local_path, **kwargs)
@@ -4,6 +4,7 @@ import json
 import cryptease as crypt
 import yaml
 import getpass as gp
+import lochness.functools as functools
 
 
 def load_encrypted_keyring(enc_keyring_loc: str) -> dict:
@@ -27,6 +28,20 @@ def passphrase(Lochness, study):
     return Lochness['keyring']['lochness']['SECRETS'][study]
 
 
+def encryption_key(Lochness, study):
+    '''get encryption key derived from the passphrase for study
+
+    The key derivation is slow on purpose, so the key is derived once per run
+    and shared by every subject of the study.
+    '''
+    return _kdf(passphrase(Lochness, study))
+
+
+@functools.run_cache
+def _kdf(passphrase):
+    return crypt.kdf(passphrase)
+
+
 def dropbox_api_token(Lochness, key):
     '''get dropbox api token from keyring'''
     if key not in Lochness['keyring']:
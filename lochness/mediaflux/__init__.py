@@ -12,7 +12,6 @@ import hashlib
 from io import BytesIO
 import lochness.keyring as keyring
 from os.path import join as pjoin, basename, dirname, isfile
-import cryptease as enc
 import re
 from subprocess import Popen
 import tempfile
@@ -52,8 +51,7 @@ def sync_module(Lochness: 'lochness.config',
 
     for mf_subid in subject.mediaflux[study_name]:
         logger.debug(f'exploring {subject.study}/{subject.id}')
-        _passphrase = keyring.passphrase(Lochness, subject.study)
-        enc_key = enc.kdf(_passphrase)
+        enc_key = keyring.encryption_key(Lochness, subject.study)
 
         mflux_cfg= keyring.mediaflux_api_token(Lochness, study_name)
         
@@ -3,6 +3,7 @@ import logging
 import lochness
 import os
 import lochness.net as net
+import lochness.ratelimit as ratelimit
 import sys
 import json
 import lochness.tree as tree
@@ -138,6 +139,7 @@ def get_study_lamp(lamp: LAMP) -> Tuple[str, str]:
     Returns:
         (study_id, study_name): study id and study objects, Tuple.
     '''
+    ratelimit.acquire('mindlamp')
     study_objs = lamp.Study.all_by_researcher('me')['data']
     assert len(study_objs) == 1, "There are more than one MindLamp study"
     study_obj = study_objs[0]
@@ -154,6 +156,7 @@ def get_participants_lamp(lamp: LAMP, study_id: str) -> List[str]:
     Returns:
         subject_ids: participant ids, list of str.
     '''
+    ratelimit.acquire('mindlamp')
     subject_objs = lamp.Participant.all_by_study(study_id)['data']
     subject_ids = [x['id'] for x in subject_objs]
 
@@ -170,6 +173,7 @@ def get_activities_lamp(lamp: LAMP, subject_id: str) -> List[dict]:
     Returns:
         activity_dicts: activity records, list of dict.
     '''
+    ratelimit.acquire('mindlamp')
     activity_dicts = lamp.Activity.all_by_participant(subject_id)['data']
 
     return activity_dicts
@@ -185,6 +189,7 @@ def get_sensors_lamp(lamp: LAMP, subject_id: str) -> List[dict]:
     Returns:
         sensor_dicts: activity records, list of dict.
     '''
+    ratelimit.acquire('mindlamp')
     sensor_dicts = lamp.Sensor.all_by_participant(subject_id)['data']
 
     return sensor_dicts
@@ -200,6 +205,7 @@ def get_activity_events_lamp(lamp: LAMP, subject_id: str) -> List[dict]:
     Returns:
         activity_events_dicts: activity records, list of dict.
     '''
+    ratelimit.acquire('mindlamp')
     activity_events_dicts = lamp.ActivityEvent.all_by_participant(subject_id)['data']
 
     return activity_events_dicts
@@ -215,6 +221,7 @@ def get_sensor_events_lamp(lamp: LAMP, subject_id: str) -> List[dict]:
     Returns:
         activity_dicts: activity records, list of dict.
     '''
+    ratelimit.acquire('mindlamp')
     sensor_event_dicts = lamp.SensorEvent.all_by_participant(subject_id)['data']
 
     return sensor_event_dicts
@@ -0,0 +1,94 @@
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# backreferences are numbered by position, so they break when a pattern is
+# moved into a combined regex
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+
+class ProductMatcher(object):
+    '''
+    Match file paths against the file patterns of a list of products.
+
+    The patterns are substituted and compiled once, into a single regex with
+    one alternative per product. re.match tries the alternatives in order, so
+    the first product whose pattern matches is returned, as when each pattern
+    is matched in turn. Patterns that can not be combined are matched one by
+    one instead.
+
+    :param products: Product dicts, each with a string.Template 'pattern'
+    :type products: list
+    :param glob: Replace every '*' of the patterns with '.*'
+    :type glob: bool
+    :param strict: Raise KeyError when a pattern uses an unknown variable
+    :type strict: bool
+    :param kwargs: Variables substituted into the patterns, e.g., subject
+    '''
+    def __init__(self, products, glob=False, strict=False, **kwargs):
+        self.products = list(products)
+        patterns = []
+        for product in self.products:
+            template = product['pattern']
+            pattern = template.substitute(**kwargs) if strict \
+                    else template.safe_substitute(**kwargs)
+            if glob:
+                pattern = pattern.replace('*', '.*')
+            patterns.append(pattern)
+        self.patterns = [re.compile(x) for x in patterns]
+        self.regex = _combine(patterns)
+
+        # outer group number of each alternative -> product index
+        self.groups = dict()
+        group = 1
+        for index, pattern in enumerate(self.patterns):
+            self.groups[group] = index
+            group += 1 + pattern.groups
+
+    def match(self, s):
+        '''
+        Return the first product whose pattern matches the start of s.
+
+        :param s: File path relative to the walked folder
+        :type s: str
+        :returns: product dict, or None
+        '''
+        if self.regex is not None:
+            m = self.regex.match(s)
+            if m is None:
+                return None
+            return self.products[self.groups[m.lastindex]]
+        for pattern, product in zip(self.patterns, self.products):
+            if pattern.match(s):
+                return product
+        return None
+
+    def __call__(self, s):
+        return self.match(s)
+
+
+def _combine(patterns):
+    '''
+    Compile patterns into a single alternation, or return None if they can
+    not be combined.
+    '''
+    if not patterns or any(BACKREFERENCE.search(x) for x in patterns):
+        return None
+    try:
+        regex = re.compile('|'.join(f'({x})' for x in patterns))
+    except re.error as e:
+        logger.debug(f'matching patterns one by one: {e}')
+        return None
+    return regex
+
+
+def compile(products, glob=False, strict=False, **kwargs):
+    '''
+    Compile the file patterns of products, see ProductMatcher.
+
+    :param products: Product dicts, each with a string.Template 'pattern'
+    :type products: list
+    :returns: ProductMatcher
+    '''
+    return ProductMatcher(products, glob=glob, strict=strict, **kwargs)
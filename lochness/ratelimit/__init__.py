@@ -0,0 +1,97 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+Buckets = dict()
+'''
+Token buckets shared by every sync module, keyed by source name.
+'''
+
+
+class TokenBucket(object):
+    '''
+    Thread-safe token bucket. Tokens refill at `rate` per second up to
+    `capacity`, and acquire() blocks until enough tokens are available.
+
+    :param rate: Tokens added per second
+    :type rate: float
+    :param capacity: Maximum number of tokens (burst size), defaults to rate
+    :type capacity: float
+    '''
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise RateLimitError(f'rate must be positive, got {rate}')
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(self.rate, 1.0)
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        '''block until `tokens` are available and take them'''
+        if tokens > self.capacity:
+            raise RateLimitError(f'cannot acquire {tokens} tokens from a '
+                                 f'bucket of capacity {self.capacity}')
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                elapsed = now - self.timestamp
+                self.tokens = min(self.capacity,
+                                  self.tokens + elapsed * self.rate)
+                self.timestamp = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                seconds = (tokens - self.tokens) / self.rate
+            time.sleep(seconds)
+
+
+def configure(Lochness):
+    '''
+    Create a token bucket for every source in the ``rate_limits`` section
+    of the configuration file. A source may be given a number of requests
+    per second, or a dict with ``rate`` and an optional ``burst`` ::
+
+        rate_limits:
+          box: 10
+          redcap:
+            rate: 5
+            burst: 20
+
+    :param Lochness: Lochness context
+    :type Lochness: dict
+    '''
+    buckets = dict()
+    for source, value in iter(Lochness.get('rate_limits', dict()).items()):
+        if isinstance(value, dict):
+            rate, burst = value.get('rate'), value.get('burst')
+        else:
+            rate, burst = value, None
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)):
+            raise RateLimitError(f'bad rate limit for {source}: {value}')
+        logger.debug(f'rate limiting {source} to {rate} requests per second')
+        buckets[source] = TokenBucket(rate, burst)
+    Buckets.clear()
+    Buckets.update(buckets)
+
+
+def acquire(source, tokens=1):
+    '''
+    Wait for a token from the bucket of a source. Sources without a rate
+    limit return immediately.
+
+    :param source: Source name e.g., box, dropbox, redcap
+    :type source: str
+    :param tokens: Number of tokens (requests)
+    :type tokens: int
+    '''
+    bucket = Buckets.get(source)
+    if bucket is None:
+        return
+    bucket.acquire(tokens)
+
+
+class RateLimitError(Exception):
+    pass
@@ -6,6 +6,8 @@ import lochness
 import logging
 import requests
 import lochness.net as net
+import lochness.ratelimit as ratelimit
+import lochness.functools as functools
 import collections as col
 import lochness.tree as tree
 from pathlib import Path
@@ -14,6 +16,7 @@ import datetime
 from typing import List
 import tempfile as tf
 from lochness.redcap.process_piis import process_and_copy_db
+from lochness.redcap import data_trigger_capture
 
 
 logger = logging.getLogger(__name__)
@@ -48,6 +51,15 @@ def get_field_names_from_redcap(api_url: str,
     return field_names
 
 
+# metadata column of each source id field
+SOURCE_NAMES = {
+    'beiwe': 'Beiwe', 'xnat': 'XNAT', 'dropbox': 'Drpbox',
+    'box': 'Box', 'mediaflux': 'Mediaflux',
+    'mindlamp': 'Mindlamp', 'daris': 'Daris', 'rpms': 'RPMS'}
+
+DEFAULT_CONSENT = '1988-09-16'
+
+
 def initialize_metadata(Lochness: 'Lochness object',
                         study_name: str,
                         redcap_id_colname: str,
@@ -67,11 +79,6 @@ def initialize_metadata(Lochness: 'Lochness object',
     api_url = study_redcap['URL'] + '/api/'
     api_key = study_redcap['API_TOKEN'][study_name]
 
-    source_source_name_dict = {
-        'beiwe': 'Beiwe', 'xnat': 'XNAT', 'dropbox': 'Drpbox',
-        'box': 'Box', 'mediaflux': 'Mediaflux',
-        'mindlamp': 'Mindlamp', 'daris': 'Daris', 'rpms': 'RPMS'}
-
     record_query = {
         'token': api_key,
         'content': 'record',
@@ -81,7 +88,7 @@ def initialize_metadata(Lochness: 'Lochness object',
 
     # only pull source_names
     field_num = 2
-    for source, source_name in source_source_name_dict.items():
+    for source, source_name in SOURCE_NAMES.items():
         record_query[f"fields[{field_num}]"] = f"source_id"
 
     # pull all records from REDCap for the study
@@ -105,82 +112,120 @@ def initialize_metadata(Lochness: 'Lochness object',
         with open(tmpfilename.name, 'r') as f:
             data = json.load(f)
 
-    df = pd.DataFrame()
-    # for each record in pulled information, extract subject ID and source IDs
-    for item in data:
-        if multistudy:
-            site_two_letters_redcap_id = item[redcap_id_colname][:2]
-            site_two_letters_study = study_name.split('_')[1]
+    if len(data) == 0:
+        return
 
-            if site_two_letters_redcap_id != site_two_letters_study:
-                continue
+    # extract subject ID and source IDs of every record at once
+    df = metadata_records(pd.DataFrame(data, dtype=object), study_name,
+                          redcap_id_colname, redcap_consent_colname,
+                          multistudy)
 
-        subject_dict = {'Subject ID': item[redcap_id_colname]}
+    # Redcap default information
+    df.insert(2, 'REDCap',
+              f'redcap.{study_name}:' + df['Subject ID'].astype(str))
 
-        # Consent date
-        try:
-            subject_dict['Consent'] = item[redcap_consent_colname]
-        except:
-            subject_dict['Consent'] = '1988-09-16'
+    if len(df) == 0:
+        return
 
-        # Redcap default information
-        subject_dict['REDCap'] = f'redcap.{study_name}:{item[redcap_id_colname]}'
+    df_final = merge_metadata_records(df)
 
-        for source, source_name in source_source_name_dict.items():
-            try:
-                subject_dict[source_name] = item[f'{source}_id']
-            except:
-                pass
+    general_path = Path(Lochness['phoenix_root']) / 'GENERAL'
+    metadata_study = general_path / study_name / f"{study_name}_metadata.csv"
+    df_final.to_csv(metadata_study, index=False)
 
-        df_tmp = pd.DataFrame.from_dict(subject_dict, orient='index')
-        df = pd.concat([df, df_tmp.T])
 
+def metadata_records(records: pd.DataFrame,
+                     study_name: str,
+                     id_colname: str,
+                     consent_colname: str,
+                     multistudy: bool = True) -> pd.DataFrame:
+    '''Extract the subject ID, consent date and source IDs of records
 
-    if len(df) == 0:
-        return
+    Key arguments:
+        records: REDCap or RPMS records, one row per record, pd.DataFrame.
+        study_name: Name of the study, str.
+        id_colname: Name of the ID field, str.
+        consent_colname: Name of the consent date field, str.
+        multistudy: True if the records contain more than one study's data,
+                    in which case only the records whose ID starts with the
+                    two site letters of the study are kept.
+
+    Returns:
+        pd.DataFrame with 'Subject ID', 'Consent' if the records have a
+        consent date field, and a column for each source found in the
+        records.
+    '''
+    if multistudy:
+        site_two_letters_study = study_name.split('_')[1]
+        records = records[
+                records[id_colname].astype(str).str[:2] ==
+                site_two_letters_study]
+
+    df = pd.DataFrame({'Subject ID': records[id_colname]}, dtype=object)
+
+    # Consent date, missing dates are filled in once the records of each
+    # subject are merged
+    if consent_colname in records:
+        df['Consent'] = records[consent_colname]
+
+    # sources without any id in the records are left out
+    for source, source_name in SOURCE_NAMES.items():
+        if f'{source}_id' in records and \
+                records[f'{source}_id'].notna().any():
+            df[source_name] = records[f'{source}_id']
 
-    # Each subject may have more than one arms, which will result in more than
-    # single item for the subject in the redcap pulled `content`
-    # remove empty lables
-    df_final = pd.DataFrame()
-    for _, table in df.groupby(['Subject ID']):
-        pad_filled = table.fillna(
-                method='ffill').fillna(method='bfill').iloc[0]
-        df_final = pd.concat([df_final, pad_filled], axis=1)
-    df_final = df_final.T
+    return df
+
+
+def merge_metadata_records(df: pd.DataFrame) -> pd.DataFrame:
+    '''Merge the records of each subject into a single metadata row
+
+    Each subject may have more than one arms, which will result in more than
+    single record for the subject. The first non-empty value of each column
+    is kept for the subject, and subjects without any consent date get
+    DEFAULT_CONSENT.
+
+    Key arguments:
+        df: records, as returned by metadata_records, pd.DataFrame.
+
+    Returns:
+        pd.DataFrame with a row for each subject, sorted by 'Subject ID'.
+    '''
+    df_final = df.groupby('Subject ID').first().reset_index()
+    if 'Consent' in df_final:
+        df_final['Consent'] = df_final['Consent'].fillna(DEFAULT_CONSENT)
+    else:
+        df_final['Consent'] = DEFAULT_CONSENT
 
     # register all of the lables as active
     df_final['Active'] = 1
 
     # reorder columns
     main_cols = ['Active', 'Consent', 'Subject ID']
-    df_final = df_final[main_cols + \
-            [x for x in df_final.columns if x not in main_cols]]
-
-    general_path = Path(Lochness['phoenix_root']) / 'GENERAL'
-    metadata_study = general_path / study_name / f"{study_name}_metadata.csv"
-    df_final.to_csv(metadata_study, index=False)
-
+    return df_final[main_cols +
+                    [x for x in df.columns if x not in main_cols]]
 
 
 def check_if_modified(subject_id: str,
                       existing_json: str,
-                      df: pd.DataFrame) -> bool:
+                      det_index: dict) -> bool:
     '''check if subject data has been modified in the data entry trigger db
 
     Comparing unix times of the json modification and lastest redcap update
-    '''
-
-    json_modified_time = Path(existing_json).stat().st_mtime  # in unix time
 
-    subject_df = df[df.record == subject_id]
+    Key arguments:
+        subject_id: REDCap record id of the subject, str.
+        existing_json: path of the json previously pulled for the subject.
+        det_index: lastest update time of each record, returned by
+                   get_data_entry_trigger_index, dict.
+    '''
+    lastest_update_time = det_index.get(str(subject_id))
 
     # if the subject does not exist in the DET_DB, return False
-    if len(subject_df) < 1:
+    if lastest_update_time is None:
         return False
 
-    lastest_update_time = subject_df.loc[
-            subject_df['timestamp'].idxmax()].timestamp
+    json_modified_time = Path(existing_json).stat().st_mtime  # in unix time
 
     if lastest_update_time > json_modified_time:
         return True
@@ -193,30 +238,57 @@ def get_data_entry_trigger_df(Lochness: 'Lochness') -> pd.DataFrame:
     if 'redcap' in Lochness:
         if 'data_entry_trigger_csv' in Lochness['redcap']:
             db_loc = Lochness['redcap']['data_entry_trigger_csv']
-            if Path(db_loc).is_file():
-                db_df = pd.read_csv(db_loc)
-                try:
-                    db_df['record'] = db_df['record'].astype(str)
-                except KeyError:
-                    db_df = pd.DataFrame({'record':[]})
-                return db_df
+            return read_data_entry_trigger_csv(db_loc)
 
     db_df = pd.DataFrame({'record':[]})
     # db_df = pd.DataFrame()
     return db_df
 
 
+def read_data_entry_trigger_csv(db_loc: str) -> pd.DataFrame:
+    '''Read Data Entry Trigger database csv as dataframe'''
+    if Path(db_loc).is_file():
+        db_df = pd.read_csv(db_loc)
+        try:
+            db_df['record'] = db_df['record'].astype(str)
+        except KeyError:
+            db_df = pd.DataFrame({'record':[]})
+        return db_df
+
+    return pd.DataFrame({'record':[]})
+
+
+def get_data_entry_trigger_index(Lochness: 'Lochness') -> dict:
+    '''Return the lastest Data Entry Trigger timestamp of each record
+
+    The database is read once per run, and the returned dict makes the
+    check for each subject a single lookup.
+    '''
+    db_loc = Lochness.get('redcap', dict()).get('data_entry_trigger_csv')
+    if db_loc is None:
+        return dict()
+    return _data_entry_trigger_index(db_loc)
+
+
+@functools.run_cache
+def _data_entry_trigger_index(db_loc: str) -> dict:
+    return data_trigger_capture.latest_timestamps(db_loc)
+
+
 @net.retry(max_attempts=5)
 def sync(Lochness, subject, dry=False):
 
-    # load dataframe for redcap data entry trigger
-    db_df = get_data_entry_trigger_df(Lochness)
+    # load lastest update time of each record in data entry trigger db
+    det_index = get_data_entry_trigger_index(Lochness)
 
     logger.debug(f'exploring {subject.study}/{subject.id}')
     deidentify = deidentify_flag(Lochness, subject.study)
 
     logger.debug(f'deidentify for study {subject.study} is {deidentify}')
 
+    bulk_export = bulk_export_flag(Lochness, subject.study)
+    logger.debug(f'bulk_export for study {subject.study} is {bulk_export}')
+
     for redcap_instance, redcap_subject in iterate(subject):
         for redcap_project, api_url, api_key in redcap_projects(
                 Lochness, subject.study, redcap_instance):
@@ -242,7 +314,7 @@ def sync(Lochness, subject, dry=False):
             # check if the data has been updated by checking the redcap data
             # entry trigger db
             if dst.is_file():
-                if check_if_modified(redcap_subject, dst, db_df):
+                if check_if_modified(redcap_subject, dst, det_index):
                     pass  # if modified, carry on
                 else:
                     print("\n----")
@@ -255,35 +327,29 @@ def sync(Lochness, subject, dry=False):
             print("----\n")
             _debug_tup = (redcap_instance, redcap_project, redcap_subject)
 
-            record_query = {
-                'token': api_key,
-                'content': 'record',
-                'format': 'json',
-                'records': redcap_subject
-            }
-
-            if deidentify:
-                # get fields that aren't identifiable and narrow record query
-                # by field name
-                metadata_query = {
+            if bulk_export:
+                # split the subject out of a single export of the project
+                records = export_project_records(api_url, api_key, deidentify)
+                content = subject_content(records, redcap_subject)
+            else:
+                record_query = {
                     'token': api_key,
-                    'content': 'metadata',
-                    'format': 'json'
+                    'content': 'record',
+                    'format': 'json',
+                    'records': redcap_subject
                 }
 
-                content = post_to_redcap(api_url, metadata_query, _debug_tup)
-                metadata = json.loads(content)
-                field_names = []
-                for field in metadata:
-                    if field['identifier'] != 'y':
-                        field_names.append(field['field_name'])
-                record_query['fields'] = ','.join(field_names)
+                if deidentify:
+                    # narrow record query to the fields that aren't
+                    # identifiable
+                    field_names = deidentified_field_names(api_url, api_key)
+                    record_query['fields'] = ','.join(field_names)
 
-            # post query to redcap
-            content = post_to_redcap(api_url, record_query, _debug_tup)
+                # post query to redcap
+                content = post_to_redcap(api_url, record_query, _debug_tup)
 
             # check if response body is nothing but a sad empty array
-            if content.strip() == '[]':
+            if content.strip() == b'[]':
                 logger.info(f'no redcap data for {redcap_subject}')
                 continue
 
@@ -319,6 +385,78 @@ class REDCapError(Exception):
     pass
 
 
+@functools.run_cache
+def get_project_metadata(api_url: str, api_key: str) -> List[dict]:
+    '''Return the data dictionary of a REDCap project, once per run'''
+    metadata_query = {
+        'token': api_key,
+        'content': 'metadata',
+        'format': 'json'
+    }
+    content = post_to_redcap(api_url, metadata_query, (api_url, 'metadata'))
+    return json.loads(content)
+
+
+def deidentified_field_names(api_url: str, api_key: str) -> List[str]:
+    '''Return names of the fields that are not flagged as identifiers'''
+    metadata = get_project_metadata(api_url, api_key)
+    return [field['field_name'] for field in metadata
+            if field['identifier'] != 'y']
+
+
+@functools.run_cache
+def export_project_records(api_url: str,
+                           api_key: str,
+                           deidentify: bool) -> dict:
+    '''Export all records of a REDCap project with a single request
+
+    The export is made once per run and shared by every subject of the
+    project.
+
+    Key arguments:
+        api_url: REDCap API url, str.
+        api_key: REDCap API token of the project, str.
+        deidentify: only export fields that aren't identifiable, bool.
+
+    Returns:
+        records: rows of the export grouped by record id, dict.
+                 key: record id, str.
+                 value: list of rows (one per event or repeat instance).
+    '''
+    # the first field in the data dictionary is the record id field
+    metadata = get_project_metadata(api_url, api_key)
+    record_id_field = metadata[0]['field_name']
+
+    record_query = {
+        'token': api_key,
+        'content': 'record',
+        'format': 'json'
+    }
+
+    if deidentify:
+        field_names = deidentified_field_names(api_url, api_key)
+        if record_id_field not in field_names:
+            field_names.insert(0, record_id_field)
+        record_query['fields'] = ','.join(field_names)
+
+    logger.debug(f'exporting all records from {api_url}')
+    content = post_to_redcap(api_url, record_query, (api_url, 'bulk export'))
+
+    records = col.defaultdict(list)
+    for row in json.loads(content):
+        records[str(row[record_id_field])].append(row)
+
+    return dict(records)
+
+
+def subject_content(records: dict, redcap_subject: str) -> bytes:
+    '''Return the records of a subject as REDCap styled json content'''
+    rows = records.get(str(redcap_subject), [])
+    return json.dumps(rows,
+                      ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
 def redcap_projects(Lochness, phoenix_study, redcap_instance):
     '''get redcap api_url and api_key for a phoenix study'''
     Keyring = Lochness['keyring']
@@ -356,6 +494,7 @@ def redcap_projects(Lochness, phoenix_study, redcap_instance):
 
 
 def post_to_redcap(api_url, data, debug_tup):
+    ratelimit.acquire('redcap')
     r = requests.post(api_url, data=data, stream=True, verify=False)
     if r.status_code != requests.codes.OK:
         raise REDCapError(f'redcap url {r.url} responded {r.status_code}')
@@ -393,6 +532,18 @@ def deidentify_flag(Lochness, study):
     return value
 
 
+def bulk_export_flag(Lochness, study):
+    ''' get study specific bulk_export flag with a safe default '''
+    value = Lochness.get('redcap', dict()) \
+                    .get(study, dict()) \
+                    .get('bulk_export', False)
+
+    # if this is anything but a boolean, just return False
+    if not isinstance(value, bool):
+        return False
+    return value
+
+
 def iterate(subject):
     '''generator for redcap instance and subject'''
     for instance, ids in iter(subject.redcap.items()):
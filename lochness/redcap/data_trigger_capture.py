@@ -7,14 +7,23 @@ Usage::
     ./server.py [<port>]
 """
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import logging
 from pathlib import Path
 import pandas as pd
 import re
+import os
+import io
+import csv
 import time
-import hashlib
+import fcntl
 import shutil
+import threading
+from contextlib import contextmanager
+
+
+COLUMNS = ['timestamp', 'project_url', 'project_id',
+           'redcap_username', 'record', 'instrument']
 
 
 class S(BaseHTTPRequestHandler):
@@ -37,10 +46,17 @@ class S(BaseHTTPRequestHandler):
         # <--- Gets the data itself
         post_data = self.rfile.read(content_length)
 
+        back_up = False
         if 'redcap' in post_data.decode('utf-8'):
             save_post_from_redcap(post_data.decode('utf-8'),
                                   self.db_location)
-            self.n_post += 1
+
+            # the post count is shared by all request handler threads
+            with self.lock:
+                type(self).n_post += 1
+                if type(self).n_post >= self.back_up_after_n_post:
+                    type(self).n_post = 0
+                    back_up = True
 
         logging.info("POST request,\nPath: %s\nHeaders:\n%s\n\nBody:\n%s\n",
                 str(self.path), str(self.headers), post_data.decode('utf-8'))
@@ -48,21 +64,33 @@ class S(BaseHTTPRequestHandler):
         self._set_response()
         # self.wfile.write(f"POST request for {self.path.encode('utf-8')}")
 
-        if self.n_post == self.back_up_after_n_post:
+        if back_up:
             back_up_db(self.db_location)
-            self.n_post = 0
+            if self.max_db_bytes:
+                rotate_db(self.db_location, self.max_db_bytes)
 
 
 def run(db_location: str = 'db.csv',
-        server_class=HTTPServer,
-        handler_class=S, port=8080):
+        server_class=ThreadingHTTPServer,
+        handler_class=S, port=8080,
+        back_up_after_n_post: int = 50,
+        max_db_bytes: int = None):
+    '''Listen to REDCap Data Entry Trigger POST signals
+
+    Each POST is handled in its own thread and appended to the db_location.
+    The db is backed up after every back_up_after_n_post POSTs, and compacted
+    when it grows larger than max_db_bytes.
+    '''
 
     # register db_location
     class redcap_handler(handler_class):
+        n_post = 0
+        lock = threading.Lock()
+
         def __init__(self, *args, **kwargs):
             self.db_location = db_location
-            self.n_post = 0
-            self.back_up_after_n_post = 50
+            self.back_up_after_n_post = back_up_after_n_post
+            self.max_db_bytes = max_db_bytes
             handler_class.__init__(self, *args, **kwargs)
 
     logging.basicConfig(
@@ -89,22 +117,15 @@ def save_post_from_redcap(body: str, db_location: str):
     Requirements:
       - "Data Entry Trigger" from REDCap configuration
 
+    The record is appended to the end of the db_location csv, so existing
+    records are never read or rewritten.
     '''
 
     body = re.sub("%3A", ":", body)
     body = re.sub("%2F", "/", body)
     body = re.sub("%3F", "?", body)
     body = re.sub("%3D", "=", body)
-    
-    columns = ['timestamp', 'project_url', 'project_id',
-               'redcap_username', 'record', 'instrument']
-    if Path(db_location).is_file():
-        db_df = pd.read_csv(db_location, index_col=0)
-
-    else:
-        db_df = pd.DataFrame(columns=columns)
 
-    redcap_url = get_info_from_post_body('redcap_url', body)
     project_url = get_info_from_post_body('project_url', body)
     project_id = get_info_from_post_body('project_id', body)
     redcap_username = get_info_from_post_body('username', body)
@@ -112,56 +133,146 @@ def save_post_from_redcap(body: str, db_location: str):
     instrument = get_info_from_post_body('instrument', body)
 
     # here the time stamp is created in the server (unix time)
-    df_tmp = pd.DataFrame({
-        'timestamp': [time.time()],
-        'redcap_url': redcap_url,
+    append_to_db(db_location, {
+        'timestamp': time.time(),
         'project_url': project_url,
         'project_id': project_id,
         'redcap_username': redcap_username,
         'record': record,
         'instrument': instrument})
 
-    db_df = db_df.append(df_tmp)
-    db_df[columns].to_csv(db_location)
 
+def append_to_db(db_location: str, row: dict) -> None:
+    '''Append a single record to the data entry trigger db csv
 
-def get_info_from_post_body(var_name, body):
-    pattern_catcher = '([A-Za-z%0-9:\./?\=_]+)'
-    return re.search(f'{var_name}={pattern_catcher}', body).group(1)
+    The line is written with a single write call while holding an exclusive
+    lock on the file, so concurrent POSTs from threads or processes never
+    interleave or drop records.
+    '''
+    line = io.StringIO()
+    csv.writer(line).writerow([0] + [row[x] for x in COLUMNS])
+
+    with _locked_db(db_location, 'a', fcntl.LOCK_EX) as f:
+        # write the header to a new db, in the same layout as the csv written
+        # by pandas
+        if os.fstat(f.fileno()).st_size == 0:
+            header = io.StringIO()
+            csv.writer(header).writerow([''] + COLUMNS)
+            f.write(header.getvalue())
+        f.write(line.getvalue())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+@contextmanager
+def _locked_db(db_location: str, mode: str, operation: int):
+    '''open the db and hold a flock on it
+
+    The db may have been replaced by rotate_db while waiting for the lock, in
+    which case the new file is opened instead.
+    '''
+    newline = None if 'b' in mode else ''
+    while True:
+        f = open(db_location, mode, newline=newline)
+        fcntl.flock(f, operation)
+        try:
+            if os.fstat(f.fileno()).st_ino == os.stat(db_location).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+    try:
+        yield f
+    finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+
+def latest_timestamps(db_location: str) -> dict:
+    '''Return the lastest data entry trigger timestamp of each record
 
+    Key arguments:
+        db_location: data entry trigger db csv, str.
 
-def get_sha(file_loc: str) -> str:
-    '''return sha1 hexdigest of a file'''
-    BUF_SIZE = 65536
-    sha1 = hashlib.sha1()
+    Returns:
+        {record: lastest unix timestamp}, dict.
+    '''
+    if not Path(db_location).is_file():
+        return dict()
+
+    with _locked_db(db_location, 'r', fcntl.LOCK_SH) as f:
+        try:
+            db_df = pd.read_csv(f, usecols=['record', 'timestamp'],
+                                dtype={'record': str})
+        except (ValueError, pd.errors.EmptyDataError):
+            return dict()
 
-    with open(file_loc, 'rb') as f:
-        data = f.read(BUF_SIZE)
-        sha1.update(data)
+    return db_df.groupby('record')['timestamp'].max().to_dict()
 
-    return sha1.hexdigest()
+
+def get_info_from_post_body(var_name, body):
+    pattern_catcher = r'([A-Za-z%0-9:\./?\=_]+)'
+    return re.search(f'{var_name}={pattern_catcher}', body).group(1)
 
 
 def back_up_db(db_location) -> None:
-    ''''Back up the db file'''
+    ''''Back up the db file
+
+    As the db is only ever appended to, the back up is brought up to date by
+    copying the bytes added since the last back up. The whole db is copied
+    if the back up is missing or the db has been rotated.
+    '''
 
     db_dir = Path(db_location).parent
     db_backup_file = db_dir / f".back_{Path(db_location).name}"
 
-    if db_backup_file.is_file():
-        with open(db_location, 'rb') as f:
-            db_file_sha1 = get_sha(db_location)
+    with _locked_db(db_location, 'rb', fcntl.LOCK_SH) as f:
+        db_size = os.fstat(f.fileno()).st_size
+        backup_size = db_backup_file.stat().st_size \
+                if db_backup_file.is_file() else 0
+
+        if backup_size == db_size:
+            logging.debug('No back up')
+        elif 0 < backup_size < db_size:
+            logging.debug('backing up new records')
+            f.seek(backup_size)
+            with open(db_backup_file, 'ab') as backup:
+                shutil.copyfileobj(f, backup)
+        else:
+            logging.debug('backing up')
+            with open(db_backup_file, 'wb') as backup:
+                shutil.copyfileobj(f, backup)
 
-        with open(db_backup_file, 'rb') as f:
-            back_up_file_sha1 = get_sha(db_backup_file)
+    return True
 
-        if db_file_sha1 == back_up_file_sha1:
-            print('No back up')
-            pass
-        else:
-            print('backing up')
-            shutil.copy(db_location, db_backup_file)
-    else:
+
+def rotate_db(db_location: str, max_bytes: int) -> bool:
+    '''Compact the db once it grows larger than max_bytes
+
+    The full db is moved aside with a timestamp suffix, and replaced by a db
+    holding only the lastest record for each REDCap record id, which is all
+    lochness needs to decide what to pull.
+    '''
+    if not Path(db_location).is_file() or \
+            os.path.getsize(db_location) <= max_bytes:
+        return False
+
+    db_path = Path(db_location)
+    with _locked_db(db_location, 'r', fcntl.LOCK_EX) as f:
+        db_df = pd.read_csv(f, index_col=0, dtype={'record': str})
+        db_df = db_df.sort_values('timestamp').groupby('record').tail(1)
+
+        rotated = db_path.parent / \
+                f'.{db_path.stem}_{int(time.time())}{db_path.suffix}'
+        tmp_location = db_path.parent / f'.tmp_{db_path.name}'
+        db_df[COLUMNS].to_csv(tmp_location)
+        os.link(db_location, rotated)
+        os.rename(tmp_location, db_location)
+
+        # restart the back up from the compacted db
+        db_backup_file = db_path.parent / f".back_{db_path.name}"
         shutil.copy(db_location, db_backup_file)
 
+    logging.info(f'rotated {db_location} to {rotated}')
     return True
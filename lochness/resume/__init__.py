@@ -0,0 +1,314 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+import concurrent.futures as cf
+import requests
+import urllib3
+import lochness
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+MIN_SIZE = 64 * 1024 * 1024
+MAX_ATTEMPTS = 5
+
+# errors after which the download is resumed from the last saved byte
+RESUMABLE_ERRORS = (OSError,
+                    requests.exceptions.RequestException,
+                    urllib3.exceptions.HTTPError)
+
+
+def resumable(size, key=None):
+    '''
+    True if a download should be saved to a resumable part file. Encrypted
+    files are never resumed, so their plain content never rests on disk.
+
+    :param size: File size in bytes, or None if unknown
+    :type size: int
+    :param key: Encryption key
+    '''
+    return key is None and size is not None and size >= MIN_SIZE
+
+
+class Part(object):
+    '''
+    Partial download of a remote file. The downloaded bytes are appended to a
+    hidden ``.part`` file next to the local file, and a ``.part.json``
+    manifest records which remote file they belong to, so the download can be
+    resumed with a Range request after a failure or a restart. Downloads in
+    blocks append the digest of each finished block to ``.part.blocks``.
+
+    :param local_fullfile: Final local path of the file
+    :type local_fullfile: str
+    :param remote_id: Remote file id or path
+    :type remote_id: str
+    :param content_hash: Remote content hash of the file
+    :type content_hash: str
+    :param size: Remote file size in bytes
+    :type size: int
+    '''
+    def __init__(self, local_fullfile, remote_id, content_hash, size):
+        dirname, basename = os.path.split(local_fullfile)
+        self.path = os.path.join(dirname, f'.{basename}.part')
+        self.manifest = self.path + '.json'
+        self.blocks = self.path + '.blocks'
+        self.remote = {'remote_id': remote_id,
+                       'content_hash': content_hash,
+                       'size': size}
+
+    def restore(self):
+        '''
+        Return the manifest of the part file, or start a new part file if it
+        belongs to a different version of the remote file.
+        '''
+        try:
+            with open(self.manifest, 'r') as fp:
+                manifest = json.load(fp)
+        except (OSError, ValueError):
+            manifest = None
+
+        if manifest is not None and os.path.exists(self.path) and \
+                all(manifest.get(x) == y for x, y in self.remote.items()):
+            return manifest
+
+        self.remove()
+        manifest = dict(self.remote, started_at=time.time())
+        self._write_manifest(manifest)
+        open(self.path, 'wb').close()
+        return manifest
+
+    def _write_manifest(self, manifest):
+        lochness.atomic_write(self.manifest,
+                              json.dumps(manifest).encode('utf-8'))
+
+    def offset(self):
+        '''
+        Number of bytes already downloaded. A part file of a different
+        version of the remote file is discarded.
+        '''
+        self.restore()
+        return os.path.getsize(self.path)
+
+    def download(self, open_range, new_hasher, stream=None):
+        '''
+        Download the rest of the file into the part file, resuming after
+        failures, and hash the whole content. A range request answered with
+        the whole content restarts the download from byte 0.
+
+        :param open_range: Function opening a stream of the file content from
+                           a byte offset to the end
+        :type open_range: function
+        :param new_hasher: Function returning a new hashlib-like hasher
+        :type new_hasher: function
+        :param stream: Already opened stream of the content from byte 0,
+                       optional
+        :returns: path of the part file, and the hasher of the whole content
+        :rtype: tuple
+        '''
+        hasher = new_hasher()
+        self.written = self.offset()
+        if self.written:
+            logger.info(f'resuming {self.path} from byte {self.written}')
+            self._hash_part(hasher)
+        if stream is not None and self.written:
+            stream.close()
+            stream = None
+
+        attempt = 1
+        while self.written < self.remote['size']:
+            try:
+                if stream is None:
+                    stream = open_range(self.written)
+                byte_range = content_range(stream)
+                if byte_range is None and self.written:
+                    logger.warning(f'range request of {self.path} returned '
+                                   'the whole file, restarting from byte 0')
+                    hasher = new_hasher()
+                    self.written = 0
+                elif byte_range is not None and byte_range != \
+                        (self.written, self.remote['size'] - 1):
+                    raise PartError(f'requested bytes {self.written}- but '
+                                    f'received {byte_range}')
+                self._append(stream, hasher)
+                if self.written < self.remote['size']:
+                    raise PartError(f'connection closed at byte '
+                                    f'{self.written}')
+            except RESUMABLE_ERRORS + (PartError,) as e:
+                if attempt == MAX_ATTEMPTS:
+                    raise
+                attempt += 1
+                logger.warning(f'download of {self.path} failed at byte '
+                               f'{self.written} with error: {e}, resuming '
+                               f'{attempt}/{MAX_ATTEMPTS}')
+            finally:
+                if stream is not None:
+                    stream.close()
+                    stream = None
+        return self.path, hasher
+
+    def _append(self, stream, hasher):
+        '''append a stream to the part file, counting the bytes written'''
+        with open(self.path, 'ab') as fo:
+            # drop the tail of a chunk that failed to be written
+            fo.truncate(self.written)
+            try:
+                while 1:
+                    buf = stream.read(CHUNK_SIZE)
+                    if not buf:
+                        break
+                    fo.write(buf)
+                    hasher.update(buf)
+                    self.written += len(buf)
+            finally:
+                fo.flush()
+                os.fsync(fo.fileno())
+
+    def download_blocks(self, open_range, digest, block_size, workers):
+        '''
+        Download the file in blocks of block_size bytes, fetching `workers`
+        blocks at the same time with range requests. Each block is written
+        to its offset in the part file and digested on its own. The digest of
+        every finished block is appended to the blocks file, so only missing
+        blocks are downloaded after a failure or a restart.
+
+        :param open_range: Function opening a stream of the file content
+                           between two inclusive byte offsets
+        :type open_range: function
+        :param digest: Function returning the digest of a block, as bytes
+        :type digest: function
+        :param block_size: Block size in bytes
+        :type block_size: int
+        :param workers: Number of blocks downloaded at the same time
+        :type workers: int
+        :returns: digest of every block, in order
+        :rtype: list
+        '''
+        self.restore()
+        blocks = self._read_blocks()
+        nblocks = -(-self.remote['size'] // block_size)
+        missing = [x for x in range(nblocks) if x not in blocks]
+        if len(missing) < nblocks:
+            logger.info(f'resuming {self.path} with {len(missing)} of '
+                        f'{nblocks} blocks missing')
+
+        lock = threading.Lock()
+
+        def fetch(index):
+            block_digest = self._fetch_block(fd, open_range, digest,
+                                             index, block_size)
+            with lock:
+                blocks[index] = block_digest
+                log.write(f'{index} {block_digest.hex()}\n')
+                log.flush()
+
+        fd = os.open(self.path, os.O_WRONLY)
+        try:
+            os.ftruncate(fd, self.remote['size'])
+            with open(self.blocks, 'a') as log, \
+                    cf.ThreadPoolExecutor(max_workers=workers) as pool:
+                for _ in pool.map(fetch, missing):
+                    pass
+        finally:
+            os.close(fd)
+
+        return [blocks[x] for x in range(nblocks)]
+
+    def _read_blocks(self):
+        '''
+        Return the digest of every finished block, ignoring a record cut
+        short by a crash.
+        '''
+        blocks = dict()
+        if not os.path.exists(self.blocks):
+            return blocks
+        with open(self.blocks, 'r') as fp:
+            for line in fp:
+                if not line.endswith('\n'):
+                    break
+                try:
+                    index, block_digest = line.split()
+                    blocks[int(index)] = bytes.fromhex(block_digest)
+                except ValueError:
+                    continue
+        return blocks
+
+    def _fetch_block(self, fd, open_range, digest, index, block_size):
+        '''download one block, write it to the part file and digest it'''
+        first = index * block_size
+        last = min(first + block_size, self.remote['size']) - 1
+        attempt = 1
+        while True:
+            stream = None
+            try:
+                stream = open_range(first, last)
+                byte_range = content_range(stream)
+                if byte_range != (first, last) and not (
+                        byte_range is None and first == 0 and
+                        last == self.remote['size'] - 1):
+                    raise PartError(f'requested bytes {first}-{last} of '
+                                    f'block {index} but received '
+                                    f'{byte_range or "the whole file"}')
+                data = bytearray()
+                while len(data) < last - first + 1:
+                    buf = stream.read(last - first + 1 - len(data))
+                    if not buf:
+                        break
+                    data += buf
+                if len(data) != last - first + 1:
+                    raise PartError(f'block {index} is {len(data)} bytes')
+                break
+            except RESUMABLE_ERRORS + (PartError,) as e:
+                if attempt == MAX_ATTEMPTS:
+                    raise
+                attempt += 1
+                logger.warning(f'download of block {index} of {self.path} '
+                               f'failed with error: {e}, retrying '
+                               f'{attempt}/{MAX_ATTEMPTS}')
+            finally:
+                if stream is not None:
+                    stream.close()
+        os.pwrite(fd, data, first)
+        os.fdatasync(fd)
+        return digest(data)
+
+    def _hash_part(self, hasher):
+        '''hash the bytes downloaded by an earlier attempt'''
+        with open(self.path, 'rb') as fo:
+            while 1:
+                buf = fo.read(CHUNK_SIZE)
+                if not buf:
+                    break
+                hasher.update(buf)
+
+    def remove(self):
+        '''remove the part file and its manifest'''
+        for path in [self.path, self.manifest, self.blocks]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class PartError(Exception):
+    pass
+
+
+def content_range(stream):
+    '''
+    Return the inclusive (first, last) byte offsets of a partial content
+    response, or None if the response has the whole content.
+
+    :param stream: urllib3 response of a range request
+    :raises PartError: if the response is neither 200 nor 206, or its
+                       Content-Range is missing
+    '''
+    if stream.status == 200:
+        return None
+    if stream.status != 206:
+        raise PartError(f'range request returned status {stream.status}')
+    value = stream.headers.get('Content-Range', '')
+    match = re.match(r'bytes (\d+)-(\d+)/', value)
+    if match is None:
+        raise PartError(f'unexpected Content-Range {value!r}')
+    return int(match.group(1)), int(match.group(2))
@@ -12,6 +12,7 @@ import lochness.tree as tree
 from typing import List, Dict
 import pandas as pd
 from lochness.redcap.process_piis import process_and_copy_db
+from lochness.redcap import metadata_records, merge_metadata_records
 
 
 yaml.SafeDumper.add_representer(
@@ -60,58 +61,21 @@ def initialize_metadata(Lochness: 'Lochness object',
     study_rpms = Lochness['keyring'][f'rpms.{study_name}']
     rpms_root_path = study_rpms['RPMS_PATH']
 
-    source_source_name_dict = {
-        'beiwe': 'Beiwe', 'xnat': 'XNAT', 'dropbox': 'Drpbox',
-        'box': 'Box', 'mediaflux': 'Mediaflux',
-        'mindlamp': 'Mindlamp', 'daris': 'Daris', 'rpms': 'RPMS'}
-
     # get list of csv files from the rpms root
     all_df_dict = get_rpms_database(rpms_root_path)
+    if not all_df_dict:
+        return
 
-    df = pd.DataFrame()
-    # for each record in pulled information, extract subject ID and source IDs
-    for measure, df_measure in all_df_dict.items():
-        if multistudy:
-            site_two_letters_rpms_id = df_measure[rpms_id_colname][:2]
-            site_two_letters_study = study_name.split('_')[1]
-
-            if not site_two_letters_rpms_id == site_two_letters_study:
-                continue
-
-        subject_dict = {'Subject ID': df_measure[rpms_id_colname]}
+    # extract subject ID and source IDs of the records of every measure
+    df = pd.concat([metadata_records(df_measure.astype(object), study_name,
+                                     rpms_id_colname, rpms_consent_colname,
+                                     multistudy)
+                    for df_measure in all_df_dict.values()])
 
-        # Consent date
-        try:
-            subject_dict['Consent'] = df_measure[rpms_consent_colname]
-        except:
-            subject_dict['Consent'] = '1988-09-16'
-
-        for source, source_name in source_source_name_dict.items():
-            try:
-                subject_dict[source_name] = df_measure[f'{source}_id']
-            except:
-                pass
+    if len(df) == 0:
+        return
 
-        df_tmp = pd.DataFrame.from_dict(subject_dict, orient='index')
-        df = pd.concat([df, df_tmp.T])
-
-    # Each subject may have more than one arms, which will result in more than
-    # single item for the subject in the RPMS pulled `content`
-    # remove empty lables
-    df_final = pd.DataFrame()
-    for _, table in df.groupby(['Subject ID']):
-        pad_filled = table.fillna(
-                method='ffill').fillna(method='bfill').iloc[0]
-        df_final = pd.concat([df_final, pad_filled], axis=1)
-    df_final = df_final.T
-
-    # register all of the lables as active
-    df_final['Active'] = 1
-
-    # reorder columns
-    main_cols = ['Active', 'Consent', 'Subject ID']
-    df_final = df_final[main_cols + \
-            [x for x in df_final.columns if x not in main_cols]]
+    df_final = merge_metadata_records(df)
 
     general_path = Path(Lochness['phoenix_root']) / 'GENERAL'
     metadata_study = general_path / study_name / f"{study_name}_metadata.csv"
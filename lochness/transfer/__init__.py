@@ -1,6 +1,5 @@
 from typing import List
 from pathlib import Path
-from datetime import datetime
 import os
 import pandas as pd
 import subprocess
@@ -9,8 +8,9 @@ import tempfile as tf
 import sys
 import paramiko
 import tarfile
-import shutil
+import concurrent.futures as cf
 from lochness import keyring
+from lochness.transfer import scan, manifest, volume, extract
 
 from typing import List, Tuple
 
@@ -18,67 +18,38 @@ from typing import List, Tuple
 def get_updated_files(phoenix_root: str,
                       timestamp_start: int,
                       timestamp_end: int,
-                      general_only: bool = True) -> List[Path]:
-    '''Return list of file paths updated between time window using GNU find
+                      general_only: bool = True,
+                      index: scan.DirectoryIndex = None) -> List[Path]:
+    '''Return list of file paths updated between time window
 
     In order to compress the new files with the original structure from the
-    PHOENIX root, the absolute paths returned by GNU find is changed to
-    relative path from the PHOENIX root.
+    PHOENIX root, the paths are relative to the parental directory of the
+    PHOENIX root. Read docstring for scan.updated_files().
 
     Key arguments:
         phoenix_root: PHOENIX root, str.
-        timestamp_start: start of the GNU find search window in timestamp, int.
-        timestamp_end: end of the GNU find search window in timestamp, int.
+        timestamp_start: start of the search window in timestamp, int.
+        timestamp_end: end of the search window in timestamp, int.
         general_only: only searches new files under GENERAL directory, bool.
+        index: directory index of the previous search, scan.DirectoryIndex.
 
     Returns:
         file_paths_relative: relative paths of new files, list of Path objects.
 
     '''
-    date_time_start = datetime.fromtimestamp(timestamp_start).replace(
-            microsecond=0)
-    date_time_end = datetime.fromtimestamp(timestamp_end).replace(
-            microsecond=0)
-
-    if general_only:
-        find_command = f'find {phoenix_root} ' \
-                       f'-path {phoenix_root}/PROTECTED -prune -o ' \
-                       f'\( -type f ' \
-                       f'-newermt "{date_time_start}" ' \
-                       f'! -newermt "{date_time_end}" \)'
-    else:
-        find_command = f'find {phoenix_root} ' \
-                       f'-type f ' \
-                       f'-newermt "{date_time_start}" ' \
-                       f'! -newermt "{date_time_end}"'
-
-    proc = subprocess.Popen(find_command, shell=True, stdout=subprocess.PIPE)
-    proc.wait()
-
-    outs, _ = proc.communicate()
-
-    file_paths_absolute = outs.decode().strip().split('\n')
-    file_paths_relative = [Path(x).relative_to(Path(phoenix_root).parent) for x
-                           in file_paths_absolute]
-
-    if general_only:
-        # remove the PROTECTED DIR
-        file_paths_relative = [x for x in file_paths_relative
-                               if x.name != 'PROTECTED']
-
-    return file_paths_relative
+    return list(scan.updated_files(phoenix_root, timestamp_start,
+                                   timestamp_end, general_only, index=index))
 
 
 def compress_list_of_files(phoenix_root: str,
                            file_list: list,
-                           out_tar_ball: str) -> None:
+                           out_tar_ball: str,
+                           file_manifest: manifest.Manifest = None) -> None:
     '''Compress list of files using tar
 
     In order to compress the files in the original structure from the
     PHOENIX root, the function takes relative paths from the parent of the
-    PHOENIX directory. Therefore, the tar execution location is changed to the
-    parental directory of the PHOENIX root, and changed back after completing
-    the compression.
+    PHOENIX directory. Read docstring for add_files_to_tar().
 
 
     Key arguments:
@@ -86,6 +57,8 @@ def compress_list_of_files(phoenix_root: str,
         file_list: list of file paths relative to parental directory of
                    PHOENIX root, list of str.
         out_tar_ball: tar file to save
+        file_manifest: only compress the files that changed on the receiver,
+                       manifest.Manifest.
     eg)
     ```
     file_list = ['PHOENIX/GENERAL/StudyA/StudyA_metadata.csv',
@@ -102,20 +75,43 @@ def compress_list_of_files(phoenix_root: str,
     Read docstring for get_updated_files().
     '''
 
-    # convert the out_tar_ball to absolute path
-    out_tar_ball_absolute = Path(out_tar_ball).absolute()
+    with tarfile.open(out_tar_ball, 'w') as tar:
+        add_files_to_tar(tar, phoenix_root, file_list, file_manifest)
+
+
+def add_files_to_tar(tar: tarfile.TarFile,
+                     phoenix_root: str,
+                     file_list: list,
+                     file_manifest: manifest.Manifest = None) -> None:
+    '''Add list of files to an open tar file
 
-    # move to parent directory of the root
-    pwd = os.getcwd()
-    os.chdir(Path(phoenix_root).parent)
+    The files are stored under their paths relative to the parental directory
+    of the PHOENIX root, using arcname, so the working directory is not
+    changed.
 
-    tar = tarfile.open(out_tar_ball_absolute, "w")
+    If a manifest is given, files whose content is already on the receiver
+    are left out, and the manifest of the files added is added as the last
+    member of the tar file.
+
+    Key arguments:
+        tar: tar file open for writing, tarfile.TarFile.
+        phoenix_root: PHOENIX directory
+        file_list: list of file paths relative to parental directory of
+                   PHOENIX root, list of str.
+        file_manifest: manifest of the transfer, manifest.Manifest.
+    '''
+    if file_manifest is not None:
+        file_list = file_manifest.changed(file_list)
+
+    root_parent = Path(phoenix_root).parent
     for file_path in file_list:
-        tar.add(file_path)
-    tar.close()
+        if file_manifest is not None:
+            file_manifest.add_file(tar, file_path)
+        else:
+            tar.add(root_parent / file_path, arcname=str(file_path))
 
-    # move back to original directory
-    os.chdir(pwd)
+    if file_manifest is not None:
+        file_manifest.add_to_tar(tar)
 
 
 def get_ts_and_db(timestamp_db: str) -> Tuple[float, float, pd.DataFrame]:
@@ -158,7 +154,9 @@ def get_ts_and_db(timestamp_db: str) -> Tuple[float, float, pd.DataFrame]:
 
 
 def compress_new_files(compress_db: str, phoenix_root: str,
-                       out_tar_ball: str, general_only: bool = True) -> None:
+                       out_tar_ball: str, general_only: bool = True,
+                       index: scan.DirectoryIndex = None,
+                       file_manifest: manifest.Manifest = None) -> None:
     '''Find a list of new files from the last lochness to lochness sync
 
     Key arguments:
@@ -171,27 +169,41 @@ def compress_new_files(compress_db: str, phoenix_root: str,
         phoenix_root: PHOENIX root, str.
         out_tar_ball: compressed tarball output path, str.
         general_only: only compress the data under GENERAL if True, bool.
+        index: directory index of the previous search, scan.DirectoryIndex.
+        file_manifest: only compress the files that changed on the receiver,
+                       manifest.Manifest.
 
     Returns:
         None
     '''
     last_compress_timestamp, now, compress_df = get_ts_and_db(compress_db)
 
-    # find new files and zip them
-    new_file_lists = get_updated_files(phoenix_root,
-                                       last_compress_timestamp,
-                                       now,
-                                       general_only)
+    # find new files and zip them as they are found
+    new_file_lists = scan.updated_files(phoenix_root,
+                                        last_compress_timestamp,
+                                        now,
+                                        general_only,
+                                        index=index)
 
-    compress_list_of_files(phoenix_root, new_file_lists, out_tar_ball)
+    compress_list_of_files(phoenix_root, new_file_lists, out_tar_ball,
+                           file_manifest)
 
     # save database when the process completes
     compress_df.to_csv(compress_db, index=False)
+    if file_manifest is not None:
+        file_manifest.save()
 
 
-def send_data_over_sftp(Lochness, file_to_send: str):
-    '''Send data over sftp'''
+def connect_sftp(Lochness) -> Tuple[paramiko.Transport,
+                                     paramiko.SFTPClient,
+                                     str]:
+    '''Connect to the sftp server of the lochness_sync keyring
 
+    Returns:
+        transport: paramiko.Transport, to be closed by the caller
+        sftp: paramiko.SFTPClient
+        path_in_host: directory to save the transferred files, str.
+    '''
     sftp_keyring = Lochness['keyring']['lochness_sync']
     host = sftp_keyring['HOST']
     username = sftp_keyring['USERNAME']
@@ -203,11 +215,140 @@ def send_data_over_sftp(Lochness, file_to_send: str):
     transport.connect(username=username, password=password)
     sftp = paramiko.SFTPClient.from_transport(transport)
 
+    return transport, sftp, path_in_host
+
+
+def transfer_manifest(Lochness, sftp=None, path_in_host=None):
+    '''Return the manifest of a transfer if lochness_sync_manifest is set
+
+    The acknowledgement manifest of the receiver is read over sftp, using a
+    new connection unless one is given.
+
+    Key arguments:
+        Lochness: Lochness config.load object
+        sftp: connection to the receiver, paramiko.SFTPClient, optional.
+        path_in_host: directory the receiver picks up tarballs from, str.
+
+    Returns:
+        manifest.Manifest, or None
+    '''
+    if not manifest.enabled(Lochness):
+        return None
+
+    if sftp is None:
+        transport, sftp, path_in_host = connect_sftp(Lochness)
+        try:
+            ack = manifest.read_ack(sftp, path_in_host)
+        finally:
+            sftp.close()
+            transport.close()
+    else:
+        ack = manifest.read_ack(sftp, path_in_host)
+
+    return manifest.Manifest(Lochness['phoenix_root'], ack,
+                             manifest.cache_path(Lochness))
+
+
+def send_data_over_sftp(Lochness, file_to_send: str):
+    '''Send data over sftp'''
+    transport, sftp, path_in_host = connect_sftp(Lochness)
+
     sftp.put(file_to_send, str(Path(path_in_host) / Path(file_to_send).name))
     sftp.close()
     transport.close()
 
 
+def stream_new_files_over_sftp(Lochness, general_only: bool = True) -> None:
+    '''Stream new files from the last lochness to lochness sync over sftp
+
+    Tar members are written straight into the remote file, which is opened in
+    pipelined mode, so packing and upload overlap, and no tarball is saved
+    locally. Read docstring for volume.write_volumes().
+
+    Key arguments:
+        Lochness: Lochness config.load object
+        general_only: only searches new files under GENERAL directory, bool.
+    '''
+    compress_db = Lochness['lochness_sync_history_csv']
+    phoenix_root = Lochness['phoenix_root']
+    last_compress_timestamp, now, compress_df = get_ts_and_db(compress_db)
+
+    new_file_lists = scan.updated_files(phoenix_root,
+                                        last_compress_timestamp,
+                                        now,
+                                        general_only,
+                                        index=scan.directory_index(Lochness))
+
+    transport, sftp, path_in_host = connect_sftp(Lochness)
+    try:
+        file_manifest = transfer_manifest(Lochness, sftp, path_in_host)
+        volume.write_volumes(phoenix_root,
+                             new_file_lists,
+                             volume.SFTPSink(sftp, path_in_host),
+                             f'lochness_sync_{now:.0f}',
+                             file_manifest=file_manifest,
+                             **volume.options(Lochness))
+    finally:
+        sftp.close()
+        transport.close()
+
+    # save database when the upload completes
+    compress_df.to_csv(compress_db, index=False)
+    if file_manifest is not None:
+        file_manifest.save()
+
+
+def send_new_volumes_over_sftp(Lochness, general_only: bool = True) -> None:
+    '''Compress new files into volumes, then send them over sftp
+
+    Key arguments:
+        Lochness: Lochness config.load object
+        general_only: only searches new files under GENERAL directory, bool.
+    '''
+    compress_db = Lochness['lochness_sync_history_csv']
+    phoenix_root = Lochness['phoenix_root']
+    last_compress_timestamp, now, compress_df = get_ts_and_db(compress_db)
+
+    new_file_lists = scan.updated_files(phoenix_root,
+                                        last_compress_timestamp,
+                                        now,
+                                        general_only,
+                                        index=scan.directory_index(Lochness))
+    file_manifest = transfer_manifest(Lochness)
+
+    with tf.TemporaryDirectory(suffix='tmp', dir='.') as tmpdir:
+        volumes = volume.write_volumes(phoenix_root,
+                                       new_file_lists,
+                                       volume.LocalSink(tmpdir),
+                                       f'lochness_sync_{now:.0f}',
+                                       file_manifest=file_manifest,
+                                       **volume.options(Lochness))
+
+        transport, sftp, path_in_host = connect_sftp(Lochness)
+        try:
+            # the index of a volume is renamed before the volume, so the
+            # receiver finds the index of every volume, as with SFTPSink
+            for filename in volumes:
+                for name in [filename + volume.INDEX_SUFFIX, filename]:
+                    remote_path = str(Path(path_in_host) / name)
+                    sftp.put(str(Path(tmpdir) / name), remote_path + '.part')
+                    sftp.posix_rename(remote_path + '.part', remote_path)
+        finally:
+            sftp.close()
+            transport.close()
+
+    # save database when the upload completes
+    compress_df.to_csv(compress_db, index=False)
+    if file_manifest is not None:
+        file_manifest.save()
+
+
+def stream_enabled(Lochness) -> bool:
+    '''True if lochness_sync_stream is set in the config'''
+    value = Lochness.get('lochness_sync_stream', False)
+    return value if isinstance(value, bool) else False
+
+
 def lochness_to_lochness_transfer_sftp(Lochness, general_only: bool = True):
     '''Lochness to Lochness transfer
 
@@ -216,6 +357,14 @@ def lochness_to_lochness_transfer_sftp(Lochness, general_only: bool = True):
         general_only: only searches new files under GENERAL directory, bool.
                       default = True.
     '''
+    if stream_enabled(Lochness):
+        stream_new_files_over_sftp(Lochness, general_only)
+        return
+
+    if volume.enabled(Lochness):
+        send_new_volumes_over_sftp(Lochness, general_only)
+        return
+
     with tf.NamedTemporaryFile(suffix='tmp.tar',
                                delete=False,
                                dir='.') as tmpfilename:
@@ -223,7 +372,9 @@ def lochness_to_lochness_transfer_sftp(Lochness, general_only: bool = True):
         compress_new_files(Lochness['lochness_sync_history_csv'],
                            Lochness['phoenix_root'],
                            tmpfilename.name,
-                           general_only)
+                           general_only,
+                           scan.directory_index(Lochness),
+                           transfer_manifest(Lochness))
 
         # send to remote server
         send_data_over_sftp(Lochness, tmpfilename.name)
@@ -339,14 +490,49 @@ def lochness_to_lochness_transfer_receive_sftp(Lochness):
 
     last_sync_timestamp, _, sync_df = get_ts_and_db(sync_db)
 
+    # tarballs transferred after the last transfer, in the order received
+    transferred = []
     for root, _, files in os.walk(path_in_host):
         for file in files:
             file_p = Path(root) / file
-            # if the file is transferred after the last transfer
-            if file_p.stat().st_mtime > last_sync_timestamp \
-                    and file.endswith('.tar'):
-                decompress_transferred_file_and_copy(target_phoenix_root,
-                                                     file_p)
+            if volume.codec_of(file) is not None:
+                mtime = file_p.stat().st_mtime
+                if mtime > last_sync_timestamp:
+                    transferred.append((mtime, str(file_p)))
+    transferred = [Path(x) for _, x in sorted(transferred)]
+
+    sequencer = extract.Sequencer()
+
+    def extract_checked(sequence, file_p):
+        '''extract a tarball, checking volumes against their index'''
+        return extract.extract_volume(target_phoenix_root, file_p, sequence,
+                                      sequencer, remove=False,
+                                      index=volume.read_index(file_p))
+
+    with cf.ThreadPoolExecutor(
+            max_workers=extract.receive_workers(Lochness)) as pool:
+        futures = [pool.submit(extract_checked, sequence, file_p)
+                   for sequence, file_p in enumerate(transferred)]
+        cf.wait(futures)
+
+    # tarballs are only removed and acknowledged up to the first one that
+    # failed. It is extracted again on the next transfer, with every tarball
+    # received after it, so it does not replace their files.
+    received = dict()
+    failed = None
+    for file_p, future in zip(transferred, futures):
+        failed = future.exception()
+        if failed is not None:
+            break
+        received.update(future.result())
+        os.remove(file_p)
+        # index of the volume
+        index_p = Path(str(file_p) + volume.INDEX_SUFFIX)
+        if index_p.is_file():
+            os.remove(index_p)
+    manifest.update_ack(path_in_host, received)
+    if failed is not None:
+        raise failed
 
     sync_df.to_csv(sync_db, index=False)
 
@@ -356,28 +542,17 @@ def decompress_transferred_file_and_copy(target_phoenix_root: str,
     '''Decompress the tar file and arrange the new data into PHOENIX structure
 
     Decompress the tar file transferred and arrange the new data into the
-    corresponding structure under the PHOENIX structure.
+    corresponding structure under the PHOENIX structure. Read docstring for
+    extract.extract_volume().
 
     Key arguments:
         target_phoenix_root: path of the PHOENIX directory, str.
         tar_file_trasferred: path of the tar file transferred from another
-                             lochness using lochness_sync, str.
-    '''
-    tar = tarfile.open(tar_file_trasferred)
-
-    with tf.TemporaryDirectory(suffix='tmp', dir='.') as tmpdir:
-        tar.extractall(path=tmpdir)
-
-        for root, _, files in os.walk(tmpdir):
-            for file in files:
-                relative_root = root.split(tmpdir + '/PHOENIX/')[1]
-                target_path = Path(target_phoenix_root) / relative_root / file
-                target_path.parent.mkdir(exist_ok=True, parents=True)
+                             lochness using lochness_sync, str. It may be
+                             compressed with any of volume.CODECS.
 
-                # this overwrites exsiting file
-                shutil.copy(Path(root) / file, target_path)
-
-                # permission change
-                os.chmod(target_path, 0o0644)
-
-    os.remove(tar_file_trasferred)
+    Returns:
+        received: manifest of the files in the tar file, {path: [size, hash]},
+                  or an empty dict if the sender did not add a manifest.
+    '''
+    return extract.extract_volume(target_phoenix_root, tar_file_trasferred)
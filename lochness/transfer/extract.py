@@ -0,0 +1,169 @@
+import os
+import shutil
+import logging
+import tempfile
+import threading
+from pathlib import Path, PurePosixPath
+from lochness.transfer import manifest, volume
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RECEIVE_WORKERS = 4
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def receive_workers(Lochness) -> int:
+    '''get lochness_sync_receive_workers with a safe default'''
+    value = Lochness.get('lochness_sync_receive_workers',
+                         DEFAULT_RECEIVE_WORKERS)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        return DEFAULT_RECEIVE_WORKERS
+    return value
+
+
+class Sequencer(object):
+    '''
+    Keep the version of each file from the latest tarball, when tarballs are
+    extracted at the same time. Tarballs are numbered in the order they were
+    received, and a file is only replaced by a tarball numbered the same or
+    later than the one that last replaced it.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latest = dict()
+
+    def outdated(self, target, sequence):
+        '''True if the file was replaced by a later tarball already'''
+        with self.lock:
+            return self.latest.get(target, sequence) > sequence
+
+    def replace(self, tmp, target, sequence):
+        '''
+        Rename a temporary file to its target, unless a later tarball
+        replaced the target already.
+
+        :returns: True if the target was replaced
+        '''
+        with self.lock:
+            if self.latest.get(target, sequence) > sequence:
+                return False
+            os.replace(tmp, target)
+            self.latest[target] = sequence
+            return True
+
+
+def target_path(target_phoenix_root, name):
+    '''
+    Return the path of a tar member under the target PHOENIX root, or None if
+    the member is not under a PHOENIX directory.
+    '''
+    parts = PurePosixPath(name).parts
+    if len(parts) < 2 or parts[0] == '/' or '..' in parts:
+        return None
+    return Path(target_phoenix_root, *parts[1:])
+
+
+def extract_member(tar, member, target, sequence, sequencer):
+    '''
+    Write a tar member to a temporary file next to its target, with the
+    permissions of the target, and rename it to the target.
+    '''
+    target.parent.mkdir(exist_ok=True, parents=True)
+    fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=f'.{target.name}.')
+    try:
+        os.fchmod(fd, 0o0644)
+        with os.fdopen(fd, 'wb') as fp:
+            shutil.copyfileobj(tar.extractfile(member), fp, CHUNK_SIZE)
+        if not sequencer.replace(tmp, target, sequence):
+            os.remove(tmp)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def check_name(path, index):
+    '''check that a volume is the one its index was written for'''
+    codec = index.get('codec')
+    expected = f'{index.get("name")}.{index.get("volume", 0):04d}' \
+               f'{volume.CODECS.get(codec, "")}'
+    if Path(path).name != expected or volume.codec_of(str(path)) != codec:
+        raise volume.VolumeError(f'{path} does not match its index, '
+                                 f'written for {expected}')
+
+
+def extract_volume(target_phoenix_root: str,
+                   tar_file_transferred: str,
+                   sequence: int = 0,
+                   sequencer: Sequencer = None,
+                   remove: bool = True,
+                   index: dict = None) -> dict:
+    '''Extract a tarball into PHOENIX member by member
+
+    Each file is streamed from the tarball to a temporary file next to its
+    target, which is renamed to the target once complete, so a file is never
+    seen half written. The tarball is removed once all of its files are
+    extracted, unless ``remove`` is False.
+
+    With the index of a volume, the name and codec of the volume are checked
+    before extracting it, each file is checked against the index before it
+    is extracted, and the number of files and tar size once the volume is
+    read, so a volume that is truncated or not the one indexed fails.
+
+    Key arguments:
+        target_phoenix_root: path of the PHOENIX directory, str.
+        tar_file_transferred: path of the tar file transferred from another
+                              lochness using lochness_sync, str.
+        sequence: order in which the tarball was received, int.
+        sequencer: Sequencer shared by the tarballs extracted at the same
+                   time.
+        remove: remove the tarball once extracted, bool.
+        index: index of the volume, from volume.read_index(), dict.
+
+    Returns:
+        received: manifest of the files in the tar file, {path: [size, hash]},
+                  or an empty dict if the sender did not add a manifest.
+    '''
+    sequencer = sequencer or Sequencer()
+    received = dict()
+    if index is not None:
+        check_name(tar_file_transferred, index)
+    files = 0
+    with volume.stream_volume(tar_file_transferred) as tar:
+        for member in tar:
+            if member.name == manifest.MANIFEST:
+                received = manifest.read_json(tar.extractfile(member),
+                                              manifest.MANIFEST)
+                continue
+
+            if index is not None and member.isfile():
+                if files >= len(index['files']) or \
+                        index['files'][files] != member.name:
+                    raise volume.VolumeError(
+                            f'{member.name} of {tar_file_transferred} is '
+                            'not in its index')
+                files += 1
+
+            target = target_path(target_phoenix_root, member.name)
+            if target is None:
+                logger.warning(f'skipping {member.name} of '
+                               f'{tar_file_transferred}')
+            elif member.isdir():
+                target.mkdir(exist_ok=True, parents=True)
+            elif not member.isfile():
+                logger.warning(f'skipping {member.name} of '
+                               f'{tar_file_transferred}, not a file')
+            elif not sequencer.outdated(target, sequence):
+                extract_member(tar, member, target, sequence, sequencer)
+
+        if index is not None:
+            if files != len(index['files']):
+                raise volume.VolumeError(
+                        f'{tar_file_transferred} has {files} files, its '
+                        f'index lists {len(index["files"])} files')
+            volume.check_size(tar_file_transferred, index, tar.offset)
+
+    if remove:
+        os.remove(tar_file_transferred)
+    return received
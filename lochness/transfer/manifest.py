@@ -0,0 +1,236 @@
+import os
+import io
+import json
+import time
+import hashlib
+import logging
+import tarfile
+from pathlib import Path
+from typing import Iterable, Iterator
+import lochness
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'lochness_sync_manifest.json'
+'''
+Tar member listing the files of a tarball as {path: [size, hash]}.
+'''
+
+ACK = 'lochness_sync_ack.json'
+'''
+Written by the receiver in PATH_IN_HOST, listing every file received as
+{path: [size, hash]}.
+'''
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def enabled(Lochness) -> bool:
+    '''True if lochness_sync_manifest is set in the config'''
+    value = Lochness.get('lochness_sync_manifest', False)
+    return value if isinstance(value, bool) else False
+
+
+def hash_file(path: str) -> str:
+    '''blake2b hex digest of a file'''
+    hasher = hashlib.blake2b()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class HashingReader(object):
+    '''blake2b hash the data read from a file object'''
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hasher = hashlib.blake2b()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        return data
+
+
+def read_json(fp, name: str) -> dict:
+    '''read a manifest, or an empty manifest if it is unreadable'''
+    try:
+        content = json.load(fp)
+    except ValueError as e:
+        logger.warning(f'ignoring unreadable manifest {name}: {e}')
+        return dict()
+    return content if isinstance(content, dict) else dict()
+
+
+def read_ack(sftp, path_in_host: str) -> dict:
+    '''
+    Read the acknowledgement manifest of the receiver over sftp
+
+    Key arguments:
+        sftp: paramiko.SFTPClient connected to the receiver
+        path_in_host: directory the receiver picks up tarballs from, str.
+
+    Returns:
+        {path: [size, hash]} of the files the receiver has, or an empty
+        dict if the receiver has not written one yet.
+    '''
+    ack_path = str(Path(path_in_host) / ACK)
+    try:
+        with sftp.open(ack_path, 'r') as fp:
+            return read_json(fp, ack_path)
+    except IOError:
+        return dict()
+
+
+def update_ack(path_in_host: str, received: dict) -> None:
+    '''
+    Add files received to the acknowledgement manifest of the receiver
+
+    Key arguments:
+        path_in_host: directory the receiver picks up tarballs from, str.
+        received: {path: [size, hash]} of the files received, dict.
+    '''
+    if not received:
+        return
+    ack_path = Path(path_in_host) / ACK
+    ack = dict()
+    if ack_path.is_file():
+        with open(ack_path, 'r') as fp:
+            ack = read_json(fp, str(ack_path))
+    ack.update(received)
+    lochness.atomic_write(str(ack_path), json.dumps(ack).encode('utf-8'))
+
+
+class Manifest(object):
+    '''
+    Contents of the files sent by a lochness to lochness transfer.
+
+    Files whose size and hash match the acknowledgement manifest of the
+    receiver are not sent again, even if their modification time changed.
+    Hashes are kept with the size and modification time of each file, and
+    persisted to ``path``, so unchanged files are not hashed again on the
+    next transfer. Files that are sent without being compared to the
+    receiver's, as their size differs, are hashed while they are added to
+    the tar file.
+
+    :param phoenix_root: PHOENIX root
+    :type phoenix_root: str
+    :param ack: acknowledgement manifest of the receiver
+    :type ack: dict
+    :param path: json file to persist the hashes to, optional
+    :type path: str
+    '''
+    def __init__(self, phoenix_root, ack=None, path=None):
+        self.root_parent = Path(phoenix_root).parent
+        self.ack = ack or dict()
+        self.path = path
+        self.hashes = dict()
+        self.sent = dict()
+        if path and os.path.exists(path):
+            with open(path, 'r') as fp:
+                self.hashes = read_json(fp, path)
+
+    def entry(self, file_path: str, stat=None) -> list:
+        '''
+        Return [size, hash] of a file, only hashing it if its size or
+        modification time changed since it was last hashed.
+
+        Key arguments:
+            file_path: path relative to parental directory of PHOENIX root.
+            stat: os.stat_result of the file, optional.
+        '''
+        stat = stat or os.stat(self.root_parent / file_path)
+        cached = self.hashes.get(file_path)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return [stat.st_size, cached[2]]
+        content_hash = hash_file(self.root_parent / file_path)
+        self.hashes[file_path] = [stat.st_size, stat.st_mtime_ns,
+                                  content_hash]
+        return [stat.st_size, content_hash]
+
+    def changed(self, file_list: Iterable) -> Iterator[str]:
+        '''
+        Generate the files whose content differs from the receiver's, and
+        record them as sent. Files are only hashed here when the receiver
+        has a file of the same size, and the hash of the other files is
+        recorded once they are added to the tar file by add_file().
+
+        Key arguments:
+            file_list: file paths relative to parental directory of PHOENIX
+                       root.
+        '''
+        skipped = 0
+        for file_path in file_list:
+            file_path = str(file_path)
+            try:
+                stat = os.stat(self.root_parent / file_path)
+                acked = self.ack.get(file_path)
+                if acked and acked[0] == stat.st_size:
+                    entry = self.entry(file_path, stat)
+                else:
+                    entry = [stat.st_size, None]
+            except FileNotFoundError:
+                continue
+            if acked == entry:
+                skipped += 1
+                continue
+            self.sent[file_path] = entry
+            yield file_path
+        logger.info(f'{len(self.sent)} files to send, {skipped} files '
+                    'already on the receiver')
+
+    def add_file(self, tar: tarfile.TarFile, file_path: str) -> None:
+        '''
+        Add a file sent to a tar, hashing it on the way if it was not hashed
+        by changed().
+
+        Key arguments:
+            tar: tar file open for writing, tarfile.TarFile.
+            file_path: path relative to parental directory of PHOENIX root.
+        '''
+        file_path = str(file_path)
+        if self.sent[file_path][1] is not None:
+            tar.add(self.root_parent / file_path, arcname=file_path)
+            return
+        with open(self.root_parent / file_path, 'rb') as fp:
+            stat = os.fstat(fp.fileno())
+            info = tar.gettarinfo(arcname=file_path, fileobj=fp)
+            reader = HashingReader(fp)
+            tar.addfile(info, reader)
+        content_hash = reader.hasher.hexdigest()
+        self.hashes[file_path] = [info.size, stat.st_mtime_ns, content_hash]
+        self.sent[file_path] = [info.size, content_hash]
+
+    def add_to_tar(self, tar: tarfile.TarFile, files: list = None) -> None:
+        '''
+        Add the manifest of the files sent as the last member of a tar
+
+        Key arguments:
+            tar: tar file open for writing, tarfile.TarFile.
+            files: only list these files, e.g., the files of a volume.
+        '''
+        sent = self.sent if files is None else \
+            {x: self.sent[x] for x in files}
+        content = json.dumps(sent).encode('utf-8')
+        info = tarfile.TarInfo(MANIFEST)
+        info.size = len(content)
+        info.mtime = time.time()
+        info.mode = 0o644
+        tar.addfile(info, io.BytesIO(content))
+
+    def save(self) -> None:
+        '''write the hashes to the hash file'''
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lochness.atomic_write(self.path,
+                              json.dumps(self.hashes).encode('utf-8'))
+
+
+def cache_path(Lochness):
+    '''hash file under cache_dir, or None if cache_dir is not set'''
+    directory = Lochness.get('cache_dir', None)
+    if not directory:
+        return None
+    return os.path.join(os.path.expanduser(directory), 'transfer',
+                        'sent_manifest.json')
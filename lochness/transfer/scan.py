@@ -0,0 +1,227 @@
+import os
+import json
+import queue
+import logging
+import threading
+import concurrent.futures as cf
+from pathlib import Path
+from typing import Iterator
+import lochness
+
+logger = logging.getLogger(__name__)
+
+SCAN_WORKERS = 4
+
+DONE = object()
+'''
+Put on the result queue by a scan worker once its study is scanned.
+'''
+
+
+class DirectoryIndex(object):
+    '''
+    Modification times of the PHOENIX directories seen by the last scan.
+
+    Lochness replaces files by renaming a temporary file, which updates the
+    modification time of the directory. A directory whose modification time
+    has not changed since a scan that ended before the start of the time
+    window has no new files in the window, so the files in it are not looked
+    up again. Its subdirectories are still listed, as their changes do not
+    show in the modification time of the parent.
+
+    Files modified in place, instead of replaced, in such a directory are
+    missed until something else changes in the directory.
+
+    :param path: json file to persist the index to, optional
+    :type path: str
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.scanned_until = 0
+        self.directories = dict()
+        self.seen = dict()
+        if path and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        '''read the index from the index file'''
+        try:
+            with open(self.path, 'r') as fp:
+                content = json.load(fp)
+            self.scanned_until = content['scanned_until']
+            self.directories = content['directories']
+        except (ValueError, KeyError, OSError) as e:
+            logger.warning(f'ignoring unreadable index {self.path}: {e}')
+            self.scanned_until = 0
+            self.directories = dict()
+
+    def save(self):
+        '''write the index to the index file'''
+        if not self.path:
+            return
+        with self.lock:
+            content = json.dumps({'scanned_until': self.scanned_until,
+                                  'directories': self.directories})
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lochness.atomic_write(self.path, content.encode('utf-8'))
+
+    def unchanged(self, timestamp_start, path, mtime_ns):
+        '''
+        True if a directory has no files newer than ``timestamp_start``.
+
+        :param timestamp_start: start of the time window
+        :type timestamp_start: float
+        :param path: Directory path
+        :type path: str
+        :param mtime_ns: Modification time of the directory
+        :type mtime_ns: int
+        '''
+        if not self.scanned_until or self.scanned_until > timestamp_start:
+            return False
+        return self.directories.get(path) == mtime_ns
+
+    def see(self, path, mtime_ns, cutoff_ns):
+        '''
+        Record a directory. Directories modified after the end of the scan
+        window are not recorded, so they are looked up again.
+        '''
+        if mtime_ns < cutoff_ns:
+            with self.lock:
+                self.seen[path] = mtime_ns
+
+    def update(self, timestamp_end):
+        '''replace the index by the directories seen by a complete scan'''
+        with self.lock:
+            self.directories = self.seen
+            self.seen = dict()
+            self.scanned_until = timestamp_end
+
+
+def directory_index(Lochness):
+    '''
+    Return the PHOENIX directory index if ``lochness_sync_directory_index``
+    is set in the configuration file, or None. The index is kept under
+    ``cache_dir``.
+
+    :param Lochness: Lochness context
+    :type Lochness: dict
+    '''
+    if Lochness.get('lochness_sync_directory_index', False) is not True:
+        return None
+    directory = Lochness.get('cache_dir', None)
+    if not directory:
+        logger.warning('lochness_sync_directory_index requires cache_dir')
+        return None
+    return DirectoryIndex(os.path.join(os.path.expanduser(directory),
+                                       'transfer', 'phoenix_directories.json'))
+
+
+def updated_files(phoenix_root: str,
+                  timestamp_start: float,
+                  timestamp_end: float,
+                  general_only: bool = True,
+                  workers: int = SCAN_WORKERS,
+                  index: DirectoryIndex = None) -> Iterator[Path]:
+    '''
+    Generate the files under PHOENIX modified in a time window
+
+    The time window is rounded down to the second, and includes its end, as
+    in ``find -newermt start ! -newermt end``. Each study directory is
+    scanned by one of the workers, and files are generated as soon as their
+    directory is scanned. PROTECTED is not scanned at all when
+    ``general_only`` is set.
+
+    :param phoenix_root: PHOENIX root
+    :type phoenix_root: str
+    :param timestamp_start: start of the time window
+    :type timestamp_start: float
+    :param timestamp_end: end of the time window
+    :type timestamp_end: float
+    :param general_only: only scan the GENERAL directory
+    :type general_only: bool
+    :param workers: number of study directories to scan at the same time
+    :type workers: int
+    :param index: Directory index, updated once the scan is complete
+    :type index: DirectoryIndex
+    :returns: paths relative to the parental directory of PHOENIX root
+    '''
+    start_ns = int(timestamp_start) * 10**9
+    end_ns = int(timestamp_end) * 10**9
+    root = Path(phoenix_root)
+    prune = str(root / 'PROTECTED') if general_only else None
+    if index is not None:
+        index.seen = dict()
+
+    def scan(path, relative_path):
+        '''return the files in the window and the subdirectories'''
+        files, subdirs = [], []
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            skip_files = index is not None and \
+                index.unchanged(timestamp_start, path, mtime_ns)
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    # an entry removed since the listing, e.g., a temporary
+                    # file renamed away, is skipped on its own
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.path != prune:
+                                subdirs.append(
+                                    (entry.path,
+                                     os.path.join(relative_path, entry.name)))
+                        elif not skip_files and \
+                                entry.is_file(follow_symlinks=False) and \
+                                start_ns < entry.stat(follow_symlinks=False
+                                                      ).st_mtime_ns <= end_ns:
+                            files.append(Path(relative_path, entry.name))
+                    except OSError as e:
+                        logger.debug(f'skipping {entry.path}: {e}')
+        except OSError as e:
+            logger.warning(f'skipping {path}: {e}')
+            return [], []
+        if index is not None:
+            index.see(path, mtime_ns, end_ns)
+        return files, subdirs
+
+    def scan_tree(path, relative_path, results):
+        '''put the files of a directory tree on the result queue'''
+        try:
+            stack = [(path, relative_path)]
+            while stack:
+                files, subdirs = scan(*stack.pop())
+                if files:
+                    results.put(files)
+                stack.extend(subdirs)
+        except Exception as e:
+            results.put(e)
+        finally:
+            results.put(DONE)
+
+    # the PHOENIX root and the GENERAL and PROTECTED directories are scanned
+    # here, and the study directories under them by the workers
+    studies = []
+    files, subdirs = scan(str(root), root.name)
+    yield from files
+    for subdir in subdirs:
+        files, study_dirs = scan(*subdir)
+        yield from files
+        studies.extend(study_dirs)
+
+    results = queue.Queue()
+    with cf.ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        for study in studies:
+            pool.submit(scan_tree, *study, results)
+        remaining = len(studies)
+        while remaining:
+            files = results.get()
+            if files is DONE:
+                remaining -= 1
+            elif isinstance(files, Exception):
+                raise files
+            else:
+                yield from files
+
+    if index is not None:
+        index.update(timestamp_end)
+        index.save()
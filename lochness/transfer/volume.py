@@ -0,0 +1,366 @@
+import os
+import gzip
+import json
+import shutil
+import contextlib
+import logging
+import tarfile
+import threading
+import subprocess
+from pathlib import Path
+from typing import Iterable, Iterator, List
+import lochness
+
+logger = logging.getLogger(__name__)
+
+CODECS = {
+    'none': '.tar',
+    'gzip': '.tar.gz',
+    'zstd': '.tar.zst',
+}
+'''
+Codecs of lochness to lochness tarballs, with the suffix of their volumes.
+'''
+
+INDEX_SUFFIX = '.json'
+'''
+Suffix of the index of a volume, listing the name, codec, tar size and
+files of the volume.
+'''
+
+CHUNK_SIZE = 1024 * 1024
+
+SFTP_BUFSIZE = 32768
+
+
+class VolumeError(Exception):
+    pass
+
+
+def codec(Lochness) -> str:
+    '''get lochness_sync_codec with a safe default'''
+    value = Lochness.get('lochness_sync_codec', 'none')
+    if value not in CODECS:
+        logger.warning(f'unknown lochness_sync_codec {value}, using none')
+        return 'none'
+    if value == 'zstd' and not shutil.which('zstd'):
+        logger.warning('zstd is not installed, using gzip')
+        return 'gzip'
+    return value
+
+
+def codec_threads(Lochness) -> int:
+    '''get lochness_sync_codec_threads with a safe default'''
+    value = Lochness.get('lochness_sync_codec_threads', None)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        return os.cpu_count() or 1
+    return value
+
+
+def max_volume_size(Lochness) -> int:
+    '''get lochness_sync_max_volume_size in bytes, or None'''
+    value = Lochness.get('lochness_sync_max_volume_size', None)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        return None
+    return value
+
+
+def enabled(Lochness) -> bool:
+    '''True if the tarballs are compressed or split into volumes'''
+    return codec(Lochness) != 'none' or max_volume_size(Lochness) is not None
+
+
+def options(Lochness) -> dict:
+    '''keyword arguments of write_volumes from the config'''
+    return {'codec': codec(Lochness),
+            'threads': codec_threads(Lochness),
+            'max_size': max_volume_size(Lochness)}
+
+
+def codec_of(filename: str) -> str:
+    '''Return the codec of a volume from its name, or None'''
+    for name, suffix in sorted(CODECS.items(), key=lambda x: -len(x[1])):
+        if filename.endswith(suffix):
+            return name
+    return None
+
+
+class Compressor(object):
+    '''
+    Compress the data written to it with an external compressor, which runs
+    its own threads, into a file object.
+
+    :param fileobj: File object to write the compressed data to
+    :param command: Compressor command, writing to stdout
+    :type command: list
+    '''
+    def __init__(self, fileobj, command):
+        self.fileobj = fileobj
+        self.error = None
+        self.proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+        self.pump = threading.Thread(target=self._pump, daemon=True)
+        self.pump.start()
+
+    def _pump(self):
+        '''copy the compressed data to the file object'''
+        try:
+            for chunk in iter(lambda: self.proc.stdout.read(CHUNK_SIZE), b''):
+                self.fileobj.write(chunk)
+        except Exception as e:
+            self.error = e
+            self.proc.kill()
+
+    def write(self, data):
+        try:
+            self.proc.stdin.write(data)
+        except BrokenPipeError:
+            self.close()
+            raise
+        return len(data)
+
+    def close(self):
+        if not self.proc.stdin.closed:
+            self.proc.stdin.close()
+        self.pump.join()
+        returncode = self.proc.wait()
+        if self.error is not None:
+            raise self.error
+        if returncode:
+            raise VolumeError(f'{self.proc.args[0]} exited with {returncode}')
+
+
+def open_compressor(fileobj, codec: str = 'none', threads: int = 1):
+    '''
+    Return a file object compressing the data written to it into fileobj.
+    gzip uses pigz when it is installed, and gzip in this process otherwise.
+    '''
+    if codec == 'zstd':
+        return Compressor(fileobj, ['zstd', f'-T{threads}', '-q', '-c'])
+    if codec == 'gzip':
+        if shutil.which('pigz'):
+            return Compressor(fileobj, ['pigz', '-p', str(threads), '-c'])
+        return gzip.GzipFile(fileobj=fileobj, mode='wb')
+    return None
+
+
+@contextlib.contextmanager
+def stream_volume(path: str) -> Iterator[tarfile.TarFile]:
+    '''
+    Open a volume for reading member by member, decompressing it on the fly.
+    zstd volumes are decompressed by the zstd command, as tarfile does not
+    read zstd.
+    '''
+    if codec_of(str(path)) != 'zstd':
+        with tarfile.open(path, 'r|*') as tar:
+            yield tar
+        return
+
+    proc = subprocess.Popen(['zstd', '-d', '-q', '-c', str(path)],
+                            stdout=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+            yield tar
+        # the end of archive padding
+        for _ in iter(lambda: proc.stdout.read(CHUNK_SIZE), b''):
+            pass
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    proc.stdout.close()
+    if proc.wait():
+        raise VolumeError(f'zstd could not decompress {path}')
+
+
+class Counter(object):
+    '''count the bytes written through to a file object'''
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.fileobj.write(data)
+
+
+class LocalSink(object):
+    '''
+    Save volumes to a local directory. Volumes are written under a '.part'
+    name, and renamed once complete and their index is written.
+
+    :param directory: Directory to save the volumes to
+    :type directory: str
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def open(self, filename):
+        return open(os.path.join(self.directory, filename + '.part'), 'wb')
+
+    def commit(self, filename, index):
+        path = os.path.join(self.directory, filename)
+        lochness.atomic_write(path + INDEX_SUFFIX,
+                              json.dumps(index).encode('utf-8'))
+        os.rename(path + '.part', path)
+
+    def abort(self, filename):
+        try:
+            os.remove(os.path.join(self.directory, filename + '.part'))
+        except FileNotFoundError:
+            pass
+
+
+class SFTPSink(object):
+    '''
+    Upload volumes over sftp, through pipelined file handles. Volumes are
+    written under a '.part' name, which the receiver ignores, and renamed
+    once complete. The index of a volume is written before the volume is
+    renamed, so the receiver finds the index of every volume.
+
+    :param sftp: paramiko.SFTPClient
+    :param directory: Remote directory to save the volumes to
+    :type directory: str
+    '''
+    def __init__(self, sftp, directory):
+        self.sftp = sftp
+        self.directory = directory
+
+    def _path(self, filename):
+        return str(Path(self.directory) / filename)
+
+    def open(self, filename):
+        remote = self.sftp.open(self._path(filename + '.part'), 'wb',
+                                SFTP_BUFSIZE)
+        remote.set_pipelined(True)
+        return remote
+
+    def commit(self, filename, index):
+        path = self._path(filename)
+        with self.sftp.open(path + INDEX_SUFFIX + '.part', 'wb') as remote:
+            remote.write(json.dumps(index).encode('utf-8'))
+        self.sftp.posix_rename(path + INDEX_SUFFIX + '.part',
+                               path + INDEX_SUFFIX)
+        self.sftp.posix_rename(path + '.part', path)
+
+    def abort(self, filename):
+        try:
+            self.sftp.remove(self._path(filename + '.part'))
+        except IOError:
+            pass
+
+
+def read_index(path: str) -> dict:
+    '''Return the index of a volume, or None if it has none'''
+    try:
+        with open(str(path) + INDEX_SUFFIX, 'r') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        raise VolumeError(f'unreadable index of {path}: {e}')
+
+
+def check_size(path: str, index: dict, offset: int) -> None:
+    '''
+    Compare the tar size of a volume in its index to the end of the last
+    member read, followed by the end of archive blocks and the padding of
+    the last record, as written by tarfile.
+    '''
+    end = offset + 2 * tarfile.BLOCKSIZE
+    size = -(-end // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+    if size != index['size']:
+        raise VolumeError(f'{path} is {size} bytes, its index lists '
+                          f'{index["size"]} bytes')
+
+
+def write_volumes(phoenix_root: str,
+                  file_list: Iterable,
+                  sink,
+                  name: str,
+                  codec: str = 'none',
+                  threads: int = 1,
+                  max_size: int = None,
+                  file_manifest=None) -> List[str]:
+    '''
+    Write files into tar volumes, each a complete tarball with an index
+
+    A new volume is started once the tar data of the current volume reaches
+    ``max_size`` bytes, before compression, so a volume is only larger than
+    ``max_size`` when a single file is. Each volume has an index listing its
+    files, which is written once the volume is complete, so the receiver can
+    process every volume on its own, and check that it is complete.
+
+    Key arguments:
+        phoenix_root: PHOENIX directory
+        file_list: file paths relative to parental directory of PHOENIX root.
+        sink: LocalSink or SFTPSink
+        name: name of the transfer, used as the prefix of the volumes, str.
+        codec: 'none', 'gzip' or 'zstd', str.
+        threads: number of compression threads, int.
+        max_size: maximum tar size of a volume in bytes, int.
+        file_manifest: only add the files that changed on the receiver,
+                       manifest.Manifest.
+
+    Returns:
+        names of the volumes written, list of str.
+    '''
+    if file_manifest is not None:
+        file_list = file_manifest.changed(file_list)
+
+    root_parent = Path(phoenix_root).parent
+    volumes = []
+    volume = None
+
+    def finish(volume):
+        if file_manifest is not None:
+            file_manifest.add_to_tar(volume['tar'], volume['files'])
+        volume['tar'].close()
+        if volume['compressor'] is not None:
+            volume['compressor'].close()
+        volume['fileobj'].close()
+        sink.commit(volume['filename'],
+                    {'name': name,
+                     'volume': volume['number'],
+                     'codec': codec,
+                     'size': volume['counter'].count,
+                     'files': volume['files']})
+        volumes.append(volume['filename'])
+
+    def start(number):
+        filename = f'{name}.{number:04d}{CODECS[codec]}'
+        fileobj = sink.open(filename)
+        compressor = open_compressor(fileobj, codec, threads)
+        counter = Counter(compressor or fileobj)
+        return {'number': number, 'filename': filename, 'files': [],
+                'fileobj': fileobj, 'compressor': compressor,
+                'counter': counter,
+                'tar': tarfile.open(fileobj=counter, mode='w|')}
+
+    try:
+        volume = start(1)
+        for file_path in file_list:
+            if volume['files'] and max_size and \
+                    volume['counter'].count >= max_size:
+                finish(volume)
+                volume = start(volume['number'] + 1)
+            if file_manifest is not None:
+                file_manifest.add_file(volume['tar'], file_path)
+            else:
+                volume['tar'].add(root_parent / file_path,
+                                  arcname=str(file_path))
+            volume['files'].append(str(file_path))
+        finish(volume)
+    except BaseException:
+        if volume is not None and volume['filename'] not in volumes:
+            if isinstance(volume['compressor'], Compressor):
+                volume['compressor'].proc.kill()
+            try:
+                volume['fileobj'].close()
+            except Exception:
+                pass
+            sink.abort(volume['filename'])
+        raise
+
+    logger.info(f'{name}: {len(volumes)} volumes written')
+    return volumes
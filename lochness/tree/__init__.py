@@ -4,6 +4,8 @@ import logging
 from pathlib import Path
 from string import Template
 import re
+import threading
+import functools
 
 
 Templates = {
@@ -79,11 +81,51 @@ Templates = {
 
 logger = logging.getLogger(__name__)
 
+Created = set()
+'''
+Folders created or found by get(), which are not looked up on disk again
+until they are forgotten.
+'''
+
 def get(data_type, base, **kwargs):
-    '''get phoenix folder for a subject and data_type'''
+    '''get phoenix folder for a subject and data_type
+
+    The folder is resolved once for each set of arguments, and created or
+    looked up on disk the first time it is returned. Use forget() after
+    removing a folder.
+    '''
     if data_type not in Templates:
         raise TreeError('no tree templates defined for {0}'.format(data_type))
 
+    processed = kwargs.get('processed', True)
+    try:
+        folder = _resolve(data_type, base, tuple(sorted(kwargs.items())))
+    except TypeError:
+        # unhashable arguments are resolved every time
+        folder = _resolve.__wrapped__(data_type, base,
+                                      tuple(sorted(kwargs.items())))
+
+    if kwargs.get('makedirs', True) and folder and folder not in Created:
+        if not os.path.exists(folder):
+            if processed:
+                logger.debug(f'creating processed folder {folder}')
+                os.makedirs(folder, exist_ok=True)
+                os.chmod(folder, 0o01777)
+            else:
+                logger.debug(f'creating raw folder {folder}')
+                os.makedirs(folder, exist_ok=True)
+        with get.lock:
+            Created.add(folder)
+    return folder
+
+
+get.lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=4096)
+def _resolve(data_type, base, kwargs):
+    '''resolve the raw or processed folder of a data_type'''
+    kwargs = dict(kwargs)
     raw_folder = None
     processed_folder = None
 
@@ -118,20 +160,26 @@ def get(data_type, base, **kwargs):
                     base=base, **kwargs)
 
     if kwargs.get('processed', True):
-        if kwargs.get('makedirs', True) and \
-                processed_folder and not os.path.exists(processed_folder):
-            logger.debug(f'creating processed folder {processed_folder}')
-            os.makedirs(processed_folder)
-            os.chmod(processed_folder, 0o01777)
         return processed_folder
     else:
-        if kwargs.get('makedirs', True) and \
-                raw_folder and not os.path.exists(raw_folder):
-            logger.debug(f'creating raw folder {raw_folder}')
-            os.makedirs(raw_folder)
         return raw_folder
 
 
+def forget(folder=None):
+    '''
+    Forget that a folder, and every folder under it, exists on disk, so the
+    next get() looks it up again. Forget every folder if folder is None.
+    '''
+    with get.lock:
+        if folder is None:
+            Created.clear()
+            return
+        prefix = os.path.join(str(folder), '')
+        for x in [x for x in Created
+                  if str(x) == str(folder) or str(x).startswith(prefix)]:
+            Created.discard(x)
+
+
 class TreeError(Exception):
     pass
 
@@ -7,6 +7,7 @@ import logging
 import tempfile as tf
 import collections as col
 import lochness.net as net
+import lochness.ratelimit as ratelimit
 import lochness.tree as tree
 import lochness.config as config
 
@@ -47,6 +48,7 @@ def sync(Lochness, subject, dry=False):
                 if not dry:
                     tmpdir = tf.mkdtemp(dir=dirname, prefix='.')
                     os.chmod(tmpdir, 0o0755)
+                    ratelimit.acquire('xnat')
                     yaxil.download(auth, experiment.label,
                                    project=experiment.project,
                                    scan_ids=['ALL'], out_dir=tmpdir,
@@ -93,6 +95,7 @@ def experiments(auth, uid):
     try:
         project,subject = uid
         logger.info('searching xnat for {0}'.format(uid))
+        ratelimit.acquire('xnat')
         xnat_subject = yaxil.subjects(auth, subject, project)
         xnat_subject = next(xnat_subject)
     except yaxil.exceptions.AccessionError as e:
@@ -102,6 +105,7 @@ def experiments(auth, uid):
     except yaxil.exceptions.NoSubjectsError as e:
         logger.info('no xnat subject registered for {0}'.format(uid))
         return
+    ratelimit.acquire('xnat')
     for experiment in yaxil.experiments(auth, subject=xnat_subject):
         yield experiment
 
@@ -25,12 +25,31 @@ def parse_args(args):
             required=True,
             default=8080,
             help='port number to listen')
-    
+
+    argparser.add_argument(
+            "--back_up_after_n_post", "-b",
+            type=int,
+            default=50,
+            help='Back up the database after this number of POST signals')
+
+    argparser.add_argument(
+            "--max_db_size_mb", "-m",
+            type=float,
+            default=None,
+            help='Compact the database to the lastest record of each '
+                 'subject once it grows larger than this size in MB. '
+                 'The full database is kept next to it with a timestamp.')
+
     return argparser.parse_args(args)
 
 
 if __name__ == '__main__':
     args = parse_args(sys.argv[1:])
 
+    max_db_bytes = int(args.max_db_size_mb * 1024 * 1024) \
+            if args.max_db_size_mb else None
+
     data_trigger_capture.run(args.database_csv,
-                             port=args.port)
+                             port=args.port,
+                             back_up_after_n_post=args.back_up_after_n_post,
+                             max_db_bytes=max_db_bytes)
@@ -9,6 +9,9 @@ import importlib
 import argparse as ap
 import lochness.config as config
 import lochness.daemon as daemon
+import lochness.functools as functools
+import lochness.executor as executor
+import lochness.tree as tree
 import lochness.hdd as HDD
 import lochness.xnat as XNAT
 import lochness.beiwe as Beiwe
@@ -63,6 +66,9 @@ def main():
                         default=SOURCES.keys(), help='Sources to sync')
     parser.add_argument('--continuous', action='store_true',
                         help='Continuously download data')
+    parser.add_argument('--dropbox-longpoll', action='store_true',
+                        help='In continuous mode, start the next poll as '
+                             'soon as a file changes on Dropbox')
     parser.add_argument('--studies', nargs='+', default=[],
                         help='Study to sync')
     parser.add_argument('--fork', action='store_true',
@@ -88,6 +94,12 @@ def main():
                         default=False,
                         help='Enable lochness to lochness transfer on the '
                              'server side')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of subject and source sync jobs to '
+                             'run at the same time')
+    parser.add_argument('--worker-type', choices=executor.EXECUTORS.keys(),
+                        default='thread',
+                        help='Run sync jobs in threads or processes')
     parser.add_argument('--debug', action='store_true',
                         help='Enable debug messages')
     args = parser.parse_args()
@@ -125,7 +137,10 @@ def main():
         while True:
             do(args, Lochness)
             logger.info('sleeping for {0} seconds'.format(Lochness['poll_interval']))
-            time.sleep(Lochness['poll_interval'])
+            if args.dropbox_longpoll:
+                Dropbox.wait_for_changes(Lochness, Lochness['poll_interval'])
+            else:
+                time.sleep(Lochness['poll_interval'])
     else:
         do(args, Lochness)
 
@@ -136,6 +151,10 @@ def do(args, Lochness):
         lochness_to_lochness_transfer_receive_sftp(Lochness)
         return True  # break the do function here for the receiving side
 
+    # values cached for a single run, e.g., REDCap exports, start fresh
+    functools.clear_run_caches()
+    tree.forget()
+
     # initialize (overwrite) metadata.csv using either REDCap or RPMS database
     if 'redcap' in args.input_sources or 'rpms' in args.input_sources:
 
@@ -146,17 +165,11 @@ def do(args, Lochness):
             # from multiple site
             lochness.initialize_metadata(Lochness, args, multiple_site_in_a_repo=True)
 
-    for subject in lochness.read_phoenix_metadata(Lochness, args.studies):
-        if not subject.active and args.skip_inactive:
-            logger.info(f'skipping inactive subject={subject.id}, '
-                        f'study={subject.study}')
-            continue
-        if args.hdd:
-            for Module in args.hdd:
-                lochness.attempt(Module.sync, Lochness, subject, dry=args.dry)
-        else:
-            for Module in args.source:
-                lochness.attempt(Module.sync, Lochness, subject, dry=args.dry)
+    executor.run(Lochness, sync_jobs(args, Lochness),
+                 workers=args.workers, kind=args.worker_type, dry=args.dry)
+
+    # caches shared by the sync jobs, e.g., Box listings, are saved once
+    functools.end_run()
 
     # transfer new files after all sync attempts are done
     if args.lochness_sync_send:
@@ -168,5 +181,20 @@ def do(args, Lochness):
             lochness_to_lochness_transfer_sftp(Lochness)
 
 
+def sync_jobs(args, Lochness):
+    '''generator for (Module, subject) sync jobs'''
+    for subject in lochness.read_phoenix_metadata(Lochness, args.studies):
+        if not subject.active and args.skip_inactive:
+            logger.info(f'skipping inactive subject={subject.id}, '
+                        f'study={subject.study}')
+            continue
+        if args.hdd:
+            for Module in args.hdd:
+                yield Module, subject
+        else:
+            for Module in args.source:
+                yield Module, subject
+
+
 if __name__ == '__main__':
     main()
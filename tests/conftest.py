@@ -0,0 +1,40 @@
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true', default=False,
+                     help='run the tests marked as benchmarks')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers',
+                            'benchmark: slow benchmark, run with --benchmark')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark'):
+        return
+    skip = pytest.mark.skip(reason='benchmark, run with --benchmark')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
+Benchmarks = []
+'''
+Results of the benchmarks, shown at the end of the run.
+'''
+
+
+@pytest.fixture
+def report_benchmark():
+    '''return a function adding a line to the benchmark results'''
+    return Benchmarks.append
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not Benchmarks:
+        return
+    terminalreporter.section('benchmarks')
+    for line in Benchmarks:
+        terminalreporter.write_line(line)
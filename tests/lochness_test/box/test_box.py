@@ -17,6 +17,7 @@ from lochness_create_template import create_lochness_template
 
 import pytest
 import string
+import boxsdk
 
 
 box_test_dir = test_dir / 'lochness_test/box'
@@ -459,3 +460,311 @@ def test_box_sync_module_no_redownload(args_and_Lochness_BIDS):
 
                         # with open(final_dir / file_name, 'w') as f:
                             # f.write('')
+
+
+class FakeBoxObject(object):
+    '''Box file or folder stand-in that counts get and get_items calls'''
+    calls = 0
+    gets = 0
+
+    def __init__(self, response_object, children=None):
+        self.__dict__.update(response_object)
+        self.object_id = response_object['id']
+        self.response_object = response_object
+        self.children = children or []
+        self.translator = self
+        self.session = None
+
+    def translate(self, session, response_object):
+        return FakeBoxObject(response_object)
+
+    def get(self, fields=None):
+        FakeBoxObject.gets += 1
+        return self
+
+    def get_items(self, fields=None):
+        FakeBoxObject.calls += 1
+        return iter(self.children)
+
+
+class FakeClient(object):
+    '''Box client stand-in over a dict of fake folders'''
+    def __init__(self, *folders):
+        self.folders = dict((x.object_id, x) for x in folders)
+
+    def folder(self, folder_id):
+        if folder_id not in self.folders:
+            raise boxsdk.BoxAPIException(404)
+        return self.folders[folder_id]
+
+
+def fake_folder(folder_id, name, etag, children):
+    return FakeBoxObject({'type': 'folder', 'id': folder_id, 'name': name,
+                          'etag': etag, 'content_modified_at': etag},
+                         children)
+
+
+def fake_file(file_id, name):
+    return FakeBoxObject({'type': 'file', 'id': file_id, 'name': name,
+                          'sha1': file_id})
+
+
+def test_walk_from_folder_object_listing_cache(tmpdir):
+    from lochness.box import walk_from_folder_object
+    from lochness.box.cache import ListingCache
+
+    cache_file = Path(tmpdir) / 'box' / 'listing.json'
+    listing_cache = ListingCache(str(cache_file))
+    sub = fake_folder('2', 'sub', '1', [fake_file('3', 'a.csv')])
+    top = fake_folder('1', 'top', '1', [sub, fake_file('4', 'b.csv')])
+
+    FakeBoxObject.calls = 0
+    first = [(root, [x.name for x in files])
+             for root, dirs, files in walk_from_folder_object(
+                 'top', top, listing_cache)]
+    assert FakeBoxObject.calls == 2
+
+    # unchanged tree is walked from the cache, also after reloading it
+    listing_cache.save()
+    listing_cache = ListingCache(str(cache_file))
+    second = [(root, [x.name for x in files])
+              for root, dirs, files in walk_from_folder_object(
+                  'top', top, listing_cache)]
+    assert FakeBoxObject.calls == 2
+    assert first == second == [('top', ['b.csv']), ('top/sub', ['a.csv'])]
+
+    # a changed signature lists the folder again
+    top.content_modified_at = '2'
+    list(walk_from_folder_object('top', top, listing_cache))
+    assert FakeBoxObject.calls == 3
+
+    # listings without a modification time are never cached
+    del top.content_modified_at
+    list(walk_from_folder_object('top', top, listing_cache))
+    list(walk_from_folder_object('top', top, listing_cache))
+    assert FakeBoxObject.calls == 5
+
+
+def test_listing_caches_saved_once_per_run(tmpdir, monkeypatch):
+    import lochness.functools as functools
+    import lochness.box.cache as cache
+    from lochness.box import walk_from_folder_object
+
+    writes = []
+    atomic_write = lochness.atomic_write
+    monkeypatch.setattr(lochness, 'atomic_write',
+                        lambda *x: writes.append(x[0]) or atomic_write(*x))
+    monkeypatch.setattr(cache, 'ListingCaches', dict())
+    Lochness = {'cache_dir': str(tmpdir)}
+    listing_cache = cache.listing_cache(Lochness, 'a')
+    top = fake_folder('1', 'top', '1', [fake_file('2', 'a.csv')])
+
+    for _ in range(3):
+        list(walk_from_folder_object('top', top, listing_cache))
+    functools.end_run()
+    assert writes == [listing_cache.path]
+
+    # unchanged caches are not written again
+    list(walk_from_folder_object('top', top, listing_cache))
+    functools.end_run()
+    assert writes == [listing_cache.path]
+
+
+def test_get_box_object_based_on_name_path_cache(tmpdir):
+    from lochness.box import get_box_object_based_on_name
+    from lochness.box.cache import PathCache
+
+    site = fake_folder('3', 'PronetLA', '1', [])
+    example = fake_folder('2', 'example', '1', [site])
+    root = fake_folder('0', '', '1', [example])
+    client = FakeClient(root, example, site)
+
+    cache_file = Path(tmpdir) / 'box' / 'paths.json'
+    path_cache = PathCache(str(cache_file))
+
+    FakeBoxObject.calls = 0
+    assert get_box_object_based_on_name(
+            client, '/example/PronetLA', '0', None, path_cache) is site
+    assert get_box_object_based_on_name(
+            client, 'PronetLA', '2', None, path_cache) is site
+    assert get_box_object_based_on_name(
+            client, 'missing', '2', None, path_cache) is None
+    assert FakeBoxObject.calls == 3
+
+    # resolved from the persisted cache without listing, but fetched for
+    # their signature
+    path_cache.save()
+    path_cache = PathCache(str(cache_file))
+    FakeBoxObject.gets = 0
+    assert get_box_object_based_on_name(
+            client, 'example/PronetLA', '0', None, path_cache) is site
+    assert FakeBoxObject.calls == 3
+    assert FakeBoxObject.gets == 2
+
+    # and fetched once per run
+    assert get_box_object_based_on_name(
+            client, 'example/PronetLA', '0', None, path_cache) is site
+    assert FakeBoxObject.gets == 2
+
+    # expired entries are resolved again
+    path_cache.ttl = -1
+    assert get_box_object_based_on_name(
+            client, 'example/PronetLA', '0', None, path_cache) is site
+    assert FakeBoxObject.calls == 5
+
+
+def test_path_caches_saved_at_end_of_run(tmpdir):
+    import os
+    import lochness.functools as functools
+    import lochness.box.cache as cache
+
+    functools.clear_run_caches()
+    path_cache = cache.path_cache({'cache_dir': str(tmpdir)}, 'a')
+    path_cache.put('0', 'example', '2')
+    assert not os.path.exists(path_cache.path)
+
+    functools.end_run()
+    assert cache.PathCache(path_cache.path).get('0', 'example') == '2'
+    functools.clear_run_caches()
+
+
+def test_get_box_object_based_on_name_moved_folder(tmpdir):
+    from lochness.box import get_box_object_based_on_name
+    from lochness.box.cache import PathCache
+
+    site = fake_folder('4', 'PronetLA', '1', [])
+    root = fake_folder('0', '', '1', [site])
+    client = FakeClient(root, site)
+
+    # a cached folder that is gone is resolved through the listing again
+    path_cache = PathCache()
+    path_cache.put('0', 'PronetLA', '3')
+    assert get_box_object_based_on_name(
+            client, 'PronetLA', '0', None, path_cache) is site
+    assert path_cache.get('0', 'PronetLA') == '4'
+
+
+def test_get_client_shared_within_run():
+    import lochness.functools as functools
+    from lochness.box import get_client, MAX_CONNECTIONS
+
+    functools.clear_run_caches()
+    client = get_client('id', 'secret', 'token')
+    assert get_client('id', 'secret', 'token') is client
+    assert get_client('id', 'secret', 'other_token') is not client
+
+    adapter = client.session._network_layer._session.adapters['https://']
+    assert adapter._pool_maxsize == MAX_CONNECTIONS
+
+    functools.clear_run_caches()
+    assert get_client('id', 'secret', 'token') is not client
+
+
+class FakeStream(object):
+    '''streaming response stand-in that records the largest read'''
+    def __init__(self, content, content_range=None):
+        self.content = content
+        self.status = 200 if content_range is None else 206
+        self.headers = {'Content-Range': content_range}
+        self.offset = 0
+        self.max_read = 0
+        self.closed = False
+
+    def read(self, n=-1):
+        n = len(self.content) if n is None or n < 0 else n
+        self.max_read = max(self.max_read, n)
+        chunk = self.content[self.offset:self.offset + n]
+        self.offset += len(chunk)
+        return chunk
+
+    def readinto(self, b):
+        chunk = self.read(len(b))
+        b[:len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBoxFile(object):
+    '''Box file stand-in serving its content as a stream'''
+    def __init__(self, content):
+        import hashlib
+        self.sha1 = hashlib.sha1(content).hexdigest()
+        self.stream = FakeStream(content)
+        self.session = self
+        self.headers = []
+
+    def get_url(self, *args):
+        return 'https://api.box.com/2.0/files/1/content'
+
+    def get(self, url, expect_json_response, stream, headers):
+        import types
+        self.headers.append(headers)
+        if headers is not None:
+            offset = int(headers['Range'][len('bytes='):].rstrip('-'))
+            content = self.stream.content
+            self.stream = FakeStream(
+                    content[offset:],
+                    f'bytes {offset}-{len(content) - 1}/{len(content)}')
+        return types.SimpleNamespace(network_response=types.SimpleNamespace(
+            response_as_stream=self.stream))
+
+
+@pytest.mark.parametrize('encrypt,compress', [(False, False), (True, True)])
+def test_save_streams_content(tmpdir, encrypt, compress):
+    import os
+    import cryptease as crypt
+    from lochness.box import save, verify, open_content, CHUNK_SIZE
+
+    content = os.urandom(CHUNK_SIZE * 20 + 10)
+    box_file = FakeBoxFile(content)
+    key = crypt.kdf('lochness') if encrypt else None
+    save(box_file, ('top', 'a.bin'), str(tmpdir), key=key, compress=compress)
+
+    ext = ('.lock' if encrypt else '') + ('.gz' if compress else '')
+    local_file = Path(tmpdir) / f'a.bin{ext}'
+    verify(str(local_file), box_file.sha1, key=key, compress=compress)
+    assert box_file.stream.closed
+    assert box_file.stream.max_read <= CHUNK_SIZE
+
+    open_content(box_file, (10, None))
+    assert box_file.headers[-1] == {'Range': 'bytes=10-'}
+
+
+def test_save_hash_mismatch(tmpdir):
+    from lochness.box import save, DownloadError
+
+    box_file = FakeBoxFile(b'content')
+    box_file.sha1 = 'not the sha1'
+    box_file.stream.content = b'content' * 3
+
+    with pytest.raises(DownloadError):
+        save(box_file, ('top', 'a.txt'), str(tmpdir), paranoid=True)
+    assert list(Path(tmpdir).iterdir()) == []
+
+
+def test_save_resumes_large_files(tmpdir, monkeypatch):
+    import os
+    import lochness.resume as resume
+    from lochness.box import save, verify
+    from lochness.resume import Part
+
+    monkeypatch.setattr(resume, 'MIN_SIZE', 100)
+    content = os.urandom(1000)
+    box_file = FakeBoxFile(content)
+    box_file.object_id = '1'
+    box_file.size = len(content)
+
+    # a part file left by an earlier run
+    local_file = Path(tmpdir) / 'a.bin.gz'
+    part = Part(str(local_file), '1', box_file.sha1, len(content))
+    part.offset()
+    with open(part.path, 'wb') as f:
+        f.write(content[:400])
+
+    save(box_file, ('top', 'a.bin'), str(tmpdir), compress=True)
+
+    assert box_file.headers == [{'Range': 'bytes=400-'}]
+    verify(str(local_file), box_file.sha1, compress=True)
+    assert os.listdir(tmpdir) == ['a.bin.gz']
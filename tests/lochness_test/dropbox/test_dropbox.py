@@ -0,0 +1,193 @@
+from lochness.dropbox import combine_blocks
+from lochness.dropbox.hash import DropboxContentHasher
+
+import os
+import hashlib
+
+
+def test_combine_blocks():
+    content = os.urandom(DropboxContentHasher.BLOCK_SIZE * 2 + 10)
+    hasher = DropboxContentHasher()
+    hasher.update(content)
+
+    size = DropboxContentHasher.BLOCK_SIZE
+    blocks = [hashlib.sha256(content[x:x + size]).digest()
+              for x in range(0, len(content), size)]
+    assert combine_blocks(blocks).hexdigest() == hasher.hexdigest()
+
+
+class FakeDropbox(object):
+    '''Dropbox client stand-in serving pages of list_folder results'''
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def files_list_folder(self, path, recursive=False):
+        self.calls.append(('list', path, recursive))
+        return self.pages[path]
+
+    def files_list_folder_continue(self, cursor):
+        self.calls.append(('continue', cursor))
+        return self.pages[cursor]
+
+
+def file_md(path):
+    import datetime
+    import dropbox
+    now = datetime.datetime(2021, 1, 1)
+    return dropbox.files.FileMetadata(
+            name=os.path.basename(path), path_lower=path.lower(),
+            path_display=path, id='id:1', client_modified=now,
+            server_modified=now, rev='0123456789', size=1)
+
+
+def folder_md(path):
+    import dropbox
+    return dropbox.files.FolderMetadata(
+            name=os.path.basename(path), path_lower=path.lower(),
+            path_display=path, id='id:2')
+
+
+def deleted_md(path):
+    import dropbox
+    return dropbox.files.DeletedMetadata(
+            name=os.path.basename(path), path_lower=path.lower(),
+            path_display=path)
+
+
+def page(entries, cursor, has_more=False):
+    import dropbox
+    return dropbox.files.ListFolderResult(
+            entries=entries, cursor=cursor, has_more=has_more)
+
+
+def test_walk_follows_has_more():
+    from lochness.dropbox import walk
+
+    client = FakeDropbox({
+        '/top': page([file_md('/top/a.csv')], 'c1', has_more=True),
+        'c1': page([folder_md('/top/Sub')], 'c2'),
+        '/top/Sub': page([file_md('/top/Sub/b.csv')], 'c3')})
+
+    assert list(walk(client, '/top')) == [('/top', ['Sub'], ['a.csv']),
+                                          ('/top/Sub', [], ['b.csv'])]
+
+
+def test_walk_with_cursor(tmpdir):
+    from lochness.dropbox import walk
+    from lochness.dropbox.cursor import CursorStore
+
+    cursor_file = str(tmpdir / 'dropbox' / 'cursors.json')
+    cursors = CursorStore(cursor_file)
+    client = FakeDropbox({
+        '/top': page([folder_md('/top'),
+                      file_md('/top/a.csv'),
+                      folder_md('/top/Sub')], 'c1', has_more=True),
+        'c1': page([file_md('/top/Sub/b.csv')], 'c2'),
+        'c2': page([deleted_md('/top/Sub'),
+                    file_md('/top/c.csv')], 'c3'),
+        'c3': page([], 'c3')})
+
+    assert list(walk(client, '/top', cursors)) == [
+            ('/top', ['Sub'], ['a.csv']),
+            ('/top/Sub', [], ['b.csv'])]
+    assert client.calls == [('list', '/top', True), ('continue', 'c1')]
+
+    # the next walk only asks for the changes, also after a restart
+    cursors.save()
+    cursors = CursorStore(cursor_file)
+    assert list(walk(client, '/top', cursors)) == [
+            ('/top', [], ['a.csv', 'c.csv'])]
+    assert client.calls[2:] == [('continue', 'c2')]
+
+    assert list(walk(client, '/top', cursors)) == [
+            ('/top', [], ['a.csv', 'c.csv'])]
+    assert client.calls[3:] == [('continue', 'c3')]
+
+
+def test_save_indexes_files_on_disk_without_id(tmpdir):
+    from lochness.dropbox import save
+    from lochness.index import FileIndex
+
+    index = FileIndex(str(tmpdir / 'index' / 'files.db'))
+    out_base = tmpdir / 'out'
+    out_base.mkdir()
+    (out_base / 'a.csv').write('a')
+
+    save(None, ('/top', 'a.csv'), str(out_base), index=index)
+    assert index.get(str(out_base / 'a.csv'))['remote_id'] is None
+
+
+def test_walk_with_cursor_mixed_case(tmpdir):
+    from lochness.dropbox import walk
+    from lochness.dropbox.cursor import CursorStore
+
+    cursors = CursorStore(str(tmpdir / 'dropbox' / 'cursors.json'))
+    # the entries of a folder may be listed with a different case
+    client = FakeDropbox({
+        '/top': page([folder_md('/top/Sub'),
+                      file_md('/top/sub/b.csv'),
+                      file_md('/TOP/SUB/c.csv')], 'c1')})
+
+    assert list(walk(client, '/top', cursors)) == [
+            ('/top', ['Sub'], []),
+            ('/top/Sub', [], ['b.csv', 'c.csv'])]
+
+
+class FakeLongpoll(object):
+    '''Dropbox client stand-in reporting a change on the second longpoll'''
+    def __init__(self):
+        self.calls = 0
+
+    def files_list_folder_get_latest_cursor(self, path, recursive=False):
+        import dropbox
+        return dropbox.files.ListFolderGetLatestCursorResult(cursor='c1')
+
+    def files_list_folder_longpoll(self, cursor, timeout=30):
+        import dropbox
+        self.calls += 1
+        return dropbox.files.ListFolderLongpollResult(
+                changes=self.calls > 1)
+
+
+def test_wait_for_changes(monkeypatch):
+    import threading
+    import lochness.dropbox
+
+    clients = dict()
+    monkeypatch.setattr(lochness.dropbox, 'get_client',
+                        lambda x: clients.setdefault(x, FakeLongpoll()))
+    Lochness = {'keyring': {'dropbox.a': {'API_TOKEN': 'a'},
+                            'dropbox.b': {'API_TOKEN': 'b'},
+                            'box.c': {'API_TOKEN': 'c'}}}
+
+    threads = threading.active_count()
+    assert lochness.dropbox.wait_for_changes(Lochness, 60)
+    assert sorted(clients) == ['a', 'b']
+    assert threading.active_count() == threads
+
+
+def test_cursor_stores_saved_once_per_run(tmpdir, monkeypatch):
+    import lochness
+    import lochness.functools as functools
+    import lochness.dropbox.cursor as cursor
+    from lochness.dropbox import walk
+
+    writes = []
+    atomic_write = lochness.atomic_write
+    monkeypatch.setattr(lochness, 'atomic_write',
+                        lambda *x: writes.append(x[0]) or atomic_write(*x))
+    monkeypatch.setattr(cursor, 'CursorStores', dict())
+    cursors = cursor.get({'cache_dir': str(tmpdir)}, 'a')
+    client = FakeDropbox({'/top': page([file_md('/top/a.csv')], 'c1'),
+                          'c1': page([], 'c1')})
+
+    for _ in range(3):
+        list(walk(client, '/top', cursors))
+    functools.end_run()
+    assert writes == [cursors.path]
+
+    # unchanged cursors are not written again
+    list(walk(client, '/top', cursors))
+    functools.end_run()
+    assert writes == [cursors.path]
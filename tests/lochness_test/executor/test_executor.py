@@ -0,0 +1,178 @@
+import lochness
+import lochness.executor as executor
+from lochness.executor import run, concurrency_caps, source_name
+from lochness.executor import DownloadQueue, download_workers
+
+import sys
+import time
+import threading
+import collections as col
+import pytest
+
+
+Subject = col.namedtuple('Subject', ['study', 'id'])
+
+
+class FakeSource(object):
+    '''sync module stand-in that records how many syncs overlap'''
+    def __init__(self, name, fail=False):
+        self.__name__ = f'lochness.{name}'
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.synced = []
+
+    def sync(self, Lochness, subject, dry=False):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.01)
+        with self.lock:
+            self.running -= 1
+            self.synced.append(subject.id)
+        if self.fail:
+            raise Exception(f'failed {subject.id}')
+
+
+def sync(Lochness, subject, dry=False):
+    '''used as a module level sync function for the process executor'''
+    if subject.id.endswith('1'):
+        raise Exception(f'failed {subject.id}')
+
+
+@pytest.fixture(autouse=True)
+def reset_warnings():
+    lochness.attempt.warnings = []
+    yield
+    lochness.attempt.warnings = []
+
+
+def test_source_name():
+    assert source_name(FakeSource('box')) == 'box'
+    assert source_name(FakeSource('dropbox.mclean')) == 'dropbox'
+
+
+def test_concurrency_caps():
+    Lochness = {'concurrency': {'box': 2, 'redcap': 'many', 'xnat': 0}}
+    assert concurrency_caps(Lochness) == {'box': 2}
+    assert concurrency_caps({}) == {}
+
+
+def test_run_serial():
+    box = FakeSource('box')
+    subjects = [Subject('StudyA', f'{x}') for x in range(5)]
+    run({}, [(box, x) for x in subjects], workers=1)
+
+    assert box.synced == [x.id for x in subjects]
+    assert box.max_running == 1
+
+
+def test_run_threads_with_caps():
+    box = FakeSource('box')
+    redcap = FakeSource('redcap')
+    subjects = [Subject('StudyA', f'{x}') for x in range(20)]
+    jobs = [(module, subject) for subject in subjects
+            for module in [box, redcap]]
+    Lochness = {'concurrency': {'box': 2}}
+
+    run(Lochness, jobs, workers=8, kind='thread')
+
+    assert sorted(box.synced) == sorted(x.id for x in subjects)
+    assert sorted(redcap.synced) == sorted(x.id for x in subjects)
+    assert box.max_running <= 2
+    assert redcap.max_running > 2
+
+
+def test_run_threads_collects_warnings():
+    box = FakeSource('box', fail=True)
+    subjects = [Subject('StudyA', f'{x}') for x in range(4)]
+    run({}, [(box, x) for x in subjects], workers=4, kind='thread')
+
+    assert sorted(lochness.attempt.warnings) == \
+            sorted(f'failed {x.id}' for x in subjects)
+
+
+def test_run_processes_collects_warnings():
+    module = sys.modules[__name__]
+    subjects = [Subject('StudyA', f'{x}') for x in ['1', '2', '11']]
+    run({}, [(module, x) for x in subjects], workers=2, kind='process')
+
+    assert sorted(lochness.attempt.warnings) == ['failed 1', 'failed 11']
+
+
+def test_run_threads_bounds_deferred_jobs(monkeypatch):
+    monkeypatch.setattr(executor, 'MAX_DEFERRED', 3)
+    box = FakeSource('box')
+    pulled = []
+    outstanding = []
+
+    def jobs():
+        for x in range(30):
+            pulled.append(x)
+            outstanding.append(len(pulled) - len(box.synced))
+            yield box, Subject('StudyA', f'{x}')
+
+    run({'concurrency': {'box': 1}}, jobs(), workers=4, kind='thread')
+
+    assert len(box.synced) == 30
+    # one running, MAX_DEFERRED kept aside, and the one being pulled
+    assert max(outstanding) <= 1 + 3 + 1
+
+
+def test_attempt_warnings_sent_without_lock(monkeypatch):
+    sent = []
+
+    def attempts_error(Lochness, attempt):
+        assert not lochness.attempt.lock.locked()
+        sent.append(list(attempt.warnings))
+    monkeypatch.setattr(lochness.email, 'attempts_error', attempts_error)
+
+    lochness.attempt.warnings = [f'warning {x}' for x in range(5)]
+    lochness.attempt(lambda Lochness: None, {})
+    assert sent == [[f'warning {x}' for x in range(5)]]
+    assert lochness.attempt.warnings == []
+
+
+def test_run_unknown_kind():
+    with pytest.raises(executor.ExecutorError):
+        run({}, [], workers=2, kind='fiber')
+
+
+def test_download_workers():
+    Lochness = {'download_workers': {'box': 4, 'dropbox': 'many'}}
+    assert download_workers(Lochness, 'box') == 4
+    assert download_workers(Lochness, 'dropbox') == 1
+    assert download_workers({}, 'box') == 1
+
+
+def test_download_queue_bounded():
+    box = FakeSource('box')
+    submitted = []
+    with DownloadQueue(workers=3, backlog=2) as downloads:
+        for x in range(20):
+            downloads.submit(box.sync, {}, Subject('StudyA', f'{x}'))
+            submitted.append(x)
+            # the walk never runs more than workers + backlog files ahead
+            assert len(submitted) - len(box.synced) <= 5
+
+    assert sorted(box.synced) == sorted(f'{x}' for x in range(20))
+    assert 1 < box.max_running <= 3
+
+
+def test_download_queue_inline():
+    box = FakeSource('box')
+    with DownloadQueue(workers=1) as downloads:
+        downloads.submit(box.sync, {}, Subject('StudyA', '1'))
+        assert box.synced == ['1']
+
+
+def test_download_queue_error():
+    box = FakeSource('box', fail=True)
+    with pytest.raises(Exception, match='failed'):
+        with DownloadQueue(workers=2) as downloads:
+            for x in range(100):
+                downloads.submit(box.sync, {}, Subject('StudyA', f'{x}'))
+
+    # the queue stops after the first failed download
+    assert len(box.synced) < 100
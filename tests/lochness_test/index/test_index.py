@@ -0,0 +1,84 @@
+import lochness.index as fileindex
+from lochness.index import FileIndex
+
+import os
+import time
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def reset_indexes():
+    fileindex.Indexes.clear()
+    yield
+    fileindex.Indexes.clear()
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'w').close()
+
+
+def test_exists_uses_index(tmpdir, monkeypatch):
+    saved = str(tmpdir / 'PHOENIX' / 'a.csv')
+    touch(saved)
+    index = FileIndex(str(tmpdir / 'cache' / 'files.sqlite'))
+
+    assert index.exists(saved, remote_id='id:1', size=0)
+    assert not index.exists(str(tmpdir / 'PHOENIX' / 'b.csv'))
+    assert index.get(saved)['remote_id'] == 'id:1'
+
+    # indexed files are not looked up on disk anymore
+    def no_stat(path):
+        raise AssertionError(f'stat {path}')
+    monkeypatch.setattr(os.path, 'exists', no_stat)
+    assert index.exists(saved)
+
+
+def test_index_is_persisted(tmpdir):
+    saved = str(tmpdir / 'PHOENIX' / 'a.csv')
+    touch(saved)
+    path = str(tmpdir / 'cache' / 'files.sqlite')
+    index = FileIndex(path)
+    index.add(saved, 'id:1', 10, 'abc')
+    index.close()
+
+    index = FileIndex(path)
+    assert saved in index
+    assert index.get(saved)['content_hash'] == 'abc'
+
+
+def test_reconcile(tmpdir):
+    kept = str(tmpdir / 'PHOENIX' / 'a.csv')
+    removed = str(tmpdir / 'PHOENIX' / 'b.csv')
+    gone = str(tmpdir / 'PHOENIX' / 'sub' / 'c.csv')
+    for x in [kept, removed, gone]:
+        touch(x)
+    index = FileIndex(str(tmpdir / 'cache' / 'files.sqlite'),
+                      reconcile_interval=3600)
+    for x in [kept, removed, gone]:
+        index.add(x)
+
+    os.remove(removed)
+    os.remove(gone)
+    os.rmdir(os.path.dirname(gone))
+
+    # not due yet
+    index.last_reconciled = time.time()
+    index.reconcile_if_due()
+    assert removed in index
+
+    index.last_reconciled = 0
+    index.reconcile_if_due()
+    assert kept in index
+    assert removed not in index and index.get(removed) is None
+    assert gone not in index
+
+
+def test_get(tmpdir):
+    assert fileindex.get({}, 'box', 'xxxxx') is None
+    assert fileindex.exists(None, str(tmpdir)) is True
+
+    Lochness = {'cache_dir': str(tmpdir)}
+    index = fileindex.get(Lochness, 'box', 'xxxxx')
+    assert index is fileindex.get(Lochness, 'box', 'xxxxx')
+    assert index.path == str(tmpdir / 'box' / 'xxxxx_files.sqlite')
@@ -1,6 +1,7 @@
 import lochness
 from pathlib import Path
-from lochness.keyring import print_keyring
+from lochness.keyring import print_keyring, encryption_key
+import lochness.functools as functools
 
 import sys
 lochness_root = Path(lochness.__path__[0]).parent
@@ -15,3 +16,14 @@ def test_read_phoenix_data(Lochness):
     print_keyring(Lochness)
     show_tree_then_delete('tmp_lochness')
 
+
+def test_encryption_key_derived_once_per_run():
+    Lochness = {'keyring': {'lochness': {'SECRETS': {'StudyA': 'lochness',
+                                                     'StudyB': 'lochness'}}}}
+    functools.clear_run_caches()
+    key = encryption_key(Lochness, 'StudyA')
+    assert encryption_key(Lochness, 'StudyA') is key
+    assert encryption_key(Lochness, 'StudyB') is key
+
+    functools.clear_run_caches()
+    assert encryption_key(Lochness, 'StudyA') is not key
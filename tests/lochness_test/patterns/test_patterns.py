@@ -0,0 +1,100 @@
+import lochness.patterns as patterns
+from lochness.dropbox import mclean, nrg
+
+import re
+import time
+import string
+import pytest
+
+
+def find_product_loop(s, products, **kwargs):
+    '''file routing as done before the patterns were compiled'''
+    for product in products:
+        pattern = product['pattern'].safe_substitute(**kwargs)
+        pattern = re.sub(r'\*', '.*', pattern)
+        if re.match(pattern, s):
+            return product
+    return None
+
+
+def box_products():
+    return [{'product': 'actigraphy',
+             'pattern': string.Template('GENEActiv/${subject}_*.bin')},
+            {'product': 'csv', 'pattern': string.Template('*csv')},
+            {'product': 'groups',
+             'pattern': string.Template('(a|b)(c(d))/*.txt')},
+            {'product': 'txt', 'pattern': string.Template('*.txt')}]
+
+
+def test_first_matching_product():
+    matcher = patterns.compile(box_products(), glob=True, subject='S01')
+    assert matcher.regex is not None
+
+    assert matcher('GENEActiv/S01_wrist.bin')['product'] == 'actigraphy'
+    assert matcher('GENEActiv/S02_wrist.bin') is None
+    assert matcher('GENEActiv/S01_wrist.csv')['product'] == 'csv'
+    assert matcher('bcd/notes.txt')['product'] == 'groups'
+    assert matcher('xcd/notes.txt')['product'] == 'txt'
+    assert matcher('notes.pdf') is None
+
+
+def test_matches_one_by_one_with_backreference():
+    products = [{'product': 'twice', 'pattern': string.Template(r'(\w)\1')},
+                {'product': 'any', 'pattern': string.Template('.')}]
+    matcher = patterns.compile(products)
+    assert matcher.regex is None
+
+    assert matcher('aa')['product'] == 'twice'
+    assert matcher('ab')['product'] == 'any'
+
+
+def test_strict_substitution():
+    products = [{'product': 'x', 'pattern': string.Template('${visit}_.*')}]
+    with pytest.raises(KeyError):
+        patterns.compile(products, strict=True, subject='S01')
+    assert patterns.compile(products, subject='S01')('${visit}_1') is None
+
+
+def test_dropbox_configs():
+    for module, strict in [(nrg, True), (mclean, False)]:
+        for products in module.CONFIG.values():
+            matcher = patterns.compile(products, strict=strict, subject='S01')
+            for name in ['S01_a.csv', 'GENEActiv/S01_a.bin', 'S01_Zoom.mp4',
+                         'S01_a.mov', 'S02_a.csv', 'notes.txt']:
+                assert matcher(name) is find_product_loop(
+                        name, products, subject='S01')
+
+
+def benchmark_names():
+    '''file names of the benchmark, half of them matching a product'''
+    return [f'GENEActiv/S{x % 100:02d}_{x}.{ext}'
+            for x in range(5000) for ext in ['bin', 'pdf']]
+
+
+def test_matcher_routes_as_loop():
+    products = box_products() * 5
+    names = benchmark_names()
+    matcher = patterns.compile(products, glob=True, subject='S01')
+    assert all(matcher(x) is find_product_loop(x, products, subject='S01')
+               for x in names)
+
+
+@pytest.mark.benchmark
+def test_benchmark(report_benchmark):
+    products = box_products() * 5
+    names = benchmark_names()
+
+    start = time.perf_counter()
+    for x in names:
+        find_product_loop(x, products, subject='S01')
+    loop = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matcher = patterns.compile(products, glob=True, subject='S01')
+    for x in names:
+        matcher(x)
+    compiled = time.perf_counter() - start
+
+    report_benchmark(f'patterns: {len(names)} names routed through '
+                     f'{len(products)} products in {loop:.3f}s with a loop, '
+                     f'{compiled:.3f}s with a compiled matcher')
@@ -0,0 +1,69 @@
+import lochness.ratelimit as ratelimit
+from lochness.ratelimit import TokenBucket, RateLimitError
+
+import time
+import threading
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def reset_buckets():
+    ratelimit.Buckets.clear()
+    yield
+    ratelimit.Buckets.clear()
+
+
+def test_token_bucket_burst_then_rate():
+    bucket = TokenBucket(rate=20, capacity=5)
+
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.05
+
+    # the next five tokens refill at 20 per second
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.2
+
+
+def test_token_bucket_threads():
+    bucket = TokenBucket(rate=50, capacity=1)
+    start = time.monotonic()
+
+    threads = [threading.Thread(target=bucket.acquire) for _ in range(11)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert time.monotonic() - start >= 0.2
+
+
+def test_token_bucket_bad_values():
+    with pytest.raises(RateLimitError):
+        TokenBucket(rate=0)
+
+    with pytest.raises(RateLimitError):
+        TokenBucket(rate=1, capacity=2).acquire(3)
+
+
+def test_configure():
+    Lochness = {'rate_limits': {'box': 10,
+                                'redcap': {'rate': 5, 'burst': 20}}}
+    ratelimit.configure(Lochness)
+
+    assert ratelimit.Buckets['box'].rate == 10
+    assert ratelimit.Buckets['box'].capacity == 10
+    assert ratelimit.Buckets['redcap'].capacity == 20
+
+    with pytest.raises(RateLimitError):
+        ratelimit.configure({'rate_limits': {'box': 'fast'}})
+
+
+def test_acquire_without_limit():
+    ratelimit.configure({})
+    start = time.monotonic()
+    for _ in range(1000):
+        ratelimit.acquire('box')
+    assert time.monotonic() - start < 0.5
@@ -0,0 +1,78 @@
+from lochness.redcap import metadata_records, merge_metadata_records
+
+import time
+import pytest
+import pandas as pd
+
+
+def make_records(n):
+    '''n REDCap records of n / 2 subjects, each with two arms'''
+    return pd.DataFrame([{'chric_subject_id': f'AB{x // 2:05d}',
+                          'chric_consent_date': '2021-01-01' if x % 2 else '',
+                          'box_id': f'box.a:{x // 2}' if x % 2 == 0 else None,
+                          'xnat_id': f'xnat.a:P:{x // 2}'}
+                         for x in range(n)], dtype=object)
+
+
+def test_metadata_records():
+    records = pd.DataFrame([
+        {'id': 'AB1', 'consent': '2021-01-01', 'box_id': 'box.a:1'},
+        {'id': 'AB1', 'xnat_id': 'xnat.a:P:1'},
+        {'id': 'CD2', 'consent': '2021-01-02', 'dropbox_id': 'dropbox.a:2'},
+        {'id': 'AB0', 'consent': '2021-01-03'}], dtype=object)
+
+    df = metadata_records(records, 'StudyA_AB', 'id', 'consent', True)
+    assert df['Subject ID'].tolist() == ['AB1', 'AB1', 'AB0']
+    assert df['Consent'].tolist()[::2] == ['2021-01-01', '2021-01-03']
+    assert pd.isna(df['Consent'].tolist()[1])
+    # the dropbox id is only found in a record of another site
+    assert 'Drpbox' not in df
+
+    df_final = merge_metadata_records(df)
+    assert df_final.columns.tolist() == ['Active', 'Consent', 'Subject ID',
+                                         'XNAT', 'Box']
+    assert df_final.to_dict('records') == [
+        {'Active': 1, 'Consent': '2021-01-03', 'Subject ID': 'AB0',
+         'XNAT': None, 'Box': None},
+        {'Active': 1, 'Consent': '2021-01-01', 'Subject ID': 'AB1',
+         'XNAT': 'xnat.a:P:1', 'Box': 'box.a:1'}]
+
+
+def test_metadata_records_without_consent():
+    records = pd.DataFrame([{'id': '1'}, {'id': '2'}], dtype=object)
+    df = metadata_records(records, 'StudyA', 'id', 'consent', False)
+    assert 'Consent' not in df
+    assert merge_metadata_records(df)['Consent'].tolist() == \
+        ['1988-09-16', '1988-09-16']
+
+
+def test_metadata_records_of_two_measures():
+    # RPMS measures, the first without the consent date of AB1
+    measures = [
+        pd.DataFrame([{'id': 'AB1', 'consent': None, 'box_id': 'box.a:1'},
+                      {'id': 'AB2', 'consent': None}], dtype=object),
+        pd.DataFrame([{'id': 'AB1', 'consent': '2022-02-02'},
+                      {'id': 'AB2'}], dtype=object)]
+    df = pd.concat([metadata_records(x, 'StudyA_AB', 'id', 'consent', True)
+                    for x in measures])
+
+    df_final = merge_metadata_records(df)
+    assert df_final[['Subject ID', 'Consent', 'Box']].to_dict('records') == [
+        {'Subject ID': 'AB1', 'Consent': '2022-02-02', 'Box': 'box.a:1'},
+        {'Subject ID': 'AB2', 'Consent': '1988-09-16', 'Box': None}]
+
+
+@pytest.mark.benchmark
+def test_benchmark(report_benchmark):
+    for n in [5000, 50000]:
+        records = make_records(n)
+        start = time.perf_counter()
+        df_final = merge_metadata_records(metadata_records(
+            records, 'StudyA_AB', 'chric_subject_id', 'chric_consent_date',
+            True))
+        elapsed = time.perf_counter() - start
+        report_benchmark(f'metadata records: {n} records merged into '
+                         f'{len(df_final)} subjects in {elapsed:.3f}s')
+
+        assert len(df_final) == n // 2
+        assert df_final['Box'].notna().all()
@@ -273,3 +273,161 @@ def test_sync_det_update_while_diff_file_leads_to_data_overwrite(
     assert {'test': 'test'} != new_content_dict
     rmtree('tmp_lochness')
 
+
+
+@pytest.fixture
+def fake_redcap_api(monkeypatch):
+    '''replace post_to_redcap with a fake REDCap project'''
+    metadata = [{'field_name': 'record_id', 'identifier': ''},
+                {'field_name': 'name', 'identifier': 'y'},
+                {'field_name': 'score', 'identifier': ''}]
+    records = [{'record_id': 'subject_1', 'name': 'a', 'score': '1'},
+               {'record_id': 'subject_1', 'name': 'a', 'score': '2'},
+               {'record_id': 'subject_2', 'name': 'b', 'score': '3'}]
+    posts = []
+
+    def post_to_redcap(api_url, data, debug_tup):
+        posts.append(data)
+        if data['content'] == 'metadata':
+            return json.dumps(metadata).encode()
+        fields = data.get('fields', 'record_id,name,score').split(',')
+        return json.dumps([{k: v for k, v in x.items() if k in fields}
+                           for x in records]).encode()
+
+    monkeypatch.setattr(lochness.redcap, 'post_to_redcap', post_to_redcap)
+    lochness.functools.clear_run_caches()
+    yield posts
+    lochness.functools.clear_run_caches()
+
+
+def test_export_project_records_once_per_run(fake_redcap_api):
+    from lochness.redcap import export_project_records, subject_content
+    posts = fake_redcap_api
+
+    for subject in ['subject_1', 'subject_2', 'subject_3']:
+        records = export_project_records('https://url/api/', 'token', False)
+        content = subject_content(records, subject)
+
+    # one metadata and one record request for every subject
+    assert len(posts) == 2
+    assert [x['record_id'] for x in records['subject_1']] == \
+            ['subject_1', 'subject_1']
+    assert json.loads(subject_content(records, 'subject_2')) == \
+            [{'record_id': 'subject_2', 'name': 'b', 'score': '3'}]
+    assert subject_content(records, 'subject_3') == b'[]'
+
+    # a new run exports again
+    lochness.functools.clear_run_caches()
+    export_project_records('https://url/api/', 'token', False)
+    assert len(posts) == 4
+
+
+def test_export_project_records_deidentify(fake_redcap_api):
+    from lochness.redcap import export_project_records
+    from lochness.redcap import deidentified_field_names
+    posts = fake_redcap_api
+
+    records = export_project_records('https://url/api/', 'token', True)
+    assert records['subject_2'] == [{'record_id': 'subject_2', 'score': '3'}]
+
+    # metadata is only pulled once per run
+    deidentified_field_names('https://url/api/', 'token')
+    assert [x['content'] for x in posts] == ['metadata', 'record']
+
+
+def test_data_entry_trigger_index(tmp_path):
+    from lochness.redcap import get_data_entry_trigger_index
+    from lochness.redcap import check_if_modified
+    lochness.functools.clear_run_caches()
+
+    db_loc = tmp_path / 'det.csv'
+    pd.DataFrame({'timestamp': [100.0, 300.0, 200.0],
+                  'record': ['subject_1', 'subject_1', 1001]}).to_csv(db_loc)
+    Lochness = {'redcap': {'data_entry_trigger_csv': str(db_loc)}}
+
+    det_index = get_data_entry_trigger_index(Lochness)
+    assert det_index == {'subject_1': 300.0, '1001': 200.0}
+
+    # the csv is only read once per run
+    os.remove(db_loc)
+    assert get_data_entry_trigger_index(Lochness) is det_index
+
+    existing_json = tmp_path / 'subject_1.StudyA.json'
+    existing_json.touch()
+    os.utime(existing_json, (250, 250))
+    assert check_if_modified('subject_1', existing_json, det_index)
+    assert not check_if_modified('1001', existing_json, det_index)
+    assert not check_if_modified('subject_2', existing_json, det_index)
+
+    lochness.functools.clear_run_caches()
+    assert get_data_entry_trigger_index(Lochness) == {}
+    assert get_data_entry_trigger_index({}) == {}
+
+
+def det_post_body(record):
+    return "redcap_url=https%3A%2F%2Fredcap.partners.org%2Fredcap%2F&project_url=https%3A%2F%2Fredcap.partners.org%2Fredcap%2Fredcap_v10.0.30%2Findex.php%3Fpid%3D26709&project_id=26709&username=kc244&record=" + record + "&instrument=inclusionexclusion_checklist&inclusionexclusion_checklist_complete=0"
+
+
+def test_save_post_from_redcap_concurrent(tmp_path):
+    import threading
+    from lochness.redcap.data_trigger_capture import latest_timestamps
+    db_loc = tmp_path / 'det.csv'
+
+    threads = [threading.Thread(target=save_post_from_redcap,
+                                args=(det_post_body(f'subject_{x % 5}'),
+                                      db_loc))
+               for x in range(100)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    db_df = pd.read_csv(db_loc, index_col=0)
+    assert len(db_df) == 100
+    assert list(db_df.columns) == ['timestamp', 'project_url', 'project_id',
+                                   'redcap_username', 'record', 'instrument']
+    assert db_df.project_url.iloc[0] == \
+        'https://redcap.partners.org/redcap/redcap_v10.0.30/index.php?pid=26709'
+
+    latest = latest_timestamps(db_loc)
+    assert sorted(latest) == [f'subject_{x}' for x in range(5)]
+    for record, timestamp in latest.items():
+        assert timestamp == db_df[db_df.record == record].timestamp.max()
+
+
+def test_back_up_db_appends_new_records(tmp_path):
+    db_loc = tmp_path / 'det.csv'
+    backup = tmp_path / '.back_det.csv'
+
+    save_post_from_redcap(det_post_body('subject_1'), db_loc)
+    back_up_db(db_loc)
+    assert backup.read_bytes() == db_loc.read_bytes()
+
+    save_post_from_redcap(det_post_body('subject_2'), db_loc)
+    back_up_db(db_loc)
+    assert backup.read_bytes() == db_loc.read_bytes()
+
+    # nothing new to back up
+    back_up_db(db_loc)
+    assert backup.read_bytes() == db_loc.read_bytes()
+
+
+def test_rotate_db(tmp_path):
+    from lochness.redcap.data_trigger_capture import rotate_db
+    from lochness.redcap.data_trigger_capture import latest_timestamps
+    db_loc = tmp_path / 'det.csv'
+
+    for x in range(20):
+        save_post_from_redcap(det_post_body(f'subject_{x % 2}'), db_loc)
+    latest = latest_timestamps(db_loc)
+
+    assert not rotate_db(db_loc, db_loc.stat().st_size)
+    assert rotate_db(db_loc, 100)
+
+    assert len(pd.read_csv(db_loc, index_col=0)) == 2
+    assert latest_timestamps(db_loc) == latest
+    assert len(list(tmp_path.glob('.det_*.csv'))) == 1
+
+    # new records are appended to the compacted db
+    save_post_from_redcap(det_post_body('subject_3'), db_loc)
+    assert len(pd.read_csv(db_loc, index_col=0)) == 3
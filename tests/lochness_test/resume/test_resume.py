@@ -0,0 +1,167 @@
+import lochness.resume as resume
+from lochness.resume import Part, resumable
+
+import os
+import io
+import hashlib
+import pytest
+
+
+class FlakyStream(io.BytesIO):
+    '''
+    response stream which fails after `fail_after` bytes, of the whole
+    content, or of its bytes from `first` when the full `size` is given
+    '''
+    def __init__(self, content, fail_after=None, first=None, size=None):
+        super().__init__(content)
+        self.fail_after = fail_after
+        self.status = 200 if size is None else 206
+        self.headers = dict()
+        if size is not None:
+            self.headers['Content-Range'] = \
+                    f'bytes {first}-{first + len(content) - 1}/{size}'
+
+    def read(self, n=-1):
+        if self.fail_after is not None and self.tell() >= self.fail_after:
+            raise ConnectionResetError('connection reset')
+        return super().read(n)
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(resume, 'CHUNK_SIZE', 10)
+
+
+def test_resumable():
+    assert resumable(resume.MIN_SIZE)
+    assert not resumable(resume.MIN_SIZE - 1)
+    assert not resumable(None)
+    assert not resumable(resume.MIN_SIZE, key='key')
+
+
+def test_download_resumes_after_failures(tmpdir, small_chunks):
+    content = os.urandom(100)
+    offsets = []
+
+    def open_range(offset):
+        offsets.append(offset)
+        return FlakyStream(content[offset:], fail_after=30,
+                           first=offset, size=len(content))
+
+    part = Part(str(tmpdir / 'a.bin'), 'id', 'hash', len(content))
+    part_name, hasher = part.download(open_range, hashlib.sha1)
+
+    assert offsets == [0, 30, 60, 90]
+    assert open(part_name, 'rb').read() == content
+    assert hasher.hexdigest() == hashlib.sha1(content).hexdigest()
+
+    part.remove()
+    assert os.listdir(tmpdir) == []
+
+
+def test_download_resumes_after_restart(tmpdir, small_chunks):
+    content = os.urandom(100)
+
+    part = Part(str(tmpdir / 'a.bin'), 'id', 'hash', len(content))
+    with pytest.raises(ConnectionResetError):
+        part.download(lambda x: FlakyStream(content[x:], fail_after=0,
+                                            first=x, size=len(content)),
+                      hashlib.sha1,
+                      stream=FlakyStream(content, fail_after=50))
+    assert os.path.getsize(part.path) == 50
+
+    # a new process picks up from the part file
+    offsets = []
+
+    def open_range(offset):
+        offsets.append(offset)
+        return FlakyStream(content[offset:], first=offset, size=len(content))
+
+    part = Part(str(tmpdir / 'a.bin'), 'id', 'hash', len(content))
+    _, hasher = part.download(open_range, hashlib.sha1)
+    assert offsets == [50]
+    assert hasher.hexdigest() == hashlib.sha1(content).hexdigest()
+
+    # a new version of the remote file starts over
+    offsets.clear()
+    part = Part(str(tmpdir / 'a.bin'), 'id', 'new hash', len(content))
+    part.download(open_range, hashlib.sha1)
+    assert offsets == [0]
+    assert open(part.path, 'rb').read() == content
+
+
+def test_download_blocks(tmpdir):
+    content = os.urandom(1000)
+    ranges = []
+    failed = set()
+
+    def open_range(first, last):
+        ranges.append((first, last))
+        # every block fails once half way
+        if first not in failed:
+            failed.add(first)
+            return FlakyStream(content[first:last + 1], fail_after=50,
+                               first=first, size=len(content))
+        return FlakyStream(content[first:last + 1], first=first,
+                           size=len(content))
+
+    def digest(data):
+        return hashlib.sha256(data).digest()
+
+    part = Part(str(tmpdir / 'a.bin'), 'id', 'hash', len(content))
+    blocks = part.download_blocks(open_range, digest, 300, 3)
+
+    assert open(part.path, 'rb').read() == content
+    assert blocks == [digest(content[x:x + 300]) for x in range(0, 1000, 300)]
+    assert sorted(set(ranges)) == [(0, 299), (300, 599), (600, 899),
+                                   (900, 999)]
+
+    # finished blocks are not downloaded again
+    ranges.clear()
+    part = Part(str(tmpdir / 'a.bin'), 'id', 'hash', len(content))
+    assert part.download_blocks(open_range, digest, 300, 3) == blocks
+    assert ranges == []
+
+
+    # a record cut short by a crash downloads its block again
+    with open(part.blocks, 'r') as fp:
+        records = fp.read().splitlines()
+    with open(part.blocks, 'w') as fp:
+        fp.write('\n'.join(records[:3]) + '\n' + records[3][:10])
+    part = Part(str(tmpdir / 'a.bin'), 'id', 'hash', len(content))
+    assert part.download_blocks(open_range, digest, 300, 3) == blocks
+    assert len(ranges) == 1
+
+
+def test_download_checks_content_range(tmpdir, small_chunks):
+    content = os.urandom(100)
+    part = Part(str(tmpdir / 'a.bin'), 'id', 'hash', len(content))
+    with pytest.raises(ConnectionResetError):
+        part.download(lambda x: FlakyStream(content[x:], fail_after=0,
+                                            first=x, size=len(content)),
+                      hashlib.sha1,
+                      stream=FlakyStream(content, fail_after=50))
+
+    # the whole content in answer to a range request starts over
+    offsets = []
+
+    def open_range(offset):
+        offsets.append(offset)
+        return FlakyStream(content)
+
+    part = Part(str(tmpdir / 'a.bin'), 'id', 'hash', len(content))
+    part_name, hasher = part.download(open_range, hashlib.sha1)
+    assert offsets == [50]
+    assert open(part_name, 'rb').read() == content
+    assert hasher.hexdigest() == hashlib.sha1(content).hexdigest()
+
+    # other bytes than the ones requested are not written
+    part = Part(str(tmpdir / 'b.bin'), 'id', 'hash', len(content))
+    with pytest.raises(resume.PartError):
+        part.download(lambda x: FlakyStream(content[x + 10:], first=x + 10,
+                                            size=len(content)),
+                      hashlib.sha1)
+    assert os.path.getsize(part.path) == 0
+    with pytest.raises(resume.PartError):
+        part.download_blocks(lambda first, last: FlakyStream(content),
+                             hashlib.sha1, 30, 2)
@@ -1,4 +1,6 @@
 import lochness
+import lochness.transfer
+from lochness.transfer import scan, manifest, volume, extract
 import os
 import shutil
 from lochness.transfer import get_updated_files, compress_list_of_files
@@ -32,6 +34,8 @@ import pandas as pd
 import cryptease as crypt
 import tempfile as tf
 import tarfile
+import io
+import contextlib
 import paramiko
 
 from sync import do
@@ -335,3 +339,422 @@ def test_s3_sync_function(Lochness):
     print(os.popen(command).read())
 
     
+
+
+class FakeSFTPFile(io.BytesIO):
+    def __init__(self, sftp, path):
+        super().__init__()
+        self.sftp = sftp
+        self.path = path
+        self.pipelined = False
+
+    def set_pipelined(self, pipelined=True):
+        self.pipelined = pipelined
+
+    def close(self):
+        if not self.closed:
+            self.sftp.files[self.path] = self.getvalue()
+        super().close()
+
+
+class FakeSFTP(object):
+    def __init__(self):
+        self.files = dict()
+        self.opened = []
+        self.renamed = []
+
+    def open(self, path, mode='r', bufsize=-1):
+        if 'r' in mode:
+            if path not in self.files:
+                raise IOError(path)
+            return io.BytesIO(self.files[path])
+        self.opened.append(FakeSFTPFile(self, path))
+        return self.opened[-1]
+
+    def put(self, localpath, remotepath):
+        with open(localpath, 'rb') as fp:
+            self.files[remotepath] = fp.read()
+
+    def posix_rename(self, old, new):
+        self.files[new] = self.files.pop(old)
+        self.renamed.append(new)
+
+    def remove(self, path):
+        self.files.pop(path, None)
+
+    def close(self):
+        pass
+
+
+def test_stream_new_files_over_sftp(tmpdir, monkeypatch):
+    phoenix_root = Path(tmpdir) / 'PHOENIX'
+    for subdir in ['GENERAL/StudyA', 'PROTECTED/StudyA']:
+        (phoenix_root / subdir).mkdir(parents=True)
+        (phoenix_root / subdir / 'a.csv').write_text(subdir)
+        os.utime(phoenix_root / subdir / 'a.csv', (time() - 60,) * 2)
+
+    sftp = FakeSFTP()
+    monkeypatch.setattr(lochness.transfer, 'connect_sftp',
+                        lambda Lochness: (sftp, sftp, '/remote'))
+    Lochness = {'phoenix_root': str(phoenix_root),
+                'lochness_sync_history_csv': str(tmpdir / 'history.csv'),
+                'lochness_sync_stream': True,
+                'keyring': {}}
+    pwd = os.getcwd()
+    lochness_to_lochness_transfer_sftp(Lochness)
+
+    assert os.getcwd() == pwd
+    assert sftp.opened[0].pipelined
+    assert sftp.opened[0].path.endswith('.tar.part')
+    remote_path, index_path = sorted(sftp.files)
+    assert remote_path.startswith('/remote/') and remote_path.endswith('.tar')
+    assert index_path == remote_path + '.json'
+    with tarfile.open(fileobj=io.BytesIO(sftp.files[remote_path])) as tar:
+        assert tar.getnames() == ['PHOENIX/GENERAL/StudyA/a.csv']
+        assert tar.extractfile('PHOENIX/GENERAL/StudyA/a.csv').read() == \
+                b'GENERAL/StudyA'
+    assert Path(Lochness['lochness_sync_history_csv']).is_file()
+
+
+def test_send_new_volumes_over_sftp(tmpdir, monkeypatch):
+    from lochness.transfer import send_new_volumes_over_sftp
+
+    phoenix_root = Path(tmpdir) / 'PHOENIX'
+    (phoenix_root / 'GENERAL' / 'StudyA').mkdir(parents=True)
+    for name in ['a.csv', 'b.csv']:
+        path = phoenix_root / 'GENERAL' / 'StudyA' / name
+        path.write_bytes(os.urandom(20000))
+        os.utime(path, (time() - 60,) * 2)
+
+    sftp = FakeSFTP()
+    monkeypatch.setattr(lochness.transfer, 'connect_sftp',
+                        lambda Lochness: (sftp, sftp, '/remote'))
+    monkeypatch.chdir(tmpdir)
+    Lochness = {'phoenix_root': str(phoenix_root),
+                'lochness_sync_history_csv': str(tmpdir / 'history.csv'),
+                'lochness_sync_codec': 'gzip',
+                'lochness_sync_max_volume_size': 10000,
+                'keyring': {}}
+    send_new_volumes_over_sftp(Lochness)
+
+    # every volume is renamed after its index
+    volumes = [x for x in sftp.renamed if x.endswith('.tar.gz')]
+    assert len(volumes) == 2
+    assert sftp.renamed == [x + y for x in volumes
+                            for y in [volume.INDEX_SUFFIX, '']]
+    assert sorted(sftp.files) == sorted(sftp.renamed)
+
+
+def make_phoenix(root, mtime):
+    for path in ['top.csv', 'GENERAL/StudyA/a.csv',
+                 'GENERAL/StudyA/raw/new\nline.csv', 'GENERAL/StudyB/b.csv',
+                 'PROTECTED/StudyA/p.csv']:
+        path = root / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text('x')
+        os.utime(path, (mtime, mtime))
+    for path in sorted(root.glob('**/*'), reverse=True):
+        os.utime(path, (mtime, mtime))
+
+
+def test_scan_updated_files(tmpdir):
+    root = Path(tmpdir) / 'PHOENIX'
+    make_phoenix(root, time() - 3600)
+    now = time()
+
+    assert get_updated_files(str(root), now - 60, now) == []
+
+    found = get_updated_files(str(root), now - 7200, now)
+    assert sorted(found) == [Path('PHOENIX/GENERAL/StudyA/a.csv'),
+                             Path('PHOENIX/GENERAL/StudyA/raw/new\nline.csv'),
+                             Path('PHOENIX/GENERAL/StudyB/b.csv'),
+                             Path('PHOENIX/top.csv')]
+
+    found = scan.updated_files(str(root), now - 7200, now, False, workers=1)
+    assert Path('PHOENIX/PROTECTED/StudyA/p.csv') in list(found)
+
+
+def test_scan_skips_removed_entries(tmpdir, monkeypatch):
+    root = Path(tmpdir) / 'PHOENIX'
+    make_phoenix(root, time() - 3600)
+    study = root / 'GENERAL' / 'StudyA'
+    for name in ['x.csv', 'y.csv', 'z.csv']:
+        (study / name).write_text('x')
+        os.utime(study / name, (time() - 3600,) * 2)
+    scandir = os.scandir
+
+    class Removed(object):
+        '''entry of a file removed after the listing'''
+        def __init__(self, entry):
+            self.entry = entry
+            self.name, self.path = entry.name, entry.path
+
+        def is_dir(self, follow_symlinks=True):
+            return False
+
+        def is_file(self, follow_symlinks=True):
+            return True
+
+        def stat(self, follow_symlinks=True):
+            raise FileNotFoundError(self.path)
+
+    @contextlib.contextmanager
+    def scandir_removing_y(path):
+        with scandir(path) as entries:
+            yield [Removed(x) if x.name == 'y.csv' else x for x in entries]
+
+    monkeypatch.setattr(scan.os, 'scandir', scandir_removing_y)
+    now = time()
+    found = get_updated_files(str(root), now - 7200, now)
+    assert sorted(x.name for x in found if x.parent.name == 'StudyA') == \
+        ['a.csv', 'x.csv', 'z.csv']
+
+
+def test_scan_directory_index(tmpdir):
+    root = Path(tmpdir) / 'PHOENIX'
+    make_phoenix(root, time() - 3600)
+    index_path = str(tmpdir / 'cache' / 'directories.json')
+    start = time() - 60
+    index = scan.DirectoryIndex(index_path)
+    assert list(scan.updated_files(str(root), start - 7200, start,
+                                   index=index)) != []
+
+    index = scan.DirectoryIndex(index_path)
+    assert index.scanned_until == start
+    assert str(root / 'GENERAL' / 'StudyA') in index.directories
+
+    # modified in place, without changing the directory
+    os.utime(root / 'GENERAL' / 'StudyA' / 'a.csv', (start + 1, start + 1))
+    # replaced, which changes the directory
+    (root / 'GENERAL' / 'StudyB' / 'tmp').write_text('y')
+    os.rename(root / 'GENERAL' / 'StudyB' / 'tmp',
+              root / 'GENERAL' / 'StudyB' / 'b.csv')
+    os.utime(root / 'GENERAL' / 'StudyB' / 'b.csv', (start + 1, start + 1))
+
+    end = time() + 1
+    found = list(scan.updated_files(str(root), start, end, index=index))
+    assert found == [Path('PHOENIX/GENERAL/StudyB/b.csv')]
+
+    # an index of a later scan is not used
+    index.scanned_until = end
+    found = list(scan.updated_files(str(root), start, end, index=index))
+    assert sorted(found) == [Path('PHOENIX/GENERAL/StudyA/a.csv'),
+                             Path('PHOENIX/GENERAL/StudyB/b.csv')]
+
+
+def test_transfer_manifest(tmpdir, monkeypatch):
+    phoenix_root = Path(tmpdir) / 'PHOENIX'
+    for name in ['a.csv', 'b.csv']:
+        (phoenix_root / 'GENERAL' / 'StudyA').mkdir(parents=True,
+                                                    exist_ok=True)
+        (phoenix_root / 'GENERAL' / 'StudyA' / name).write_text(name)
+        os.utime(phoenix_root / 'GENERAL' / 'StudyA' / name,
+                 (time() - 60,) * 2)
+
+    sftp = FakeSFTP()
+    monkeypatch.setattr(lochness.transfer, 'connect_sftp',
+                        lambda Lochness: (sftp, sftp, str(tmpdir / 'in')))
+    Lochness = {'phoenix_root': str(phoenix_root),
+                'lochness_sync_history_csv': str(tmpdir / 'history.csv'),
+                'lochness_sync_stream': True,
+                'lochness_sync_manifest': True,
+                'cache_dir': str(tmpdir / 'cache'),
+                'keyring': {}}
+
+    def transfer():
+        '''send, then receive the tarball and return the files sent'''
+        os.remove(Lochness['lochness_sync_history_csv'])
+        lochness_to_lochness_transfer_sftp(Lochness)
+        remote_path, = [x for x in sftp.files if x.endswith('.tar')]
+        tar_path = Path(tmpdir) / 'in' / Path(remote_path).name
+        tar_path.write_bytes(sftp.files.pop(remote_path))
+        received = decompress_transferred_file_and_copy(
+                str(tmpdir / 'DPACC' / 'PHOENIX'), tar_path)
+        manifest.update_ack(str(tmpdir / 'in'), received)
+        ack_path = str(tmpdir / 'in' / manifest.ACK)
+        sftp.files[ack_path] = Path(ack_path).read_bytes()
+        return sorted(received)
+
+    (tmpdir / 'in').mkdir()
+    Path(Lochness['lochness_sync_history_csv']).touch()
+    assert transfer() == ['PHOENIX/GENERAL/StudyA/a.csv',
+                          'PHOENIX/GENERAL/StudyA/b.csv']
+    assert (tmpdir / 'DPACC' / 'PHOENIX' / 'GENERAL' / 'StudyA' /
+            'b.csv').read_text('utf-8') == 'b.csv'
+    assert not (tmpdir / 'DPACC' / 'PHOENIX' / manifest.MANIFEST).exists()
+
+    # touched, but not changed
+    os.utime(phoenix_root / 'GENERAL' / 'StudyA' / 'a.csv')
+    (phoenix_root / 'GENERAL' / 'StudyA' / 'b.csv').write_text('changed')
+    for name in ['a.csv', 'b.csv']:
+        os.utime(phoenix_root / 'GENERAL' / 'StudyA' / name,
+                 (time() - 30,) * 2)
+    assert transfer() == ['PHOENIX/GENERAL/StudyA/b.csv']
+    assert (tmpdir / 'DPACC' / 'PHOENIX' / 'GENERAL' / 'StudyA' /
+            'b.csv').read_text('utf-8') == 'changed'
+
+    hashes = json.loads((tmpdir / 'cache' / 'transfer' /
+                         'sent_manifest.json').read_text('utf-8'))
+    assert hashes['PHOENIX/GENERAL/StudyA/a.csv'][2] == manifest.hash_file(
+            phoenix_root / 'GENERAL' / 'StudyA' / 'a.csv')
+
+
+def test_manifest_hashes_files_sent_while_adding_them(tmpdir, monkeypatch):
+    from lochness.transfer import add_files_to_tar
+
+    phoenix_root = Path(tmpdir) / 'PHOENIX'
+    study = phoenix_root / 'GENERAL' / 'StudyA'
+    study.mkdir(parents=True)
+    file_list = []
+    for name, content in [('a.csv', 'a'), ('b.csv', 'bb'), ('c.csv', 'c')]:
+        (study / name).write_text(content)
+        file_list.append(str((study / name).relative_to(tmpdir)))
+    hashes = {x: manifest.hash_file(Path(tmpdir) / x) for x in file_list}
+
+    # only c.csv has the size of the file on the receiver
+    hashed = []
+    hash_file = manifest.hash_file
+    monkeypatch.setattr(manifest, 'hash_file',
+                        lambda x: hashed.append(x) or hash_file(x))
+    file_manifest = manifest.Manifest(str(phoenix_root),
+                                      {file_list[1]: [1, 'hash'],
+                                       file_list[2]: [1, 'hash']})
+    with tarfile.open(Path(tmpdir) / 'out.tar', 'w') as tar:
+        add_files_to_tar(tar, str(phoenix_root), file_list, file_manifest)
+
+    assert hashed == [Path(tmpdir) / file_list[2]]
+    assert file_manifest.sent == {
+            x: [os.path.getsize(Path(tmpdir) / x), hashes[x]]
+            for x in file_list}
+    assert [x[2] for x in file_manifest.hashes.values()] == \
+        [hashes[x] for x in file_list]
+
+
+@pytest.mark.parametrize('codec', [
+    'none', 'gzip',
+    pytest.param('zstd', marks=pytest.mark.skipif(
+        not shutil.which('zstd'), reason='zstd is not installed'))])
+def test_write_volumes(tmpdir, codec):
+    phoenix_root = Path(tmpdir) / 'PHOENIX'
+    file_list = []
+    for number in range(10):
+        path = phoenix_root / 'GENERAL' / 'StudyA' / f'{number}.csv'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(os.urandom(4000))
+        file_list.append(path.relative_to(tmpdir))
+    (tmpdir / 'out').mkdir()
+
+    volumes = volume.write_volumes(str(phoenix_root), file_list,
+                                   volume.LocalSink(str(tmpdir / 'out')),
+                                   'transfer', codec=codec, threads=2,
+                                   max_size=10000)
+    assert volumes == [f'transfer.{x:04d}{volume.CODECS[codec]}'
+                       for x in range(1, 6)]
+    assert sorted(os.listdir(tmpdir / 'out')) == sorted(
+            volumes + [x + volume.INDEX_SUFFIX for x in volumes])
+
+    # each volume is processed on its own
+    for filename in reversed(volumes):
+        index = json.loads((tmpdir / 'out' / (filename + '.json')).read_text(
+                'utf-8'))
+        assert index['codec'] == codec and len(index['files']) == 2
+        with volume.stream_volume(str(tmpdir / 'out' / filename)) as tar:
+            assert [x.name for x in tar] == index['files']
+        path = str(tmpdir / 'out' / filename)
+        extract.extract_volume(str(tmpdir / 'DPACC' / 'PHOENIX'), path,
+                               index=volume.read_index(path))
+
+    for file_path in file_list:
+        assert (tmpdir / 'DPACC' / file_path).read_binary() == \
+                (tmpdir / file_path).read_binary()
+
+
+def test_extract_volume_checks_index(tmpdir):
+    phoenix_root = Path(tmpdir) / 'PHOENIX'
+    study = phoenix_root / 'GENERAL' / 'StudyA'
+    study.mkdir(parents=True)
+    file_list = []
+    for number in range(3):
+        path = study / f'{number}.csv'
+        path.write_bytes(os.urandom(4000))
+        file_list.append(path.relative_to(tmpdir))
+    out = Path(tmpdir) / 'out'
+    out.mkdir()
+    filename, = volume.write_volumes(str(phoenix_root), file_list,
+                                     volume.LocalSink(str(out)), 'transfer')
+    path = str(out / filename)
+    index = volume.read_index(path)
+
+    def extract_with(**changes):
+        with pytest.raises(volume.VolumeError):
+            extract.extract_volume(str(tmpdir / 'DPACC' / 'PHOENIX'), path,
+                                   index=dict(index, **changes))
+
+    extract_with(volume=2)
+    extract_with(codec='gzip')
+    extract_with(files=index['files'][1:])
+    extract_with(files=index['files'] + ['PHOENIX/GENERAL/StudyA/3.csv'])
+    extract_with(size=index['size'] + tarfile.RECORDSIZE)
+    assert os.path.exists(path)
+
+    extract.extract_volume(str(tmpdir / 'DPACC' / 'PHOENIX'), path,
+                           index=index)
+    assert not os.path.exists(path)
+
+
+def write_versions(incoming, number):
+    '''write a tarball with a version of the same file'''
+    tar_path = incoming / f'{number}.tar'
+    with tarfile.open(tar_path, 'w') as tar:
+        for name in ['same.csv', f'{number}.csv']:
+            content = f'version {number}'.encode()
+            info = tarfile.TarInfo(f'PHOENIX/GENERAL/StudyA/{name}')
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    os.utime(tar_path, (time() - 100 + number,) * 2)
+    return tar_path
+
+
+def test_receive_tarballs_in_order(tmpdir):
+    incoming = Path(tmpdir) / 'in'
+    incoming.mkdir()
+    for number in range(8):
+        write_versions(incoming, number)
+    (incoming / 'ignored.tar.part').touch()
+
+    Lochness = {'phoenix_root': str(tmpdir / 'DPACC' / 'PHOENIX'),
+                'lochness_sync_history_csv': str(tmpdir / 'history.csv'),
+                'lochness_sync_receive_workers': 4,
+                'keyring': {'lochness_sync': {'PATH_IN_HOST': str(incoming)}}}
+    lochness_to_lochness_transfer_receive_sftp(Lochness)
+
+    study = Path(Lochness['phoenix_root']) / 'GENERAL' / 'StudyA'
+    assert (study / 'same.csv').read_text() == 'version 7'
+    assert sorted(os.listdir(study)) == sorted(
+            ['same.csv'] + [f'{x}.csv' for x in range(8)])
+    assert os.stat(study / '3.csv').st_mode & 0o777 == 0o644
+    assert os.listdir(incoming) == ['ignored.tar.part']
+
+
+def test_receive_keeps_tarballs_after_a_failure(tmpdir):
+    incoming = Path(tmpdir) / 'in'
+    incoming.mkdir()
+    for number in range(6):
+        write_versions(incoming, number)
+    (incoming / '2.tar').write_bytes(b'not a tarball')
+    os.utime(incoming / '2.tar', (time() - 98,) * 2)
+
+    Lochness = {'phoenix_root': str(tmpdir / 'DPACC' / 'PHOENIX'),
+                'lochness_sync_history_csv': str(tmpdir / 'history.csv'),
+                'keyring': {'lochness_sync': {'PATH_IN_HOST': str(incoming)}}}
+    with pytest.raises(tarfile.ReadError):
+        lochness_to_lochness_transfer_receive_sftp(Lochness)
+    assert sorted(os.listdir(incoming)) == [f'{x}.tar' for x in range(2, 6)]
+
+    # the failed tarball does not replace the files of later tarballs
+    write_versions(incoming, 2)
+    lochness_to_lochness_transfer_receive_sftp(Lochness)
+    study = Path(Lochness['phoenix_root']) / 'GENERAL' / 'StudyA'
+    assert (study / 'same.csv').read_text() == 'version 5'
+    assert (study / '2.csv').read_text() == 'version 2'
+    assert os.listdir(incoming) == []
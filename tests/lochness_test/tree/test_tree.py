@@ -148,3 +148,25 @@ def test_get_more_than_one_study():
 
     show_tree_then_delete('PHOENIX')
 
+
+
+def test_get_looks_up_folders_once(tmpdir, monkeypatch):
+    import lochness.tree as tree
+    base = str(tmpdir / 'PHOENIX' / 'GENERAL' / 'StudyA' / '1001')
+    folder = get('surveys', base, BIDS=False)
+    assert Path(folder).is_dir()
+    assert get('surveys', base, BIDS=False) is folder
+
+    # found folders are not looked up on disk again
+    def no_stat(path):
+        raise AssertionError(f'stat {path}')
+    with monkeypatch.context() as m:
+        m.setattr(os.path, 'exists', no_stat)
+        get('surveys', base, BIDS=False)
+
+    # until they are forgotten
+    shutil.rmtree(str(tmpdir / 'PHOENIX'))
+    tree.forget(str(tmpdir / 'PHOENIX'))
+    assert not Path(folder).is_dir()
+    get('surveys', base, BIDS=False)
+    assert Path(folder).is_dir()
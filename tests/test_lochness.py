@@ -7,6 +7,7 @@ import json
 from lochness import config
 from lochness import box
 from lochness import mindlamp
+import lochness.tree
 import boxsdk
 
 import sys, os, shutil
@@ -31,6 +32,8 @@ class SyncArgs(object):
         self.archive_base = None
         self.hdd = None
         self.dry = False
+        self.workers = 1
+        self.worker_type = 'thread'
         self.rsync = False
         self.s3 = False
 
@@ -240,11 +243,12 @@ def show_tree_then_delete(tmp_dir):
     print(f'Temporary directory structure : {tmp_dir}')
     print('-'*75)
     print(os.popen(f'tree {tmp_dir}').read())
-    shutil.rmtree(tmp_dir)
+    rmtree(tmp_dir)
 
 
 def rmtree(tmp_dir):
     shutil.rmtree(tmp_dir)
+    lochness.tree.forget()
 
 
 def test_do():
@@ -293,6 +297,60 @@ def test_read_phoenix_metadata():
         assert list(subject.xnat.values())[0][0][0] == 'HCPEP-BWH'
 
 
+def test_subjects_parsed_once(tmpdir, monkeypatch):
+    metadata = tmpdir / 'StudyA_metadata.csv'
+    pd.DataFrame({'Active': [1, 0],
+                  'Consent': ['2021-01-01', '2021-01-02'],
+                  'Subject ID': ['1001', ' 1002 '],
+                  'Box': ['*', 'box.a:X1;box.a:X2'],
+                  'XNAT': ['xnat.b:PROJ:1001', 'xnat.b:PROJ:1002'],
+                  'Saliva': ['a; b', 'c']}).to_csv(metadata, index=False)
+
+    def subjects():
+        return list(lochness._subjects({}, 'StudyA', 'G', 'P', str(metadata)))
+
+    first = subjects()
+    assert [x.id for x in first] == ['1001', '1002']
+    assert first[0].box == {'box.*': ['1001']}
+    assert first[1].box == {'box.a': ['X1', 'X2']}
+    assert first[0].xnat == {'xnat.b': [('PROJ', '1001')]}
+    assert first[1].xnat == {'xnat.b': [('PROJ', '1002')]}
+    assert first[0].saliva == ['a', 'b']
+    assert first[0].dropbox == {} and type(first[0].dropbox) is dict
+    assert first[0].general_folder == os.path.join('G', 'StudyA', '1001')
+
+    # an unchanged file is not parsed again
+    monkeypatch.setattr(pd, 'read_csv', None)
+    first[0].box['box.*'].append('modified')
+    os.utime(metadata, (0, 0))
+    assert [x.asdict() for x in subjects()][0]['box'] == {'box.*': ['1001']}
+    monkeypatch.undo()
+
+    with open(metadata, 'a') as fp:
+        fp.write('1,2021-01-03,1003,box.a:X3:X4,xnat.b:PROJ:1003,d\n')
+    with pytest.raises(lochness.StudyMetadataError):
+        subjects()
+
+
+def test_subject_thaws_sources_on_access():
+    import pickle
+    box = lochness.FrozenSources([('box.a', ('X1', 'X2'))])
+    subject = lochness.Subject(1, 'StudyA', '1001', '2021-01-01',
+                               lochness.NO_COLUMN, {}, lochness.FrozenList(),
+                               {}, {}, {}, box, {}, {}, {}, {},
+                               'G/StudyA/1001', 'P/StudyA/1001', 'm.csv')
+    assert not hasattr(subject, '__dict__')
+    assert subject.beiwe == {} and type(subject.beiwe) is dict
+    assert subject.saliva == []
+
+    subject.box['box.a'].append('X3')
+    assert subject.box == {'box.a': ['X1', 'X2', 'X3']}
+    assert box == (('box.a', ('X1', 'X2')),)
+
+    copy = pickle.loads(pickle.dumps(subject))
+    assert copy.asdict() == subject.asdict()
+
+
 def test_box_module():
     args = LochnessArgs()
     args.source = ['xnat', 'box', 'redcap']